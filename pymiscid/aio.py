@@ -0,0 +1,660 @@
+#
+"""
+This module is the asyncio backend of the connectors. The connectors run in
+the thread of their event loop (trollius on python 2) : sends write directly
+to the transports, the observers are called in the loop and the connections
+and the control queries return asyncio futures. It does not need the twisted
+reactor to run.
+"""
+import os
+import socket
+import weakref
+import logging
+
+from bip.aio import asyncio, AIOProtocolAdapter, loop_clock
+from bip.factory import BIPFactory
+from bip.protocol import UNBOUNDED_PEERID, Peerid, CONTROL_CAPABILITY
+from bip.flow import BLOCK
+from twisted.internet import defer
+
+from connector import BIPPrimalConnector, ConnectorProxy, is_local_host, \
+                      INPUT, OUTPUT, INOUTPUT, connector_type_to_xml_tag_map
+from dispatcher import BasicEventDispatcher, ControlEventDispatcher
+from executor import INLINE
+import controlcodec
+import variable
+
+import codebench.generator as generator
+import codebench.xml as xml
+
+from cstes import UNBOUNDED_CONNECTOR_NAME, \
+                  TXT_SEPARATOR, \
+                  IO_CONNECTOR_PREFIX, \
+                  INPUT_CONNECTOR_PREFIX, \
+                  OUTPUT_CONNECTOR_PREFIX, \
+                  CONNECTION_TIMEOUT, \
+                  REQUEST_CONTROL_QUERY, \
+                  SERVICE_FULL_DESCRIPTION, \
+                  VARIABLE_TAG, \
+                  XML_VARIABLE_TYPE
+
+logger = logging.getLogger(__name__)
+
+def deferred_to_future(deferred, loop):
+    """
+    This function returns a future of the loop which gets the result or the
+    exception of the deferred.
+    """
+    future = asyncio.Future(loop = loop)
+    def callback(result):
+        if not future.done():
+            future.set_result(result)
+    def errback(failure):
+        if not future.done():
+            future.set_exception(failure.value)
+    deferred.addCallbacks(callback, errback)
+    return future
+
+def chain(future, fct, loop):
+    """
+    This function returns a future which gets fct(result) once the given
+    future is done, or its exception.
+    """
+    result = asyncio.Future(loop = loop)
+    def done(future):
+        if future.cancelled():
+            result.cancel()
+        elif future.exception() is not None:
+            result.set_exception(future.exception())
+        else:
+            try:
+                result.set_result(fct(future.result()))
+            except Exception, err:
+                result.set_exception(err)
+    future.add_done_callback(done)
+    return result
+
+
+class AIOConnector(BIPPrimalConnector):
+    """
+    This object is the asyncio version of the Connector. Every method must be
+    called from the thread of the loop. The observers are called directly in
+    the loop (the INLINE executor) so they must be quick and succint.
+    """
+    name = UNBOUNDED_CONNECTOR_NAME
+    peerid = UNBOUNDED_PEERID
+    dispatch_workers = INLINE
+
+    tcp = None
+    unix = None
+    server = None
+    high_water = None
+    slow_peer_policy = BLOCK
+
+    # set when the connector runs in a LoopThread, the sends made from
+    # another thread are then routed to the loop
+    loop_thread = None
+    received_count = 0
+    closed_frames = 0
+
+    def __init__(self, description = "Unknown Description", loop = None):
+        """
+        Init
+        """
+        BIPPrimalConnector.__init__(self)
+        self.description = description
+        self.loop = asyncio.get_event_loop() if loop is None else loop
+        self.dispatcher = BasicEventDispatcher()
+        self.protocol_factory = BIPFactory()
+        self.protocol_factory.service = weakref.proxy(self)
+        self.waiting = {}
+
+    def __adapter__(self):
+        return AIOProtocolAdapter(self.protocol_factory, self.loop)
+
+    def start(self, host = None, port = 0, sock = None):
+        """
+        This method starts listening, by default on every interface and on a
+        free port, or on the given listening socket. It returns a future which
+        gets the connector.
+        """
+        def started(server):
+            self.server = server
+            self.tcp = server.sockets[0].getsockname()[1]
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Starting Connector on port : %d" % (self.tcp))
+            return self
+        if sock is None:
+            server = self.loop.create_server(self.__adapter__, host, port)
+        else:
+            server = self.loop.create_server(self.__adapter__, sock = sock)
+        return chain(asyncio.ensure_future(server, loop = self.loop), started,
+                     self.loop)
+
+    def stop(self):
+        """
+        This method stops listening and closes every connection.
+        """
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+        for peer in self.peers.values():
+            peer.transport.loseConnection()
+        self.tcp = None
+
+    def connect(self, proxy, timeout = CONNECTION_TIMEOUT):
+        """
+        This method connects to a remote connector, through its unix socket if
+        it is on the same host. It returns a future which gets the peerid once
+        the handshake is done.
+        """
+        future = asyncio.Future(loop = self.loop)
+        if proxy.peerid in self.peers:
+            future.set_result(proxy.peerid)
+            return future
+        self.waiting.setdefault(proxy.peerid, []).append(future)
+        unix = getattr(proxy, 'unix', None)
+        if (unix is not None) and is_local_host(proxy.host, proxy.addr) and \
+           os.path.exists(unix):
+            task = self.loop.create_unix_connection(self.__adapter__, unix)
+        else:
+            task = self.loop.create_connection(self.__adapter__, proxy.host,
+                                               int(proxy.tcp))
+        def failed(task):
+            if (task.exception() is not None) and not future.done():
+                future.set_exception(task.exception())
+        asyncio.ensure_future(task, loop = self.loop).add_done_callback(failed)
+        def timedout():
+            if not future.done():
+                if logger.isEnabledFor(logging.WARNING):
+                    logger.warning("Connection Timed Out -- %s --"
+                                   % str(proxy.peerid))
+                future.set_exception(RuntimeError("Connection timeout reached"))
+        self.loop.call_later(timeout, timedout)
+        return future
+
+    def disconnect(self, peerid):
+        """
+        This method closes the connection with a peer.
+        """
+        self.__disconnect__(peerid)
+
+    def connected(self, protocol):
+        """
+        This is an override for the primal connector protocol callback to
+        resolve the futures waiting for the peer.
+        """
+        BIPPrimalConnector.connected(self, protocol)
+        for future in self.waiting.pop(protocol.rpeerid, []):
+            if not future.done():
+                future.set_result(protocol.rpeerid)
+
+    def disconnected(self, protocol):
+        """
+        Same as BIPPrimalConnector.disconnected, the frames written to the
+        peer stay in the accounting.
+        """
+        if protocol.writer is not None:
+            self.closed_frames += protocol.writer.frames
+        BIPPrimalConnector.disconnected(self, protocol)
+
+    def __get_sent_count__(self):
+        return self.closed_frames + sum([peer.writer.frames for peer in
+                                         self.peers.values()
+                                         if peer.writer is not None])
+    # frames written to the transports of the peers, handshakes and heartbeats
+    # included
+    sent_count = property(__get_sent_count__)
+
+    def receivedBatch(self, msgs):
+        """
+        Same as BIPPrimalConnector.receivedBatch, with the accounting.
+        """
+        self.received_count += len(msgs)
+        BIPPrimalConnector.receivedBatch(self, msgs)
+
+    def streamStarted(self, msg):
+        """
+        The messages are never streamed by this backend.
+        """
+        pass
+    streamChunk = streamEnded = streamStarted
+
+    def send(self, msg, peerid = None):
+        """
+        This method sends the msg to the given peer, or to every peer, without
+        any thread hop. From another thread than the one of its LoopThread, the
+        call is routed to the loop.
+        """
+        if (self.loop_thread is not None) and not self.loop_thread.inLoop():
+            self.loop_thread.call(self.send, msg, peerid)
+            return
+        self.__send__(msg, peerid = peerid)
+
+    __call__ = send
+
+    def send_future(self, msg, peerid = None):
+        """
+        Same as send but returns a future which gets done, with the number of
+        peers, when the msg reaches the transport of every peer, or fails with
+        a SlowPeerError.
+        """
+        deferred = defer.Deferred()
+        self.__send__(msg, peerid = peerid, deferred = deferred)
+        return deferred_to_future(deferred, self.loop)
+
+
+class AIOIConnector(AIOConnector):
+    """
+    The asyncio version of the IConnector.
+    """
+    def send(self, msg, peerid = None):
+        """
+        Raise an Exception.
+        """
+        raise RuntimeError("Sending msg through an Input Connector")
+
+    send_future = send
+
+
+class AIOOConnector(AIOConnector):
+    """
+    The asyncio version of the OConnector.
+    """
+    def receivedBatch(self, msgs):
+        """
+        Close connection on the client which tries to send something to an
+        output connector.
+        """
+        for msg in msgs:
+            msg.release()
+        msg = msgs[0]
+        if logger.isEnabledFor(logging.WARNING):
+            logger.warning("Receiving msg : Output Only Connector <closing>")
+        if msg.peerid in self.peers:
+            self.peers[msg.peerid].transport.loseConnection()
+
+
+class AIOControlConnector(AIOConnector):
+    """
+    This object is the asyncio version of the ControlConnector, the queries
+    return futures.
+    """
+    name = "control"
+    binary_control = False
+
+    def __init__(self, loop = None):
+        """
+        Initialisation of the generator and the ControlDispatcher()
+        """
+        self.qid_generator = generator.uid_generator()
+        AIOConnector.__init__(self, loop = loop)
+        self.dispatcher = ControlEventDispatcher()
+        self.dispatcher.clock = loop_clock(self.loop)
+        self.dispatcher.control = weakref.ref(self)
+
+    def query(self, msg, peerid):
+        """
+        This method sends a control query to the given peerid, the connection
+        must be active. It returns a future which gets the list of the answer
+        elements.
+        """
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Sending Query ... to %s" % str(peerid))
+        qid = self.qid_generator.next()
+        answer = self.dispatcher.addWaitingAnswer(qid, peerid)
+        self.send(controlcodec.message(controlcodec.QUERY, qid, msg,
+                                       self.binaryControl(peerid)),
+                  peerid = peerid)
+        return deferred_to_future(answer, self.loop)
+
+    def answer(self, msg, qid, peerid):
+        """
+        This method answers a particular query.
+        """
+        self.send(controlcodec.message(controlcodec.ANSWER, qid, msg,
+                                       self.binaryControl(peerid)),
+                  peerid = peerid)
+
+    def event(self, msg, peerid):
+        """
+        This method sends an event to a particular peerid.
+        """
+        self.send(controlcodec.message(controlcodec.EVENT, 0, msg,
+                                       self.binaryControl(peerid)),
+                  peerid = peerid)
+
+    def binaryControl(self, peerid):
+        """
+        Same as ControlConnector.binaryControl.
+        """
+        protocol = self.peers.get(peerid, None)
+        return (protocol is not None) and \
+               (CONTROL_CAPABILITY in protocol.negotiated)
+
+
+class AIOServiceProxy(object):
+    """
+    This object gives the queries of a ServiceProxy as futures through an
+    AIOControlConnector. The description is only known once queryDescription
+    is done.
+    """
+    def __init__(self, control, peerid, host, addr, port, unix = None):
+        """
+        Init method
+        """
+        self.control = control
+        self.peerid = Peerid(peerid)
+        self.host = host
+        self.addr = addr
+        self.tcp = port
+        self.unix = unix
+        self.variables = {}
+        self.connectors = {}
+
+    def connect(self):
+        """
+        This method connects the control connector to the service, it returns
+        a future.
+        """
+        return self.control.connect(self)
+
+    def disconnect(self):
+        """
+        This method closes the control connection.
+        """
+        self.control.disconnect(self.peerid)
+
+    def __query__(self, msg, fct):
+        return chain(self.control.query(msg, self.peerid), fct,
+                     self.control.loop)
+
+    def update(self, elements):
+        """
+        This method updates the variables and connectors proxies from a
+        description.
+        """
+        for child in elements:
+            name = child.attrib['name']
+            if child.tag == VARIABLE_TAG:
+                if name not in self.variables:
+                    self.variables[name] = variable.VariableProxy()
+                    self.variables[name].name = name
+                obj = self.variables[name]
+            else:
+                if name not in self.connectors:
+                    con = ConnectorProxy(name, self.addr)
+                    con.type = child.tag
+                    con.host = self.host
+                    self.connectors[name] = con
+                obj = self.connectors[name]
+            xml.Marshall.update(obj, child)
+        return self
+
+    def queryDescription(self):
+        """
+        This method returns a future which gets the proxy once its description
+        is up to date.
+        """
+        return self.__query__(SERVICE_FULL_DESCRIPTION, self.update)
+
+    def queryVariableValue(self, vname):
+        """
+        This method returns a future which gets the value of a remote
+        variable.
+        """
+        def value(elements):
+            return elements[0].find('value').text
+        return self.__query__(REQUEST_CONTROL_QUERY %
+                              (XML_VARIABLE_TYPE, vname), value)
+
+    def queryConnectedPeers(self, cname):
+        """
+        This method returns a future which gets the peerids connected to the
+        given connector. The description must be known.
+        """
+        conn = self.connectors[cname]
+        def peers(elements):
+            return [Peerid(e.text) for e in
+                    elements[0].find('peers').findall('peer')]
+        return self.__query__(REQUEST_CONTROL_QUERY % (conn.xml_type, cname),
+                              peers)
+
+    def queryVariableValues(self, names):
+        """
+        This method returns a future which gets the dict of the values of
+        several variables, and of the connected peers of the connectors among
+        the names, with a single control query.
+        """
+        requests = []
+        for name in names:
+            if name in self.connectors:
+                xml_type = self.connectors[name].xml_type
+            else:
+                xml_type = XML_VARIABLE_TYPE
+            requests.append(REQUEST_CONTROL_QUERY % (xml_type, name))
+        def values(elements):
+            res = {}
+            for element in elements:
+                name = element.attrib['name']
+                if element.tag == VARIABLE_TAG:
+                    res[name] = element.find('value').text
+                else:
+                    res[name] = [Peerid(e.text) for e in
+                                 element.find('peers').findall('peer')]
+            missing = [name for name in names if name not in res]
+            if len(missing) != 0:
+                raise KeyError("No answer for %s" % ", ".join(missing))
+            return res
+        return self.__query__(''.join(requests), values)
+
+
+class ShardedConnector(object):
+    """
+    This object is a connector served by several loops of a LoopGroup. Each
+    shard is an AIOConnector running in its own loop, they share the peerid
+    and the dispatcher. Where SO_REUSEPORT is available, every shard listens on
+    the same port and the kernel spreads the incoming connections, otherwise
+    only the first one listens. The outgoing connections go to the shard with
+    the fewest peers. It has the thread safe API of the Connector so it can be
+    added to a StoppedService, the calls are routed to the loop of the shard
+    of the peer.
+    """
+    name = UNBOUNDED_CONNECTOR_NAME
+    tcp = None
+    udp = 0
+    unix = None
+    running = 0
+    __peerid__ = UNBOUNDED_PEERID
+
+    shard_type = {INPUT : AIOIConnector,
+                  OUTPUT : AIOOConnector,
+                  INOUTPUT : AIOConnector}
+    txt_prefixes = {INPUT : INPUT_CONNECTOR_PREFIX,
+                    OUTPUT : OUTPUT_CONNECTOR_PREFIX,
+                    INOUTPUT : IO_CONNECTOR_PREFIX}
+
+    xml_attributes = ['name']
+    xml_childs = ['tcp', 'description', 'peerId', 'peers']
+
+    def __init__(self, description, group, shards = 1, typ = INOUTPUT):
+        """
+        Creation of the shards in the least loaded loops of the group.
+        """
+        self.description = description
+        self.group = group
+        self.type = typ
+        self.txt_prefix = self.txt_prefixes[typ]
+        self.xml_tag = connector_type_to_xml_tag_map[typ]
+        self.dispatcher = BasicEventDispatcher()
+        self.shards = []
+        for loop_thread in group.pick(shards):
+            shard = self.shard_type[typ](description, loop = loop_thread.loop)
+            shard.dispatcher = self.dispatcher
+            shard.loop_thread = loop_thread
+            loop_thread.assign(shard)
+            self.shards.append(shard)
+
+    def __set_peerid__(self, value):
+        self.__peerid__ = value
+        for shard in self.shards:
+            shard.peerid = value
+    def __get_peerid__(self):
+        return self.__peerid__
+    peerid = property(__get_peerid__, __set_peerid__)
+    peerId = peerid
+
+    def __get_peers__(self):
+        peers = {}
+        for shard in self.shards:
+            peers.update(shard.peers)
+        return peers
+    peers = property(__get_peers__)
+
+    def __shard_of__(self, peerid):
+        for shard in self.shards:
+            if peerid in shard.peers:
+                return shard
+        return None
+
+    def __socket__(self, port):
+        """
+        Returns a listening socket sharing its port.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(('', port))
+        sock.listen(socket.SOMAXCONN)
+        sock.setblocking(False)
+        return sock
+
+    def privilegedStartService(self):
+        pass
+
+    def startService(self):
+        """
+        This method starts the loops and the shards.
+        """
+        self.group.start()
+        listeners = self.shards[:1]
+        if hasattr(socket, 'SO_REUSEPORT') and len(self.shards) > 1:
+            try:
+                first = self.__socket__(0)
+                sockets = [first] + [self.__socket__(first.getsockname()[1])
+                                     for shard in self.shards[1:]]
+                listeners = self.shards
+            except socket.error, err:
+                if logger.isEnabledFor(logging.WARNING):
+                    logger.warning("Cannot share the port of the shards : %s"
+                                   % str(err))
+                sockets = [None]
+        else:
+            sockets = [None]
+        for shard, sock in zip(listeners, sockets):
+            shard.loop_thread.blockingCall(shard.start, None, 0, sock)
+        self.tcp = self.shards[0].tcp
+        self.running = 1
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Starting %d shards on port : %d"
+                         % (len(listeners), self.tcp))
+
+    def stopService(self):
+        """
+        This method stops the shards, the loops keep running.
+        """
+        for shard in self.shards:
+            shard.loop_thread.blockingCall(shard.stop)
+        self.running = 0
+        self.tcp = None
+
+    def connect(self, proxy, timeout = CONNECTION_TIMEOUT):
+        """
+        This method connects to a remote connector through the shard with the
+        fewest peers. It returns when the connection is made.
+        """
+        if proxy.peerid in self.peers:
+            return
+        shard = min(self.shards, key = lambda s: len(s.peers))
+        shard.loop_thread.blockingCall(shard.connect, proxy, timeout)
+
+    def disconnect(self, peerid):
+        """
+        This method closes the connection with a peer.
+        """
+        shard = self.__shard_of__(peerid)
+        if shard is not None:
+            shard.loop_thread.call(shard.disconnect, peerid)
+
+    def loseConnection(self, peerid = None):
+        """
+        This method closes the connection with a peer or with every peer.
+        """
+        if peerid is None:
+            for shard in self.shards:
+                shard.loop_thread.call(shard.__loseConnection__)
+        else:
+            self.disconnect(peerid)
+
+    def send(self, msg, peerid = None):
+        """
+        This method sends the msg to the given peer, or to every peer, from
+        any thread.
+        """
+        if peerid is None:
+            for shard in self.shards:
+                shard.send(msg)
+        else:
+            shard = self.__shard_of__(peerid)
+            if shard is None:
+                if logger.isEnabledFor(logging.WARNING):
+                    logger.warning("Trying to send msg to an unknown peer "
+                                   "-- %s --" % str(peerid))
+                return
+            shard.send(msg, peerid)
+
+    __call__ = send
+
+    def send_many(self, msgs, peerid = None):
+        """
+        This method sends several messages, same description as send.
+        """
+        for msg in msgs:
+            self.send(msg, peerid)
+
+    def peersCount(self):
+        """
+        This methods returns the number of connected peers.
+        """
+        return len(self.peers)
+
+    def bufferedBytes(self, peerid = None):
+        """
+        Same as Connector.bufferedBytes.
+        """
+        if peerid is None:
+            buffered = {}
+            for shard in self.shards:
+                buffered.update(shard.bufferedBytes())
+            return buffered
+        shard = self.__shard_of__(peerid)
+        return 0 if shard is None else shard.bufferedBytes(peerid)
+
+    def loopMetrics(self):
+        """
+        This method returns the metrics of the loops serving this connector.
+        """
+        return [shard.loop_thread.metrics() for shard in self.shards]
+
+    def TXTRecord(self, record = None):
+        """
+        This method describe the connector as a txt record (python dict) for
+        dnssd.
+        """
+        if record is None:
+            record = {}
+        if self.running == 0:
+            raise RuntimeError("Cannot get txt record of an stopped connector")
+        record[self.name] = \
+                        ''.join([self.txt_prefix, TXT_SEPARATOR, str(self.tcp)])
+        return record
@@ -0,0 +1,145 @@
+#
+"""
+This module runs the BIP protocol on an asyncio event loop (trollius on python
+2). The BIPBaseProtocol is used as is, the asyncio transport and the loop are
+adapted to the small part of the twisted interfaces it relies on.
+"""
+import socket
+import weakref
+import logging
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+logger = logging.getLogger(__name__)
+
+class LoopClock(object):
+    """
+    This object gives the seconds, callLater and callFromThread methods of a
+    twisted reactor on top of an event loop. The loop is not kept alive by its
+    clock.
+    """
+    def __init__(self, loop):
+        self.loop = weakref.proxy(loop)
+
+    def seconds(self):
+        return self.loop.time()
+
+    def callLater(self, delay, fct, *args):
+        return self.loop.call_later(delay, fct, *args)
+
+    def callFromThread(self, fct, *args):
+        self.loop.call_soon_threadsafe(fct, *args)
+
+clocks = weakref.WeakKeyDictionary()
+
+def loop_clock(loop):
+    """
+    This function returns the LoopClock of a loop, they are shared so every
+    user of a loop shares its timer wheel.
+    """
+    clock = clocks.get(loop, None)
+    if clock is None:
+        clock = clocks[loop] = LoopClock(loop)
+    return clock
+
+class Address(object):
+    """
+    A simple address, only tcp addresses have a host and a port.
+    """
+    def __init__(self, name):
+        if isinstance(name, tuple):
+            self.host, self.port = name[:2]
+        else:
+            self.name = name
+
+class AIOTransport(object):
+    """
+    This object is the twisted transport interface used by the BIP protocol
+    over an asyncio transport.
+    """
+    bufferSize = 65536
+    connected = True
+    producer = None
+
+    # twisted buffer attributes read by the PeerWriter
+    dataBuffer = ""
+    offset = 0
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    def __get_temp_data_len__(self):
+        return self.transport.get_write_buffer_size()
+    _tempDataLen = property(__get_temp_data_len__)
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def writeSequence(self, seq):
+        self.transport.writelines(seq)
+
+    def loseConnection(self):
+        self.transport.close()
+
+    def abortConnection(self):
+        self.transport.abort()
+
+    def getPeer(self):
+        return Address(self.transport.get_extra_info('peername'))
+
+    def getHost(self):
+        return Address(self.transport.get_extra_info('sockname'))
+
+    def setTcpNoDelay(self, enabled):
+        sock = self.transport.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, enabled)
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def pauseProducing(self):
+        self.transport.pause_reading()
+
+    def resumeProducing(self):
+        self.transport.resume_reading()
+
+class AIOProtocolAdapter(asyncio.Protocol):
+    """
+    This asyncio protocol drives a BIP protocol built by a BIPFactory. The
+    write flow control of the loop pauses the PeerWriter of the protocol.
+    """
+    def __init__(self, factory, loop):
+        """
+        The BIP protocol is built here, its timers run on the loop.
+        """
+        self.protocol = factory.buildProtocol(None)
+        self.protocol.clock = loop_clock(loop)
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = AIOTransport(transport)
+        self.protocol.makeConnection(self.transport)
+
+    def data_received(self, data):
+        self.protocol.dataReceived(data)
+
+    def connection_lost(self, exc):
+        self.transport.connected = False
+        if self.transport.producer is not None:
+            self.transport.producer.stopProducing()
+        self.protocol.connectionLost(exc)
+
+    def pause_writing(self):
+        if self.transport.producer is not None:
+            self.transport.producer.pauseProducing()
+
+    def resume_writing(self):
+        if self.transport.producer is not None:
+            self.transport.producer.resumeProducing()
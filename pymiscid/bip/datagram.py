@@ -0,0 +1,136 @@
+#
+"""
+This module implements the datagram mode of the BIP protocol. The peers still
+meet through the BIP handshake on a stream connection, then the frames go
+through UDP. Every datagram is a regular BIP frame whose msgid is the sequence
+number of the message and whose body starts with a fragment header, so a
+message larger than the MTU is split in several datagrams. Only the latest
+message matters : a message older than the last one delivered or assembling is
+dropped. The datagrams come from anyone, so only the connected peers are
+heard, a message is at most DATAGRAM_MAX_SIZE bytes and a partial message is
+dropped after DATAGRAM_TIMEOUT seconds.
+"""
+import struct
+import logging
+
+from twisted.internet import protocol, reactor
+
+from protocol import MessageBuilder, LINE_ENDING, BIP_MSGID_TEMPLATE, \
+                     BIP_SIZE_TEMPLATE, PEERID_START, PEERID_END, \
+                     MSGID_START, MSGID_END, SIZE_START, SIZE_END, Peerid
+
+logger = logging.getLogger(__name__)
+
+DATAGRAM_MTU = 1400 # bytes of payload per datagram
+DATAGRAM_MAX_SIZE = 16 * 1024 * 1024 # bytes of a message
+DATAGRAM_TIMEOUT = 1 # seconds to assemble a message
+FRAGMENT = struct.Struct("!II") # offset in the message, message size
+
+class BIPDatagramProtocol(protocol.DatagramProtocol):
+    """
+    This protocol sends and reassembles the datagrams of a connector. The
+    owner (normally the connector) gets the complete messages through its
+    datagramReceived method.
+    """
+    clock = reactor
+
+    def __init__(self, owner, mtu = DATAGRAM_MTU,
+                 max_size = DATAGRAM_MAX_SIZE, timeout = DATAGRAM_TIMEOUT):
+        """
+        Owner and reassembly states initialisation.
+        """
+        self.owner = owner
+        self.mtu = mtu
+        self.max_size = max_size
+        self.timeout = timeout
+        self.last = {}
+        self.assembling = {}
+
+    def write(self, prefix, msgid, payload, address):
+        """
+        This method sends the payload to the address as msgid, prefix is the
+        greeting and peerid part of the bip header.
+        """
+        size = len(payload)
+        header = prefix + BIP_MSGID_TEMPLATE % msgid
+        for offset in xrange(0, max(size, 1), self.mtu):
+            chunk = payload[offset:offset + self.mtu]
+            self.transport.write(''.join([header,
+                            BIP_SIZE_TEMPLATE % (len(chunk) + FRAGMENT.size),
+                            FRAGMENT.pack(offset, size), chunk,
+                            LINE_ENDING]), address)
+
+    def datagramReceived(self, data, addr):
+        """
+        A datagram is copied at its place in the message of its sequence
+        number, the late ones are dropped.
+        """
+        try:
+            peerid = Peerid(data[PEERID_START:PEERID_END])
+            msgid = int(data[MSGID_START:MSGID_END], 16)
+            size = int(data[SIZE_START:SIZE_END], 16)
+            offset, total = FRAGMENT.unpack_from(data, SIZE_END +
+                                                 len(LINE_ENDING))
+        except (ValueError, struct.error):
+            if logger.isEnabledFor(logging.WARNING):
+                logger.warning("Invalid datagram from %s" % str(addr))
+            return
+        start = SIZE_END + len(LINE_ENDING) + FRAGMENT.size
+        chunk = size - FRAGMENT.size
+        if (len(data) < start + chunk) or (offset + chunk > total) or \
+           (total > self.max_size):
+            return
+        peers = getattr(self.owner, 'peers', None)
+        if (peers is not None) and (peerid not in peers):
+            return
+        if msgid <= self.last.get(peerid, -1):
+            return
+        msg = self.assembling.get(peerid, None)
+        if (msg is not None) and (msg.msgid != msgid):
+            if msgid < msg.msgid:
+                return
+            # a newer message supersedes the one we were assembling
+            self.last[peerid] = msg.msgid
+            msg.release()
+            msg = None
+        if msg is None:
+            self.expire()
+            msg = MessageBuilder(peerid, msgid, total + len(LINE_ENDING),
+                                 addr[0], getattr(self.owner, 'buffer_pool',
+                                                  None))
+            msg.fragments = set()
+            msg.received = 0
+            msg.started = self.clock.seconds()
+            self.assembling[peerid] = msg
+        if offset in msg.fragments:
+            return
+        msg.view[offset:offset + chunk] = memoryview(data)[start:start + chunk]
+        msg.fragments.add(offset)
+        msg.received += chunk
+        if msg.received == total:
+            del self.assembling[peerid]
+            self.last[peerid] = msgid
+            msg.rlen = 0
+            del msg.fragments
+            self.owner.datagramReceived(msg)
+
+    def expire(self):
+        """
+        This method drops the messages assembling for more than timeout
+        seconds, their missing datagrams are lost.
+        """
+        limit = self.clock.seconds() - self.timeout
+        for peerid, msg in self.assembling.items():
+            if msg.started < limit:
+                del self.assembling[peerid]
+                self.last[peerid] = msg.msgid
+                msg.release()
+
+    def forget(self, peerid):
+        """
+        This method drops the state kept for a peer.
+        """
+        self.last.pop(peerid, None)
+        msg = self.assembling.pop(peerid, None)
+        if msg is not None:
+            msg.release()
@@ -52,3 +52,27 @@ class BIPFactory(Factory):
         return proto
 
 
+class BIPLinkFactory(BIPFactory):
+    """
+    This factory builds the outgoing connections of a reconnecting link of a
+    connector (the service). The link is told when a connection fails or is
+    lost.
+    """
+    def __init__(self, service, link):
+        self.service = service
+        self.link = link
+
+    def clientConnectionLost(self, connector, reason):
+        """
+        Callback from the protocol, the link schedules its next attempt.
+        """
+        self.link.lost()
+
+    def clientConnectionFailed(self, connector, reason):
+        """
+        Callback from the protocol, the link schedules its next attempt.
+        """
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Connection Failed")
+        self.link.lost()
+
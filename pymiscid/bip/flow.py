@@ -0,0 +1,234 @@
+#
+"""
+This module implements the per peer flow control of the BIP protocol. Every
+protocol writes its frames through a PeerWriter which is registered as a
+streaming producer on the transport. When the transport buffer is full, the
+frames are kept in the writer queue and the slow peer policy applies once the
+bytes buffered for the peer reach the high water mark.
+"""
+from __future__ import with_statement
+import collections
+import threading
+import logging
+
+from zope.interface import implements
+from twisted.internet import interfaces, reactor
+from twisted.python import failure
+
+logger = logging.getLogger(__name__)
+
+BLOCK, DROP_OLDEST, DROP_NEWEST, DISCONNECT = range(4)
+
+class SlowPeerError(Exception):
+    """
+    This exception is given to the completion deferred of the messages dropped
+    or lost because of a slow peer.
+    """
+    pass
+
+class SendCompletion(object):
+    """
+    This object is the completion of a message given to
+    Connector.send_deferred, it can be used from any thread. It is completed
+    in the main thread when the msg reaches the transport of every peer, or
+    fails with a SlowPeerError. The callbacks always run in the main thread,
+    other threads can wait for the completion.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.callbacks = []
+        self.result = None
+        self.failure = None
+
+    def complete(self, result):
+        """
+        This method is called once in the main thread with the result or the
+        failure of the send.
+        """
+        with self.lock:
+            if isinstance(result, failure.Failure):
+                self.failure = result
+            else:
+                self.result = result
+            callbacks, self.callbacks = self.callbacks, None
+            self.event.set()
+        for callback, errback in callbacks:
+            self.__run__(callback, errback)
+
+    def addCallbacks(self, callback, errback = None):
+        """
+        This method adds the callback, which gets the result, and the errback,
+        which gets the failure. They are called in the main thread, even if
+        the completion is already done.
+        """
+        with self.lock:
+            if self.callbacks is not None:
+                self.callbacks.append((callback, errback))
+                return self
+        reactor.callFromThread(self.__run__, callback, errback)
+        return self
+
+    def __run__(self, callback, errback):
+        try:
+            if self.failure is None:
+                callback(self.result)
+            elif errback is not None:
+                errback(self.failure)
+        except Exception, err:
+            logger.exception(str(err))
+
+    def done(self):
+        return self.event.isSet()
+
+    def wait(self, timeout = None):
+        """
+        This method blocks until the completion is done and returns the
+        result, or raises the exception of the failure. It raises a
+        RuntimeError after timeout seconds. Dont call it from the main thread.
+        """
+        if not self.event.wait(timeout):
+            raise RuntimeError("Send completion timeout reached")
+        if self.failure is not None:
+            self.failure.raiseException()
+        return self.result
+
+
+class PeerWriter(object):
+    """
+    This object queues the frames of one peer while its transport is paused.
+    The owner (normally the connector) gives the high_water mark in bytes
+    (None means unbounded), the slow_peer_policy and the flow_condition
+    notified each time the queue drains.
+    """
+    implements(interfaces.IPushProducer)
+
+    paused = False
+    stopped = False
+    frames = 0 # frames written to the transport
+
+    def __init__(self, transport, owner = None):
+        """
+        Registration as a streaming producer of the transport.
+        """
+        self.transport = transport
+        self.owner = owner
+        self.queue = collections.deque()
+        self.queued = 0
+        self.written = 0
+        self.transport.registerProducer(self, True)
+
+    def __get_high_water__(self):
+        return getattr(self.owner, 'high_water', None)
+    high_water = property(__get_high_water__)
+
+    def __get_policy__(self):
+        return getattr(self.owner, 'slow_peer_policy', BLOCK)
+    policy = property(__get_policy__)
+
+    def buffered(self):
+        """
+        This method returns the number of bytes waiting for this peer, in the
+        writer queue and in the transport buffer. The bytes written to the
+        transport since it last drained count while it pauses us, below its
+        own buffer size the transport is keeping up.
+        """
+        if self.paused:
+            return self.queued + self.written
+        return self.queued
+
+    def write(self, frame, size, deferred = None):
+        """
+        This method writes the frame (a list of buffers) or queues it when the
+        transport is paused. size is the payload size used for the accounting.
+        The deferred, if any, fires when the frame reaches the transport.
+        """
+        if self.stopped:
+            if deferred is not None:
+                deferred.errback(SlowPeerError("Connection lost"))
+            return
+        if not self.paused and len(self.queue) == 0:
+            self.written += size
+            self.frames += 1
+            self.transport.writeSequence(frame)
+            if deferred is not None:
+                deferred.callback(size)
+            return
+
+        high_water = self.high_water
+        if (high_water is not None) and (self.buffered() + size > high_water):
+            policy = self.policy
+            if policy == DROP_NEWEST:
+                if deferred is not None:
+                    deferred.errback(SlowPeerError("Message dropped"))
+                return
+            elif policy == DROP_OLDEST:
+                while len(self.queue) != 0 and \
+                      (self.buffered() + size > high_water):
+                    self.__drop__()
+            elif policy == DISCONNECT:
+                if logger.isEnabledFor(logging.WARNING):
+                    logger.warning("Slow peer, closing the connection")
+                self.stopProducing()
+                if deferred is not None:
+                    deferred.errback(SlowPeerError("Slow peer disconnected"))
+                abort = getattr(self.transport, 'abortConnection',
+                                self.transport.loseConnection)
+                abort()
+                return
+        self.queue.append((frame, size, deferred))
+        self.queued += size
+
+    def __drop__(self):
+        """
+        Drops the oldest frame of the queue.
+        """
+        frame, size, deferred = self.queue.popleft()
+        self.queued -= size
+        if deferred is not None:
+            deferred.errback(SlowPeerError("Message dropped"))
+
+    def __notify__(self):
+        """
+        Wakes up the producers blocked on the owner.
+        """
+        condition = getattr(self.owner, 'flow_condition', None)
+        if condition is not None:
+            with condition:
+                condition.notifyAll()
+
+    def pauseProducing(self):
+        """
+        IPushProducer : the transport buffer is full.
+        """
+        self.paused = True
+
+    def resumeProducing(self):
+        """
+        IPushProducer : the transport buffer is drained, we flush the queue
+        until the transport pauses us again.
+        """
+        self.paused = False
+        self.written = 0
+        queue = self.queue
+        while len(queue) != 0 and not self.paused:
+            frame, size, deferred = queue.popleft()
+            self.queued -= size
+            self.written += size
+            self.frames += 1
+            self.transport.writeSequence(frame)
+            if deferred is not None:
+                deferred.callback(size)
+        self.__notify__()
+
+    def stopProducing(self):
+        """
+        IPushProducer : the connection is lost, pending frames are dropped.
+        """
+        self.stopped = True
+        while len(self.queue) != 0:
+            frame, size, deferred = self.queue.popleft()
+            if deferred is not None:
+                deferred.errback(SlowPeerError("Connection lost"))
+        self.queued = 0
+        self.__notify__()
@@ -0,0 +1,91 @@
+#
+"""
+This module implements the buffer pool used to assemble the received messages.
+The buffers are sorted in power of two size classes, a leased buffer is at
+least as large as requested and goes back to the free list of its class when
+it is released.
+"""
+from __future__ import with_statement
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+POOL_MIN_CLASS = 10 # 1 KiB
+POOL_MAX_CLASS = 24 # 16 MiB
+POOL_MAX_FREE = 32 # free buffers kept per class
+
+class BufferPool(object):
+    """
+    This object recycles the body buffers of the messages. lease is called in
+    the main thread and release from the dispatch workers, the free lists are
+    protected by a lock. Buffers larger than the biggest class are not pooled.
+    """
+    def __init__(self, min_class = POOL_MIN_CLASS, max_class = POOL_MAX_CLASS,
+                 max_free = POOL_MAX_FREE):
+        """
+        Free lists and statistics initialisation.
+        """
+        self.min_class = min_class
+        self.max_class = max_class
+        self.max_free = max_free
+        self.lock = threading.Lock()
+        self.free = dict([(c, []) for c in xrange(min_class, max_class + 1)])
+        self.leased = dict([(c, 0) for c in xrange(min_class, max_class + 1)])
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+
+    def size_class(self, size):
+        """
+        This method returns the class of a size, None if it is too large.
+        """
+        sclass = max(self.min_class, (max(size, 1) - 1).bit_length())
+        return None if sclass > self.max_class else sclass
+
+    def lease(self, size):
+        """
+        This method returns a bytearray of at least size bytes.
+        """
+        sclass = self.size_class(size)
+        if sclass is None:
+            return bytearray(size)
+        with self.lock:
+            self.leased[sclass] += 1
+            free = self.free[sclass]
+            if len(free) != 0:
+                self.hits += 1
+                return free.pop()
+            self.misses += 1
+        return bytearray(1 << sclass)
+
+    def release(self, buf):
+        """
+        This method gives back a leased buffer. The caller must not use it
+        anymore.
+        """
+        sclass = self.size_class(len(buf))
+        if (sclass is None) or (len(buf) != 1 << sclass):
+            return
+        with self.lock:
+            self.leased[sclass] -= 1
+            free = self.free[sclass]
+            if len(free) < self.max_free:
+                free.append(buf)
+            else:
+                self.discarded += 1
+
+    def stats(self):
+        """
+        This method returns the occupancy of the pool : for every class size
+        in bytes the number of leased and free buffers, and the hits, misses
+        and discarded counters.
+        """
+        with self.lock:
+            classes = dict([(1 << c, {'leased' : self.leased[c],
+                                      'free' : len(self.free[c])})
+                            for c in self.free])
+            return {'classes' : classes,
+                    'hits' : self.hits,
+                    'misses' : self.misses,
+                    'discarded' : self.discarded}
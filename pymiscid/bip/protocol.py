@@ -2,7 +2,7 @@
 """
 This is the implementation of the BIP protocol based on twisted.
 """
-from twisted.internet import reactor, protocol
+from twisted.internet import reactor, protocol, defer
 
 try:
     from ..codebench import events
@@ -10,14 +10,39 @@ except Exception, err:
     from codebench import events
 
 import random
+import zlib
 import logging
-import ctypes
+
+from flow import PeerWriter
+from wheel import timer_wheel
+import shm
 
 logger = logging.getLogger(__name__)
 
 LINE_ENDING = "\r\n"
-BIP_HEADER_TEMPLATE = "%s %s %.8x %.8x" + LINE_ENDING
+BIP_PREFIX_TEMPLATE = "%s %s "
+BIP_MSGID_TEMPLATE = "%.8x "
+BIP_SIZE_TEMPLATE = "%.8x" + LINE_ENDING
+BIP_HEADER_TEMPLATE = BIP_PREFIX_TEMPLATE + BIP_MSGID_TEMPLATE + \
+                      BIP_SIZE_TEMPLATE
 BIP_GREETING_TIMEOUT = 1  # in seconds
+PEERID_CACHE_SIZE = 8
+HEARTBEAT_INTERVAL = 0.2 # in seconds
+HEARTBEAT_MISSES = 3
+
+# The handshake body lists the capabilities offered by a peer, the ones offered
+# by both sides are active. Once a capability is active, every body starts
+# with a one byte tag giving its encoding.
+CAPABILITIES_PREFIX = "caps"
+SHM_CAPABILITY = "shm"
+UDP_CAPABILITY = "udp"
+ZLIB_CAPABILITY = "zlib"
+HEARTBEAT_CAPABILITY = "hb"
+CONTROL_CAPABILITY = "bctl"
+FRAME_PLAIN = "\x00"
+FRAME_SHM = "\x01"
+FRAME_ZLIB = "\x02"
+FRAME_HEARTBEAT = "\x03"
 
 class Peerid(long):
     """
@@ -63,12 +88,100 @@ def peerid_generator_factory():
 
 UNBOUNDED_PEERID = Peerid(0xFFFFFFFF)
 
+def is_contiguous(view):
+    """
+    This function returns True if the memory of the view is C contiguous.
+    """
+    if not view.strides:
+        return True
+    expected = view.itemsize
+    for dim, stride in reversed(zip(view.shape, view.strides)):
+        if (dim > 1) and (stride != expected):
+            return False
+        expected *= dim
+    return True
+
+def to_payload(msg):
+    """
+    This function returns the msg as a payload accepted by the transports.
+    Strings are returned as is, any other object implementing the buffer
+    protocol (bytearray, memoryview, numpy array, array ...) is exported
+    through its raw memory and everything else falls back to str. A buffer
+    which cannot be exported contiguously (a sliced numpy array ...) raises a
+    TypeError.
+    """
+    if isinstance(msg, str):
+        return msg
+    try:
+        view = memoryview(msg)
+    except TypeError:
+        if isinstance(msg, unicode):
+            return str(msg)
+        try:
+            # old style buffer interface
+            return str(buffer(msg))
+        except TypeError:
+            return str(msg)
+    except (ValueError, BufferError), err:
+        raise TypeError("Cannot export the buffer of %s : %s"
+                        % (type(msg).__name__, str(err)))
+    if not is_contiguous(view):
+        raise TypeError("Cannot send the non contiguous buffer of %s"
+                        % type(msg).__name__)
+    return view.tobytes()
+
+def encode_capabilities(capabilities):
+    """
+    This function builds the handshake body offering the given capabilities
+    (a dict name -> value). Without capability, the body stays empty.
+    """
+    if len(capabilities) == 0:
+        return ""
+    return " ".join([CAPABILITIES_PREFIX] +
+                    ["%s=%s" % item for item in capabilities.iteritems()])
+
+def decode_capabilities(body):
+    """
+    This function returns the capabilities offered in a handshake body.
+    """
+    tokens = body.split()
+    if len(tokens) == 0 or tokens[0] != CAPABILITIES_PREFIX:
+        return {}
+    return dict([token.split("=", 1) for token in tokens[1:] if "=" in token])
+
+def broadcast(protocols, msg, completion = False, compressed = None):
+    """
+    This function sends the same msg to several protocols. The payload and the
+    size field are serialized once and shared by every transport, each peer
+    only builds the msgid part of its own header. If completion is True, it
+    returns the list of the per peer completion deferreds. compressed is the
+    zlib version of the payload for the peers which negotiated it.
+    """
+    payload = to_payload(msg)
+    size = BIP_SIZE_TEMPLATE % len(payload)
+    deferreds = []
+    for proto in protocols:
+        deferred = defer.Deferred() if completion else None
+        proto.write_frame(payload, size, deferred, compressed)
+        deferreds.append(deferred)
+    return deferreds
+
 class MessageBuilder(object):
     """
     This class contains all the necessary information about the message from
-    another peer. It also helps the build process from splitted msg.
+    another peer. It also helps the build process from splitted msg. The body
+    is assembled only once in a bytearray and handed to the observers through
+    the view attribute (a memoryview on the body). The data attribute is kept
+    for compatibility, the string is built on first access and then cached.
+    With a pool, the buffer is leased from it and given back by release.
     """
-    def __init__(self, peerid, msgid, rlen, host):
+    __data__ = None
+    streamed = False
+    tag = FRAME_PLAIN
+    pool = None
+    retained = False
+
+    def __init__(self, peerid, msgid, rlen, host, pool = None):
         """
         Initialisation to keep header information for further needs
         """
@@ -76,39 +189,121 @@ class MessageBuilder(object):
         self.msgid = msgid
         self.rlen = rlen
         self.host = host
-        self.buffer = (ctypes.c_char * (rlen - 2))()
+        self.size = rlen - len(LINE_ENDING)
+        if pool is None:
+            self.buffer = bytearray(self.size)
+            self.view = memoryview(self.buffer)
+        else:
+            self.pool = pool
+            self.buffer = pool.lease(self.size)
+            self.view = memoryview(self.buffer)[:self.size]
 
     def __get_data__(self):
-        return self.buffer.raw
+        if self.__data__ is None:
+            self.__data__ = self.view.tobytes()
+        return self.__data__
     data = property(__get_data__)
 
-    def build(self, data):
+    def retain(self):
         """
-        This method keep a pointer to the data and join all buffers
-        when we received all the required data.
+        An observer calls this method to keep the message after its dispatch,
+        it then calls release when it is done with it.
         """
-        if self.rlen == 0:
-            raise Exception("Message Finished")
+        self.retained = True
 
-        data, rest = data[:self.rlen], data[self.rlen:]
-        datalen = len(data)
+    def release(self):
+        """
+        This method gives the buffer back to the pool, if any. The view is not
+        usable anymore, only the data string if it was already built.
+        """
+        self.retained = False
+        if (self.pool is not None) and (self.buffer is not None):
+            self.view = None
+            self.pool.release(self.buffer)
+            self.buffer = None
 
-	#print "rlen=%d, datalen=%d" %(self.rlen,datalen)
+    def build(self, data, offset = 0):
+        """
+        This method copy the received chunk directly at its place inside the
+        message body, starting at offset in data. The trailing line ending is
+        not kept. It returns the offset of the first byte not consumed.
+        """
+        if self.rlen == 0:
+            raise Exception("Message Finished")
 
-        if datalen == 2:
-            pass
-	elif self.rlen == datalen:
-            self.buffer[-(self.rlen - 2):] = data[:-2]
-        elif (self.rlen - 2) <= datalen:
-            self.buffer[-(self.rlen - 2):] = data
-        else:
-            self.buffer[-(self.rlen - 2):-(self.rlen - 2) + datalen] = data
+        datalen = min(self.rlen, len(data) - offset)
+        pos = self.size + len(LINE_ENDING) - self.rlen
+        if pos < self.size:
+            count = min(self.size - pos, datalen)
+            self.view[pos:pos + count] = memoryview(data)[offset:offset + count]
         self.rlen -= datalen
-        return rest
+        return offset + datalen
+
+    def decompress(self, max_size):
+        """
+        This method replaces a zlib compressed body by its content, which must
+        not be larger than max_size bytes. It raises zlib.error otherwise or if
+        the body is not a complete zlib stream.
+        """
+        decompressor = zlib.decompressobj()
+        # the extra byte is left unused only if the stream is complete
+        data = decompressor.decompress(self.data + '\0', max_size + 1)
+        if len(data) > max_size:
+            raise zlib.error("Message larger than %d bytes" % max_size)
+        if decompressor.unused_data != '\0':
+            raise zlib.error("Incomplete compressed message")
+        self.__data__ = data
+        self.release()
+        self.buffer = None
+        self.view = memoryview(self.__data__)
+        self.size = len(self.__data__)
+        self.tag = FRAME_PLAIN
+
+    def __len__(self):
+        return self.size
 
     def __str__(self):
         return self.data
 
+class MessageStream(object):
+    """
+    This class contains the header information of a message delivered
+    incrementally. Instead of being assembled, every body chunk is handed to
+    the chunk callback as a memoryview on the received data as soon as it is
+    received.
+    """
+    streamed = True
+
+    def __init__(self, peerid, msgid, rlen, host, chunk):
+        """
+        Initialisation to keep header information for further needs
+        """
+        self.peerid = peerid
+        self.msgid = msgid
+        self.rlen = rlen
+        self.host = host
+        self.size = rlen - len(LINE_ENDING)
+        self.chunk = chunk
+
+    def build(self, data, offset = 0):
+        """
+        Same as MessageBuilder.build but the body chunk is forwarded to the
+        chunk callback with this object.
+        """
+        if self.rlen == 0:
+            raise Exception("Message Finished")
+
+        datalen = min(self.rlen, len(data) - offset)
+        pos = self.size + len(LINE_ENDING) - self.rlen
+        if pos < self.size:
+            count = min(self.size - pos, datalen)
+            self.chunk(self, memoryview(data)[offset:offset + count])
+        self.rlen -= datalen
+        return offset + datalen
+
+    def __len__(self):
+        return self.size
+
 class FastLineReceiver(protocol.Protocol):
     """
     This is a reimplementation of the twisted LineReceiver. This
@@ -116,12 +311,13 @@ class FastLineReceiver(protocol.Protocol):
     beforehand so we can skip the parsing phase and split the buffer 
     directly. This object do not wait for the next message to restart 
     the state machine so it should have lower latency for small tcp
-    packet. For very small packet with a the Nagle algorithm since 
+    packet. Each read is walked with an offset cursor, headers and bodies
+    are decoded in place and only an unfinished header is kept between two
+    reads.
     """
     line_length = 0
     line_mode = True
-    __line_buffer = None
-    __line_rlen = 0
+    __tail = ""
 
     def setLineMode(self):
         """
@@ -137,32 +333,30 @@ class FastLineReceiver(protocol.Protocol):
         """
         self.line_mode = False
 
-    def _dataReceived(self, data):
-        rest = ""
-        if self.line_mode:
-            if self.__line_rlen == 0:
-                self.__line_buffer = []
-                self.__line_rlen = self.line_length
-            hdr, rest = data[:self.__line_rlen], data[self.__line_rlen:]
-            self.__line_rlen -= len(hdr)
-            self.__line_buffer.append(hdr)
-            if self.__line_rlen == 0:
-                self.lineReceived(''.join(self.__line_buffer))
-                self.setRawMode()
-        else:
-            rest = self.rawDataReceived(data)
-        return rest
-
-
-
     def dataReceived(self, data):
         """
-        This function append data to a buffer if until we have at least
-        line_size and then call lineReceived. Then , it switches to 
-        RawDataMode.
+        This function walks the received buffer. In line mode, it calls
+        lineReceived as soon as line_length bytes are available and then
+        switches to raw mode, unless lineReceived returns True to stop the
+        walk (the connection is closed). In raw mode, rawDataReceived
+        consumes what it needs and returns the new offset.
         """
-        while len(data) != 0:
-                data = self._dataReceived(data)
+        if self.__tail:
+            data = self.__tail + data
+            self.__tail = ""
+        offset, end = 0, len(data)
+        while offset < end:
+            if self.line_mode:
+                stop = offset + self.line_length
+                if stop > end:
+                    self.__tail = data[offset:]
+                    break
+                if self.lineReceived(data[offset:stop]):
+                    break
+                self.setRawMode()
+                offset = stop
+            else:
+                offset = self.rawDataReceived(data, offset)
 
     def lineReceived(self, data):
         """
@@ -170,11 +364,11 @@ class FastLineReceiver(protocol.Protocol):
         """
         pass
 
-    def rawDataReceived(self, data):
+    def rawDataReceived(self, data, offset):
         """
-        Empty callback
+        Empty callback, must return the offset of the first byte not consumed
         """
-        pass
+        return len(data)
 
 class BIPBaseProtocol(FastLineReceiver, events.EventDispatcherBase):
     """
@@ -182,7 +376,32 @@ class BIPBaseProtocol(FastLineReceiver, events.EventDispatcherBase):
     """
     __msg__ = None
     __msgid__ = None
+    __header_prefix__ = None
     rpeerid = None
+    writer = None
+    stream_threshold = None
+
+    capabilities = {}
+    rcapabilities = {}
+    negotiated = frozenset()
+    extended = False
+    shm_writer = None
+    shm_reader = None
+    shm_threshold = shm.SHM_THRESHOLD
+    datagram = None
+    udp_address = None
+    pool = None
+    clock = reactor
+
+    handshake_call = None
+
+    # heartbeat state, see start_heartbeat
+    heartbeat_call = None
+    heartbeat_timeout = None
+    received = False
+    written = False
+    silence = 0.
+    reading_paused = False
 
     __name__ = 'BIP'
     __version__ = '1.0'
@@ -192,30 +411,78 @@ class BIPBaseProtocol(FastLineReceiver, events.EventDispatcherBase):
 
     __raw_mode__ = False
 
-    events = ['connected', 'disconnected', 'received']
+    events = ['connected', 'disconnected', 'receivedBatch',
+              'streamStarted', 'streamChunk', 'streamEnded']
+
+    def __init__(self, **kw):
+        """
+        Events, peerid intern cache and batch initialisation.
+        """
+        events.EventDispatcherBase.__init__(self, **kw)
+        self.peerids = {}
+        self.batch = []
+
+    def dataReceived(self, data):
+        """
+        Every message completed by this read is delivered at once through the
+        receivedBatch event.
+        """
+        self.received = True
+        FastLineReceiver.dataReceived(self, data)
+        if len(self.batch) != 0:
+            batch, self.batch = self.batch, []
+            self.receivedBatchEvent(batch)
 
-    def rawDataReceived(self, data):
+    def decode_header(self, line):
+        """
+        This method decodes a bip header from its fixed layout. The remote
+        peerid is interned since a connection almost always carries the same
+        one. Returns the tuple (proto, peerid, msgid, size).
+        """
+        hexid = line[PEERID_START:PEERID_END]
+        peerid = self.peerids.get(hexid, None)
+        if peerid is None:
+            if len(self.peerids) >= PEERID_CACHE_SIZE:
+                self.peerids.clear()
+            peerid = self.peerids[hexid] = Peerid(hexid)
+        return (line[:GREETING_END], peerid,
+                int(line[MSGID_START:MSGID_END], 16),
+                int(line[SIZE_START:SIZE_END], 16))
+
+    def rawDataReceived(self, data, offset):
         """
         We are in the process of receiving a message, we accumulate the data
         structures through the MessageBuilder.
         """
         if logger.isEnabledFor(logging.DEBUG): 
             logger.debug("Raw Data Received")
-        rest = self.__msg__.build(data)
+        offset = self.__msg__.build(data, offset)
         if self.__msg__.rlen == 0:
             if self.__msg__.msgid == 0:
                 self.rpeerid = self.__msg__.peerid
+                if self.handshake_call is not None:
+                    self.handshake_call.cancel()
+                    self.handshake_call = None
                 if logger.isEnabledFor(logging.DEBUG):
                     logger.info("HandShake Successful with %s" % (self.rpeerid))
+                self.negotiate(decode_capabilities(self.__msg__.data))
+                self.__msg__.release()
                 self.connectedEvent(self)
+            elif self.__msg__.streamed:
+                self.streamEndedEvent(self.__msg__)
+            elif self.__msg__.tag == FRAME_HEARTBEAT:
+                self.__msg__.release()
             else:
                 # not sure about this optimization
-                optimized_size = max(len(self.__msg__.data) / 10 , 65535)
+                optimized_size = max(self.__msg__.size / 10 , 65535)
                 if (self.transport.bufferSize > (optimized_size * 2)) or (self.transport.bufferSize < (optimized_size / 2)):
                     self.transport.bufferSize = optimized_size
-                self.receivedEvent(self.__msg__)
+                if self.__msg__.tag == FRAME_SHM:
+                    self.__msg__ = self.shm_message(self.__msg__)
+                if self.__msg__ is not None:
+                    self.batch.append(self.__msg__)
             self.setLineMode()
-        return rest
+        return offset
 
     def lineReceived(self, line):
         """
@@ -223,48 +490,295 @@ class BIPBaseProtocol(FastLineReceiver, events.EventDispatcherBase):
         """
         if logger.isEnabledFor(logging.DEBUG): 
             logger.debug("Line Data Receive")
-        proto, peerid, msgid, size = line.split()
-        peerid = Peerid(peerid)
-        size = int(size, 16)
-        msgid = int(msgid, 16)
+        proto, peerid, msgid, size = self.decode_header(line)
         if (msgid == 0) and (proto != self.__greeting__):
             self.transport.loseConnection()
-            return
-
-        self.__msg__ = MessageBuilder(peerid, msgid, size + len(LINE_ENDING),
-                                      self.host)
+            return True
+        tag = FRAME_PLAIN
+        if self.extended:
+            tag = line[-1]
+            size -= 1
+
+        if (self.stream_threshold is not None) and (msgid != 0) and \
+           (size >= self.stream_threshold) and (tag == FRAME_PLAIN):
+            self.__msg__ = MessageStream(peerid, msgid, size + len(LINE_ENDING),
+                                         self.host, self.streamChunkEvent)
+            self.streamStartedEvent(self.__msg__)
+        else:
+            self.__msg__ = MessageBuilder(peerid, msgid,
+                                          size + len(LINE_ENDING), self.host,
+                                          self.pool)
+            if self.extended:
+                self.__msg__.tag = tag
 
-    def send(self, msg):
+    def shm_message(self, msg):
+        """
+        This method returns the message given by a shared memory notification.
+        The payload is copied once from the ring in the body of a new builder.
+        A notification without negotiated ring, or outside of it, closes the
+        connection and gives None.
+        """
+        notification = msg.view.tobytes()
+        msg.release()
+        valid = (self.shm_reader is not None) and \
+                (len(notification) == shm.NOTIFICATION.size)
+        if valid:
+            head, length = shm.NOTIFICATION.unpack(notification)
+            valid = self.shm_reader.holds(head, length)
+        if not valid:
+            if logger.isEnabledFor(logging.WARNING):
+                logger.warning("Invalid shared memory notification from %s"
+                               % str(msg.peerid))
+            self.transport.loseConnection()
+            return None
+        result = MessageBuilder(msg.peerid, msg.msgid,
+                                length + len(LINE_ENDING), msg.host, self.pool)
+        self.shm_reader.read(head, length, result.view)
+        result.rlen = 0
+        return result
+
+    def send(self, msg, deferred = None, compressed = None):
         """
         Encapsulate the msg with the bip header and send it through the 
-        transport
+        transport. The header, the payload and the trailer are handed to the
+        transport as separate buffers so the payload is never joined. The
+        deferred, if any, fires when the frame reaches the transport.
+        """
+        msg = to_payload(msg)
+        self.write_frame(msg, BIP_SIZE_TEMPLATE % len(msg), deferred,
+                         compressed)
+
+    def write_frame(self, payload, size, deferred = None, compressed = None):
+        """
+        This method writes a frame whose payload is already serialized. size
+        is the formatted size field of the header, so it can be shared by
+        every peer of a broadcast. Only the msgid is formatted here. When a
+        capability is active, the body starts with its tag and large payloads
+        go through the shared memory ring if there is one. Otherwise, the
+        compressed payload is used if the peer negotiated zlib. The
+        compression is done by the caller, never in the main thread. The
+        payloads too large for a datagram go through the stream connection.
         """
-        headers = BIP_HEADER_TEMPLATE % \
-                        (self.__greeting__, self.factory.service.peerid,
-                         self.__msgid__,  len(msg))
-        self.transport.write(''.join([headers, msg, LINE_ENDING]))
+        if self.__header_prefix__ is None:
+            self.__header_prefix__ = BIP_PREFIX_TEMPLATE % \
+                        (self.__greeting__, self.factory.service.peerid)
+        if (self.datagram is not None) and \
+           (len(payload) <= self.datagram.max_size):
+            self.datagram.write(self.__header_prefix__, self.__msgid__,
+                                payload, self.udp_address)
+            self.__msgid__ += 1
+            if deferred is not None:
+                deferred.callback(len(payload))
+            return
+        if self.extended:
+            tag = FRAME_PLAIN
+            if (self.shm_writer is not None) and \
+               (len(payload) >= self.shm_threshold):
+                notification = self.shm_writer.write(payload)
+                if notification is not None:
+                    tag, payload = FRAME_SHM, notification
+            if (tag == FRAME_PLAIN) and (compressed is not None) and \
+               (ZLIB_CAPABILITY in self.negotiated):
+                tag, payload = FRAME_ZLIB, compressed
+            frame = [self.__header_prefix__ +
+                     BIP_MSGID_TEMPLATE % self.__msgid__ +
+                     BIP_SIZE_TEMPLATE % (len(payload) + 1),
+                     tag, payload, LINE_ENDING]
+        else:
+            frame = [self.__header_prefix__ + BIP_MSGID_TEMPLATE %
+                     self.__msgid__ + size, payload, LINE_ENDING]
         self.__msgid__ += 1
+        self.written = True
+        if self.writer is None:
+            self.transport.writeSequence(frame)
+            if deferred is not None:
+                deferred.callback(len(payload))
+        else:
+            self.writer.write(frame, len(payload), deferred)
+
+    def buffered(self):
+        """
+        This method returns the number of bytes waiting to be sent to the peer.
+        """
+        return 0 if self.writer is None else self.writer.buffered()
 
     def connectionMade(self):
         """
         Setting the tcpNoDelay since we want to limit the latency and 
         setting the callback for the handshake timeout
         """
-        self.transport.setTcpNoDelay(True)
-        self.host = self.transport.getPeer().host
+        peer = self.transport.getPeer()
+        if hasattr(peer, 'host'):
+            self.transport.setTcpNoDelay(True)
+            self.host = peer.host
+        else:
+            # unix socket
+            self.host = "localhost"
         if logger.isEnabledFor(logging.INFO):
             logger.info("Connection made : %s, starting handshake procedure" %
                                             self.host)
         self.__msgid__ = 0 
-        self.send("")
+        self.writer = PeerWriter(self.transport, self.factory.service)
+        self.pool = getattr(self.factory.service, 'buffer_pool', None)
+        self.capabilities = self.offer_capabilities()
+        self.send(encode_capabilities(self.capabilities))
+
+        self.handshake_call = timer_wheel(self.clock).callLater(
+                                    self.factory.timeout, self.handshake_timeout)
+
+    def is_local(self):
+        """
+        This method returns True if the peer is on the same host, which is
+        always the case through an unix socket.
+        """
+        peer = getattr(self.transport.getPeer(), 'host', None)
+        return (peer is None) or \
+               (peer == getattr(self.transport.getHost(), 'host', None)) or \
+               peer.startswith("127.")
+
+    def offer_capabilities(self):
+        """
+        This method returns the capabilities offered in our handshake, from the
+        attributes of the owner (normally the connector). A peer on the same
+        host is offered the shared memory ring we write to, a datagram owner
+        offers its udp port, a compressing one zlib and a heartbeating one its
+        heartbeat interval in milliseconds. A control connector may offer the
+        binary control encoding.
+        """
+        owner = self.factory.service
+        capabilities = {}
+        if getattr(owner, 'binary_control', False):
+            capabilities[CONTROL_CAPABILITY] = "1"
+        if getattr(owner, 'heartbeat', False):
+            capabilities[HEARTBEAT_CAPABILITY] = "%d" % \
+                (getattr(owner, 'heartbeat_interval', HEARTBEAT_INTERVAL) * 1000)
+        if getattr(owner, 'datagram', False) and getattr(owner, 'udp', 0):
+            capabilities[UDP_CAPABILITY] = str(owner.udp)
+        if getattr(owner, 'compression', False):
+            capabilities[ZLIB_CAPABILITY] = str(owner.compression_level)
+        if getattr(owner, 'shared_memory', False) and self.is_local():
+            try:
+                self.shm_writer = shm.RingWriter(owner.peerid,
+                        getattr(owner, 'shm_size', shm.SHM_RING_SIZE))
+                capabilities[SHM_CAPABILITY] = self.shm_writer.path
+            except EnvironmentError, err:
+                if logger.isEnabledFor(logging.WARNING):
+                    logger.warning("Cannot create the shared memory ring : %s"
+                                   % str(err))
+        return capabilities
+
+    def negotiate(self, capabilities):
+        """
+        This method activates the capabilities offered by both peers. The
+        remote ones are kept in rcapabilities.
+        """
+        self.rcapabilities = capabilities
+        self.negotiated = frozenset(self.capabilities) & \
+                          frozenset(capabilities)
+        if len(self.negotiated) != 0:
+            self.extended = True
+            self.line_length = BIPBaseProtocol.line_length + len(FRAME_PLAIN)
+        if SHM_CAPABILITY in self.negotiated:
+            try:
+                self.shm_reader = shm.RingReader(capabilities[SHM_CAPABILITY])
+            except (EnvironmentError, ValueError), err:
+                if logger.isEnabledFor(logging.ERROR):
+                    logger.error("Cannot map the shared memory ring : %s"
+                                 % str(err))
+                self.transport.loseConnection()
+            self.shm_threshold = getattr(self.factory.service,
+                                         'shm_threshold', shm.SHM_THRESHOLD)
+        elif self.shm_writer is not None:
+            self.shm_writer.close()
+            self.shm_writer = None
+        if UDP_CAPABILITY in self.negotiated:
+            host = getattr(self.transport.getPeer(), 'host', "127.0.0.1")
+            self.udp_address = (host, int(capabilities[UDP_CAPABILITY]))
+            self.datagram = self.factory.service.datagram_protocol
+        if HEARTBEAT_CAPABILITY in self.negotiated:
+            try:
+                rinterval = int(capabilities[HEARTBEAT_CAPABILITY])
+            except ValueError:
+                rinterval = 0
+            if rinterval > 0:
+                self.start_heartbeat(rinterval / 1000.)
+            else:
+                if logger.isEnabledFor(logging.ERROR):
+                    logger.error("Invalid heartbeat interval : %s"
+                                 % capabilities[HEARTBEAT_CAPABILITY])
+                self.transport.loseConnection()
+
+    def start_heartbeat(self, rinterval):
+        """
+        This method starts the heartbeat. Every interval, an empty heartbeat
+        frame is sent if nothing else was, and the connection is aborted once
+        nothing has been received for heartbeat_misses remote intervals, so
+        the disconnected event fires without waiting for tcp.
+        """
+        owner = self.factory.service
+        interval = getattr(owner, 'heartbeat_interval', HEARTBEAT_INTERVAL)
+        self.heartbeat_timeout = rinterval * \
+                        getattr(owner, 'heartbeat_misses', HEARTBEAT_MISSES)
+        self.heartbeat_call = timer_wheel(self.clock).callLater(interval,
+                                                    self.heartbeat, interval)
+
+    def heartbeat(self, interval):
+        """
+        Periodic heartbeat call, see start_heartbeat. The peer is not silent
+        while we do not read it.
+        """
+        if self.received or self.reading_paused:
+            self.silence = 0.
+        else:
+            self.silence += interval
+        self.received = False
+        if self.silence >= self.heartbeat_timeout:
+            if logger.isEnabledFor(logging.WARNING):
+                logger.warning("Heartbeat lost, closing connection -- %s --"
+                               % str(self.rpeerid))
+            self.heartbeat_call = None
+            abort = getattr(self.transport, 'abortConnection',
+                            self.transport.loseConnection)
+            abort()
+            return
+        if not self.written:
+            # an empty frame with its own msgid, through the writer so the
+            # slow peer policy applies to it
+            frame = [self.__header_prefix__ +
+                     BIP_MSGID_TEMPLATE % self.__msgid__ +
+                     BIP_SIZE_TEMPLATE % len(FRAME_HEARTBEAT),
+                     FRAME_HEARTBEAT, LINE_ENDING]
+            self.__msgid__ += 1
+            if self.writer is None:
+                self.transport.writeSequence(frame)
+            else:
+                self.writer.write(frame, len(FRAME_HEARTBEAT))
+        self.written = False
+        self.heartbeat_call = timer_wheel(self.clock).callLater(interval,
+                                                    self.heartbeat, interval)
 
-        reactor.callLater(self.factory.timeout, self.handshake_timeout)
+    def pauseReading(self):
+        """
+        This method stops reading the peer until resumeReading is called, the
+        heartbeat does not count this time as silence.
+        """
+        self.reading_paused = True
+        self.transport.pauseProducing()
+
+    def resumeReading(self):
+        """
+        This method reads the peer again, see pauseReading.
+        """
+        self.reading_paused = False
+        self.silence = 0.
+        self.transport.resumeProducing()
 
     def handshake_timeout(self):
         """
         Checking if we received the handshake packet. In the negative, 
         we close the transport.
         """
+        self.handshake_call = None
         if self.rpeerid is None:
             if logger.isEnabledFor(logging.INFO): 
                 logger.info("No answer, closing connection")
@@ -276,9 +790,36 @@ class BIPBaseProtocol(FastLineReceiver, events.EventDispatcherBase):
         """
         if logger.isEnabledFor(logging.INFO):
             logger.info("Client Connection Lost -- %s --" % self.host)
+        msg = self.__msg__
+        if (msg is not None) and (msg.rlen != 0):
+            if msg.streamed:
+                self.streamEndedEvent(msg)
+            else:
+                msg.release()
+        if self.handshake_call is not None:
+            self.handshake_call.cancel()
+            self.handshake_call = None
+        if self.heartbeat_call is not None:
+            self.heartbeat_call.cancel()
+            self.heartbeat_call = None
+        if self.shm_writer is not None:
+            self.shm_writer.close()
+            self.shm_writer = None
+        if self.shm_reader is not None:
+            self.shm_reader.close()
+            self.shm_reader = None
         if self.rpeerid is not None:
             self.disconnectedEvent(self)
 
+# Fixed layout of a bip header : "greeting peerid msgid size"
+GREETING_END = len(BIPBaseProtocol.__greeting__)
+PEERID_START = GREETING_END + 1
+PEERID_END = PEERID_START + len(str(Peerid(0)))
+MSGID_START = PEERID_END + 1
+MSGID_END = MSGID_START + len("%.8x" % 0)
+SIZE_START = MSGID_END + 1
+SIZE_END = SIZE_START + len("%.8x" % 0)
+
 class PeerError(Exception):
     """
     A simple exception with the peerid.
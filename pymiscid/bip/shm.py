@@ -0,0 +1,165 @@
+#
+"""
+This module implements the shared memory ring buffers used between peers on
+the same host. Each side of a connection owns the ring it writes to. The
+payloads are copied in the ring and only a small notification (position and
+length) goes through the BIP connection, which keeps the message order and
+the peerid semantics.
+"""
+import os
+import stat
+import mmap
+import struct
+import random
+import ctypes
+import logging
+
+logger = logging.getLogger(__name__)
+
+SHM_DIRECTORY = "/dev/shm" if os.path.isdir("/dev/shm") else "/tmp"
+SHM_PREFIX = "pymiscid-"
+SHM_RING_SIZE = 64 * 1024 * 1024 # bytes
+SHM_THRESHOLD = 64 * 1024 # bytes
+
+RING_HEADER = struct.Struct("!Q")
+NOTIFICATION = struct.Struct("!QQ")
+
+def map_view(shared):
+    """
+    This function returns a memoryview on a mmap, through ctypes when the mmap
+    does not export the new buffer protocol.
+    """
+    try:
+        return memoryview(shared)
+    except TypeError:
+        return memoryview((ctypes.c_char * len(shared)).from_buffer(shared))
+
+def release(ring):
+    """
+    This function releases the view and the mapping of a ring.
+    """
+    view, ring.view = ring.view, None
+    if hasattr(view, 'release'):
+        view.release()
+    del view
+    ring.map.close()
+
+class RingWriter(object):
+    """
+    This object is the producer side of a ring. The first bytes of the mapping
+    hold the position released by the consumer, the data follows.
+    """
+    def __init__(self, peerid, size = SHM_RING_SIZE):
+        """
+        Creation and mapping of the ring file.
+        """
+        self.path = os.path.join(SHM_DIRECTORY, "%s%s-%08x" % (SHM_PREFIX,
+                                 str(peerid), random.randint(0, 0xFFFFFFFF)))
+        self.capacity = size
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0600)
+        try:
+            os.ftruncate(fd, RING_HEADER.size + size)
+            self.map = mmap.mmap(fd, RING_HEADER.size + size)
+        finally:
+            os.close(fd)
+        self.view = map_view(self.map)
+        self.head = 0
+
+    def write(self, payload):
+        """
+        This method copies the payload in the ring and returns the notification
+        to send to the consumer, or None if there is not enough room.
+        """
+        length = len(payload)
+        tail = RING_HEADER.unpack_from(self.map, 0)[0]
+        head = self.head
+        start = head % self.capacity
+        if start + length > self.capacity:
+            head += self.capacity - start
+            start = 0
+        if head + length - tail > self.capacity:
+            return None
+        pos = RING_HEADER.size + start
+        self.view[pos:pos + length] = payload
+        self.head = head + length
+        return NOTIFICATION.pack(head, length)
+
+    def unlink(self):
+        """
+        Removes the ring file, the mappings stay valid.
+        """
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def close(self):
+        """
+        Removes the ring and releases the mapping.
+        """
+        self.unlink()
+        release(self)
+
+def check_ring_path(path):
+    """
+    This function returns the real path of a ring given by a remote peer. It
+    raises a ValueError unless it names a ring file directly in SHM_DIRECTORY,
+    the peer must not make us map, write or unlink any other file.
+    """
+    real = os.path.realpath(path)
+    if (os.path.dirname(real) != os.path.realpath(SHM_DIRECTORY)) or \
+       not os.path.basename(real).startswith(SHM_PREFIX):
+        raise ValueError("Not a shared memory ring : %r" % path)
+    return real
+
+class RingReader(object):
+    """
+    This object is the consumer side of a ring created by the remote peer.
+    """
+    def __init__(self, path):
+        """
+        Mapping of the ring file, which must be a regular file holding more
+        than the ring header, or a ValueError is raised. The file is unlinked
+        as soon as both sides mapped it so nothing is left behind.
+        """
+        path = check_ring_path(path)
+        fd = os.open(path, os.O_RDWR | getattr(os, 'O_NOFOLLOW', 0))
+        try:
+            info = os.fstat(fd)
+            if not stat.S_ISREG(info.st_mode):
+                raise ValueError("Not a shared memory ring : %r" % path)
+            if info.st_size <= RING_HEADER.size:
+                raise ValueError("Shared memory ring too small : %r" % path)
+            size = info.st_size
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.view = map_view(self.map)
+        self.capacity = size - RING_HEADER.size
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def holds(self, head, length):
+        """
+        This method returns True if the notification (see NOTIFICATION) gives
+        a payload inside the ring.
+        """
+        return head % self.capacity + length <= self.capacity
+
+    def read(self, head, length, buf):
+        """
+        This method copies the payload given by a notification (see
+        NOTIFICATION) in buf, a writable buffer, and releases its room in the
+        ring. The notification must be checked with holds.
+        """
+        pos = RING_HEADER.size + head % self.capacity
+        memoryview(buf)[:length] = self.view[pos:pos + length]
+        RING_HEADER.pack_into(self.map, 0, head + length)
+
+    def close(self):
+        """
+        Releases the mapping.
+        """
+        release(self)
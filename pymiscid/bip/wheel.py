@@ -0,0 +1,167 @@
+#
+"""
+This module implements the hashed timer wheel shared by the timeouts (control
+queries, handshakes, heartbeats, idle control links). A timer is put in the
+slot of its expiry tick, with the number of wheel rounds to wait, so inserting
+and cancelling are O(1) whatever the number of pending timers. The wheel is
+driven by a single call of its clock per tick, only while timers are pending.
+The timers fire at most one tick late, the time is the one of the clock.
+"""
+from __future__ import with_statement
+import threading
+import math
+import weakref
+import logging
+
+from twisted.internet import reactor
+
+logger = logging.getLogger(__name__)
+
+TIMER_WHEEL_TICK = 0.05 # seconds
+TIMER_WHEEL_SIZE = 512 # slots, a round lasts 25.6s
+TIMER_WHEEL_EPSILON = 1e-9 # ticks, a delay of n ticks in floats lasts n ticks
+
+class Timer(object):
+    """
+    A pending call of a TimerWheel.
+    """
+    __slots__ = ['wheel', 'slot', 'rounds', 'fct', 'args']
+
+    def __init__(self, wheel, slot, rounds, fct, args):
+        self.wheel = wheel
+        self.slot = slot
+        self.rounds = rounds
+        self.fct = fct
+        self.args = args
+
+    def cancel(self):
+        """
+        This method cancels the call, it does nothing if it is already done.
+        """
+        self.wheel.cancel(self)
+
+    def active(self):
+        return self.wheel.active(self)
+
+
+class TimerWheel(object):
+    """
+    This object schedules calls in the thread of its clock (the reactor, a
+    LoopClock or a task.Clock). callLater and cancel can be called from any
+    thread, except with a task.Clock which has no callFromThread.
+    """
+    def __init__(self, clock = reactor, tick = TIMER_WHEEL_TICK,
+                 size = TIMER_WHEEL_SIZE):
+        """
+        Slots initialisation, the wheel starts with the first timer. The clock
+        is not kept alive by its wheel.
+        """
+        self.clock = weakref.proxy(clock)
+        self.tick = tick
+        self.slots = [set() for i in xrange(size)]
+        self.cursor = 0
+        self.count = 0
+        self.running = False
+        self.last = None
+        self.lock = threading.Lock()
+
+    def callLater(self, delay, fct, *args):
+        """
+        This method calls fct(*args) in delay seconds and returns the Timer.
+        The cursor lags the clock by up to a tick, the timer goes in the first
+        slot whose tick, counted from the time of the cursor, is not before
+        its expiry. Before the wheel starts, the time of the cursor will be
+        the one of the start.
+        """
+        now = self.clock.seconds()
+        size = len(self.slots)
+        with self.lock:
+            elapsed = 0. if self.last is None else max(now - self.last, 0.)
+            ticks = max(1, int(math.ceil((elapsed + delay) / self.tick -
+                                         TIMER_WHEEL_EPSILON)))
+            timer = Timer(self, (self.cursor + ticks) % size,
+                          (ticks - 1) // size, fct, args)
+            self.slots[timer.slot].add(timer)
+            self.count += 1
+            if self.running:
+                return timer
+            self.running = True
+        call = getattr(self.clock, 'callFromThread', None)
+        if call is None:
+            self.__start__()
+        else:
+            call(self.__start__)
+        return timer
+
+    def cancel(self, timer):
+        with self.lock:
+            slot = self.slots[timer.slot]
+            if timer in slot:
+                slot.remove(timer)
+                self.count -= 1
+
+    def active(self, timer):
+        with self.lock:
+            return timer in self.slots[timer.slot]
+
+    def __len__(self):
+        return self.count
+
+    def __start__(self):
+        with self.lock:
+            self.last = self.clock.seconds()
+        self.clock.callLater(self.tick, self.__drive__)
+
+    def __drive__(self):
+        """
+        Advances the cursor of the elapsed ticks and fires the expired timers.
+        After a stall longer than a round, each slot is passed several times.
+        """
+        now = self.clock.seconds()
+        size = len(self.slots)
+        expired = []
+        with self.lock:
+            ticks = max(1, int((now - self.last) / self.tick +
+                               TIMER_WHEEL_EPSILON))
+            self.last += ticks * self.tick
+            last = self.last
+            rounds, rest = divmod(ticks, size)
+            for i in xrange(min(ticks, size)):
+                slot = self.slots[(self.cursor + 1 + i) % size]
+                passes = rounds + (1 if i < rest else 0)
+                for timer in list(slot):
+                    if timer.rounds < passes:
+                        slot.remove(timer)
+                        expired.append(timer)
+                    else:
+                        timer.rounds -= passes
+            self.cursor = (self.cursor + ticks) % size
+            self.count -= len(expired)
+            running = self.running = self.count != 0
+            if not running:
+                # the time of the cursor is set again by __start__
+                self.last = None
+        for timer in expired:
+            try:
+                timer.fct(*timer.args)
+            except Exception, err:
+                if logger.isEnabledFor(logging.ERROR):
+                    logger.exception("Timer call failed : %s" % str(err))
+        if running:
+            self.clock.callLater(max(last + self.tick - self.clock.seconds(),
+                                     0), self.__drive__)
+
+
+wheels = weakref.WeakKeyDictionary()
+wheels_lock = threading.Lock()
+
+def timer_wheel(clock = reactor):
+    """
+    This function returns the timer wheel of a clock, created on the first
+    call.
+    """
+    with wheels_lock:
+        wheel = wheels.get(clock, None)
+        if wheel is None:
+            wheel = wheels[clock] = TimerWheel(clock)
+        return wheel
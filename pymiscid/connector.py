@@ -2,16 +2,31 @@
 """
 This is
 """
+from __future__ import with_statement
+import os
+import socket
+import random
+import zlib
 import logging
 import threading
 import weakref
-
-from bip.factory import BIPFactory
-from bip.protocol import UNBOUNDED_PEERID, Peerid
-from twisted.internet import reactor
+import collections
+
+from bip.factory import BIPFactory, BIPLinkFactory
+from bip.protocol import UNBOUNDED_PEERID, Peerid, to_payload, broadcast, \
+                         ZLIB_CAPABILITY, FRAME_ZLIB, HEARTBEAT_INTERVAL, \
+                         HEARTBEAT_MISSES, CONTROL_CAPABILITY
+from bip.flow import BLOCK, SlowPeerError, SendCompletion
+from bip.shm import SHM_RING_SIZE, SHM_THRESHOLD
+from bip.datagram import BIPDatagramProtocol, DATAGRAM_MTU, DATAGRAM_MAX_SIZE
+from bip.wheel import timer_wheel
+from twisted.internet import reactor, defer
 from twisted.application import service
+from twisted.python import threadable
 
 from dispatcher import BasicEventDispatcher, ControlEventDispatcher
+from executor import DispatchExecutor
+import controlcodec
 
 import codebench.generator as generator
 
@@ -20,9 +35,17 @@ from cstes import XML_IO_CONNECTOR_TAG, \
                   XML_O_CONNECTOR_TAG, \
                   UNBOUNDED_CONNECTOR_NAME, \
                   CONNECTION_TIMEOUT, \
-                  CONTROL_ANSWER, \
-                  CONTROL_EVENT, \
-                  CONTROL_QUERY, \
+                  RECONNECT_DELAY, \
+                  RECONNECT_MAX_DELAY, \
+                  RECONNECT_JITTER, \
+                  DISPATCH_WORKERS, \
+                  DISPATCH_QUEUE_SIZE, \
+                  STREAM_THRESHOLD, \
+                  COMPRESSION_THRESHOLD, \
+                  COMPRESSION_LEVEL, \
+                  DECOMPRESSION_MAX_SIZE, \
+                  UNIX_SOCKET_DIRECTORY, \
+                  UNIX_SOCKET_TEMPLATE, \
                   TXT_SEPARATOR, \
                   IO_CONNECTOR_PREFIX, \
                   INPUT_CONNECTOR_PREFIX, \
@@ -44,6 +67,26 @@ txt_to_connector_type_map = {'o' : OUTPUT,
                              'd' : INOUTPUT,
                              'i' : INPUT }
 
+def first_failure(err):
+    """
+    This function is the errback of a DeferredList firing on the first error,
+    it gives back the failure of the deferred which failed.
+    """
+    err.trap(defer.FirstError)
+    return err.value.subFailure
+
+def is_local_host(host, addr = None):
+    """
+    This function returns True if the host name (as published by dnssd) or the
+    address is the one of this machine.
+    """
+    if (addr is not None) and str(addr).startswith("127."):
+        return True
+    if host is None:
+        return False
+    name = str(host).rstrip('.').split('.')[0].lower()
+    return name in ['localhost', socket.gethostname().split('.')[0].lower()]
+
 class BIPPrimalConnector(object):
     """
     This object is the primal ProtocolFactory observer. It is intendended to
@@ -51,7 +94,13 @@ class BIPPrimalConnector(object):
     the transport so this is supposed to be quick and succint.
     """
     dispatcher = None
+    executor = None
     peerid = None
+    buffer_pool = None
+
+    dispatch_workers = DISPATCH_WORKERS
+    dispatch_queue_size = DISPATCH_QUEUE_SIZE
+
     def __init__(self):
         """
         PeerId  dict initialisation
@@ -85,16 +134,78 @@ class BIPPrimalConnector(object):
         if self.dispatcher is not None:
             self.dispatcher.disconnectedEvent(protocol.rpeerid)
 
-    def received(self, msg):
+    def receivedBatch(self, msgs):
         """
-        This is a direct callback from the protocol object. This call is
-        forwarded to the dispatcher in a thread from the threadpool. The 
+        This is a direct callback from the protocol object with every message
+        decoded in one read. This call is forwarded to the dispatcher through
+        the connector executor, which keeps the order of the messages of each
+        peer. The executor is built on the first message from the
+        dispatch_workers (0 runs the observers in the main thread) and
+        dispatch_queue_size attributes. If buffer_pool is set (a BufferPool
+        given before the connections are made), the message buffers are
+        leased from it and recycled after the dispatch : an observer which
+        keeps a message must call msg.retain() and later msg.release().
         """
         if self.dispatcher is not None:
-            reactor.callInThread(self.dispatcher.receivedEvent, msg)
+            self.__submit__(msgs[0], self.__dispatch_batch__, msgs)
+        else:
+            for msg in msgs:
+                msg.release()
 
-    def __connect__(self, proxy):
-        reactor.connectTCP(proxy.host, int(proxy.tcp), self.protocol_factory)
+    def __dispatch_batch__(self, msgs):
+        """
+        This method runs in the executor, it decompresses the zlib messages
+        before the dispatch so the main thread never does. Once dispatched,
+        the buffers of the messages no observer retained go back to the pool.
+        """
+        for msg in [m for m in msgs if m.tag == FRAME_ZLIB]:
+            try:
+                msg.decompress(self.decompression_max_size)
+            except zlib.error, err:
+                if logger.isEnabledFor(logging.WARNING):
+                    logger.warning("Dropping corrupted message from %s : %s"
+                                   % (str(msg.peerid), str(err)))
+                msg.release()
+                msgs.remove(msg)
+        if len(msgs) != 0:
+            self.dispatcher.dispatchBatch(msgs)
+        if self.buffer_pool is not None:
+            for msg in msgs:
+                if not msg.retained:
+                    msg.release()
+
+    def bufferPoolStats(self):
+        """
+        This method returns the occupancy statistics of the receive buffer
+        pool (see BufferPool.stats), None without pool.
+        """
+        if self.buffer_pool is None:
+            return None
+        return self.buffer_pool.stats()
+
+    def __submit__(self, msg, fct, *args):
+        """
+        This method runs fct through the connector executor on behalf of the
+        peer which sent the msg. The executor is built on the first call.
+        """
+        if self.executor is None:
+            self.executor = DispatchExecutor(self.dispatch_workers,
+                                             self.dispatch_queue_size)
+        self.executor.submit(self.peers.get(msg.peerid, None), fct, *args)
+
+    def __connect__(self, proxy, factory = None):
+        """
+        The unix socket of the remote connector is preferred when it is on the
+        same host.
+        """
+        if factory is None:
+            factory = self.protocol_factory
+        unix = getattr(proxy, 'unix', None)
+        if (unix is not None) and is_local_host(proxy.host, proxy.addr) and \
+           os.path.exists(unix):
+            reactor.connectUNIX(unix, factory)
+        else:
+            reactor.connectTCP(proxy.host, int(proxy.tcp), factory)
 
 
     def __disconnect__(self, peerid):
@@ -111,7 +222,8 @@ class BIPPrimalConnector(object):
         if peerid is None:
             for peer in self.peers.itervalues():
                 peer.transport.loseConnection()
-                self.dispatcher.disconnectedEvent(peer.rpeerid)
+                if self.dispatcher is not None:
+                    self.dispatcher.disconnectedEvent(peer.rpeerid)
         else:
             try:
                 self.peers[peerid].loseConnection()
@@ -128,24 +240,122 @@ class BIPPrimalConnector(object):
 
 
 
-    def __send__(self, msg, peerid = None):
+    def bufferedBytes(self, peerid = None):
+        """
+        This method returns the number of bytes waiting to be sent to the given
+        peer, or a dict of it for every peer if peerid is None.
+        """
+        if peerid is None:
+            return dict([(pid, peer.buffered())
+                         for pid, peer in self.peers.items()])
+        peer = self.peers.get(peerid, None)
+        return 0 if peer is None else peer.buffered()
+
+    def __send__(self, msg, peerid = None, deferred = None, compressed = None):
         """
         This function is intended to be call from the main thread. Same
-        description as send method. 
+        description as send method. The deferred, if any, fires with the
+        number of peers when the msg reaches the transport of every peer, or
+        fails with the SlowPeerError of the first peer which dropped it.
+        compressed is the zlib version of the msg, if any, for the peers which
+        negotiated it.
         """
         if logger.isEnabledFor(logging.DEBUG): 
             logger.debug("Message sent through %s : %s" % (self.peerid, msg))
 
-        string_msg = str(msg)
         if peerid is None:
-            for peer in self.peers.itervalues():
-                peer.send(string_msg)
+            deferreds = broadcast(self.peers.itervalues(), msg,
+                                  completion = deferred is not None,
+                                  compressed = compressed)
         elif peerid in self.peers:
-            self.peers[peerid].send(string_msg)
+            deferreds = [None if deferred is None else defer.Deferred()]
+            self.peers[peerid].send(msg, deferreds[0], compressed)
         else:
+            deferreds = []
             if logger.isEnabledFor(logging.WARNING): 
                 logger.warning("Trying to send msg to an unknown peer -- %s --"
                                % str(peerid))
+            if deferred is not None:
+                deferred.errback(SlowPeerError("Unknown peer"))
+                return
+        if deferred is not None:
+            sent = defer.DeferredList(deferreds, fireOnOneErrback = True,
+                                      consumeErrors = True)
+            sent.addCallbacks(len, first_failure)
+            sent.chainDeferred(deferred)
+
+
+class ReconnectingLink(object):
+    """
+    This object keeps an outgoing connection of a connector open. After a
+    failure or a loss, the next attempt waits the reconnect_delay of the
+    connector, doubled after every failed attempt up to reconnect_max_delay
+    and shortened at random by up to reconnect_jitter of it so that the peers
+    of a restarted service do not reconnect all at once. Once reconnected, the
+    reconnected method of the proxy, if any, is called to restore its state.
+    Every method runs in the main thread.
+    """
+    def __init__(self, owner, proxy):
+        self.proxy = proxy
+        self.factory = BIPLinkFactory(owner.protocol_factory.service, self)
+        self.attempts = 0
+        self.pending = False
+        self.established = False
+        self.closed = False
+        self.call = None
+
+    def open(self):
+        """
+        This method makes an attempt now, unless one is in progress.
+        """
+        owner = self.factory.service
+        if self.closed or self.pending or (self.proxy.peerid in owner.peers):
+            return
+        if self.call is not None:
+            self.call.cancel()
+            self.call = None
+        self.pending = True
+        owner.__connect__(self.proxy, self.factory)
+
+    def __retry__(self):
+        self.call = None
+        self.open()
+
+    def connected(self):
+        """
+        Callback from the connector once the handshake is done.
+        """
+        self.pending = False
+        self.attempts = 0
+        if self.established and hasattr(self.proxy, 'reconnected'):
+            self.proxy.reconnected()
+        self.established = True
+
+    def lost(self):
+        """
+        Callback from the factory, the next attempt is scheduled.
+        """
+        self.pending = False
+        if self.closed:
+            return
+        owner = self.factory.service
+        delay = min(owner.reconnect_max_delay,
+                    owner.reconnect_delay * 2 ** min(self.attempts, 16))
+        delay *= 1. - owner.reconnect_jitter * random.random()
+        self.attempts += 1
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Reconnecting to %s in %.2fs"
+                        % (str(self.proxy.peerid), delay))
+        self.call = reactor.callLater(delay, self.__retry__)
+
+    def close(self):
+        """
+        This method stops the reconnection.
+        """
+        self.closed = True
+        if self.call is not None:
+            self.call.cancel()
+            self.call = None
 
 
 class Connector(BIPPrimalConnector, service.Service):
@@ -163,13 +373,78 @@ class Connector(BIPPrimalConnector, service.Service):
     protocol_factory = None
     tcp = None
     udp = 0
+    unix = None
     sbind = None
+    ubind = None
+    dbind = None
+    datagram_protocol = None
+
+    # When unix_socket is set, local peers connect through an unix socket
+    # listening next to the tcp port. Its path is published in the txt record
+    # and the description, which only the peers of this version understand.
+    unix_socket = False
+
+    high_water = None
+    slow_peer_policy = BLOCK
+
+    stream_threshold = STREAM_THRESHOLD
+
+    # When both peers set shared_memory and are on the same host, the payloads
+    # of at least shm_threshold bytes go through a ring of shm_size bytes.
+    shared_memory = False
+    shm_size = SHM_RING_SIZE
+    shm_threshold = SHM_THRESHOLD
+
+    # When both peers set datagram, the messages go through udp once the
+    # connection is made. They are split in datagrams of datagram_mtu bytes and
+    # only the latest one matters, late messages are dropped. The messages
+    # above datagram_max_size bytes still go through the stream connection.
+    datagram = False
+    datagram_mtu = DATAGRAM_MTU
+    datagram_max_size = DATAGRAM_MAX_SIZE
+
+    # When both peers set compression, the messages of at least
+    # compression_threshold bytes are sent zlib compressed. The compression
+    # runs in the thread calling send and the decompression in the executor.
+    # A message larger than decompression_max_size bytes once decompressed is
+    # dropped.
+    compression = False
+    compression_threshold = COMPRESSION_THRESHOLD
+    compression_level = COMPRESSION_LEVEL
+    decompression_max_size = DECOMPRESSION_MAX_SIZE
+
+    # When both peers set heartbeat, they send an empty frame every
+    # heartbeat_interval seconds when idle. A peer silent for heartbeat_misses
+    # of its intervals is disconnected, and its pending queries fail.
+    heartbeat = False
+    heartbeat_interval = HEARTBEAT_INTERVAL
+    heartbeat_misses = HEARTBEAT_MISSES
+
+    # When reconnect is set, the outgoing connections are reopened after a
+    # failure or a loss until disconnect is called. A proxy with a reconnect
+    # attribute (a ServiceProxy) overrides it for its own link.
+    reconnect = False
+    reconnect_delay = RECONNECT_DELAY
+    reconnect_max_delay = RECONNECT_MAX_DELAY
+    reconnect_jitter = RECONNECT_JITTER
 
     txt_prefix = IO_CONNECTOR_PREFIX
 
     xml_tag = XML_IO_CONNECTOR_TAG
     xml_attributes = ['name']
-    xml_childs = ['tcp', 'description', 'peerId', 'peers']
+
+    def __get_xml_childs__(self):
+        """
+        The udp and unix elements are only given by a connector listening on
+        them, so the default description stays the OMiSCID one.
+        """
+        childs = ['tcp']
+        if self.udp:
+            childs.append('udp')
+        if self.unix is not None:
+            childs.append('unix')
+        return childs + ['description', 'peerId', 'peers']
+    xml_childs = property(__get_xml_childs__)
 
     def __set_peerid__(self, value):
         self.peerid = value
@@ -186,6 +461,14 @@ class Connector(BIPPrimalConnector, service.Service):
         self.description = description
         self.dispatcher = BasicEventDispatcher()
         self.connected_events = {}
+        self.connection_waiters = {}
+        self.outbox = collections.deque()
+        self.outbox_lock = threading.Lock()
+        self.flush_scheduled = False
+        self.flow_condition = threading.Condition()
+        self.stream_factories = {}
+        self.stream_uid_gen = generator.uid_generator()
+        self.links = {}
 
     def __init_factory__(self):
         """
@@ -220,7 +503,13 @@ class Connector(BIPPrimalConnector, service.Service):
             logger.debug("Connecting to %s(%s) on port %d" 
                          % (proxy.host, proxy.addr, int(proxy.tcp)))
 
-        reactor.callFromThread(self.__connect__, proxy)
+        reconnect = getattr(proxy, 'reconnect', None)
+        if reconnect is None:
+            reconnect = self.reconnect
+        if reconnect:
+            reactor.callFromThread(self.__link__, proxy)
+        else:
+            reactor.callFromThread(self.__connect__, proxy)
         self.connected_events[proxy.peerid].wait(timeout)
         if not evt.isSet(): 
             if logger.isEnabledFor(logging.WARNING): 
@@ -228,11 +517,68 @@ class Connector(BIPPrimalConnector, service.Service):
                                % str(proxy.peerid))
             raise RuntimeError("Connection timeout reached")
 
+    def __connection__(self, proxy, timeout = CONNECTION_TIMEOUT):
+        """
+        This is the non blocking version of connect, to be called from the main
+        thread. It returns a deferred which fires once the connection is made,
+        or fails with a RuntimeError after timeout seconds.
+        """
+        if self.protocol_factory is None:
+            self.__init_factory__()
+        if proxy.peerid in self.peers:
+            return defer.succeed(None)
+
+        connection = defer.Deferred()
+        connection.timer = timer_wheel().callLater(timeout,
+                        self.__connection_timedout__, proxy.peerid, connection)
+        waiters = self.connection_waiters.setdefault(proxy.peerid, [])
+        waiters.append(connection)
+        if len(waiters) > 1:
+            return connection
+
+        if logger.isEnabledFor(logging.DEBUG): 
+            logger.debug("Connecting to %s(%s) on port %d" 
+                         % (proxy.host, proxy.addr, int(proxy.tcp)))
+        reconnect = getattr(proxy, 'reconnect', None)
+        if reconnect is None:
+            reconnect = self.reconnect
+        if reconnect:
+            self.__link__(proxy)
+        else:
+            self.__connect__(proxy)
+        return connection
+
+    def __connection_timedout__(self, peerid, connection):
+        waiters = self.connection_waiters.get(peerid, [])
+        if connection in waiters:
+            waiters.remove(connection)
+            if len(waiters) == 0:
+                del self.connection_waiters[peerid]
+            if logger.isEnabledFor(logging.WARNING): 
+                logger.warning("Connection Timed Out -- %s --" % str(peerid))
+            connection.errback(RuntimeError("Connection timeout reached"))
+
     def disconnect(self, peerid):
         """
-        This is the thread safe version of __dictonnect__
+        This is the thread safe version of __dictonnect__, it also stops the
+        reconnection of the link.
         """
-        reactor.callFromThread(self.__disconnect__, peerid)
+        reactor.callFromThread(self.__unlink__, peerid)
+
+    def __link__(self, proxy):
+        """
+        This method opens the reconnecting link to the proxy.
+        """
+        link = self.links.get(proxy.peerid, None)
+        if link is None:
+            link = self.links[proxy.peerid] = ReconnectingLink(self, proxy)
+        link.open()
+
+    def __unlink__(self, peerid):
+        link = self.links.pop(peerid, None)
+        if link is not None:
+            link.close()
+        self.__disconnect__(peerid)
 
     def connected(self, protocol):
         """
@@ -246,9 +592,113 @@ class Connector(BIPPrimalConnector, service.Service):
             logger.info("connection from %s to local connector %s "
                         % (str(peerid), self.name))
         BIPPrimalConnector.connected(self, protocol)
+        protocol.stream_threshold = self.__stream_threshold__()
+        link = self.links.get(peerid, None)
+        if link is not None:
+            link.connected()
         evt = self.connected_events.pop(peerid, None)
         if evt is not None: 
             evt.set()
+        for connection in self.connection_waiters.pop(peerid, []):
+            connection.timer.cancel()
+            connection.callback(None)
+
+    def disconnected(self, protocol):
+        """
+        This is an override for the primal connector protocol callback to drop
+        the datagram state of the peer.
+        """
+        BIPPrimalConnector.disconnected(self, protocol)
+        if self.datagram_protocol is not None:
+            self.datagram_protocol.forget(protocol.rpeerid)
+
+    def datagramReceived(self, msg):
+        """
+        Direct callback from the datagram protocol, the msg is dispatched as
+        any received message if it comes from a connected peer.
+        """
+        if msg.peerid in self.peers:
+            self.receivedBatch([msg])
+
+    def addStreamObserver(self, factory):
+        """
+        This method registers a stream observer factory. For each message of
+        at least stream_threshold bytes, the factory is called to build a
+        handler which gets start(peerid, msgid, size), then chunk(memoryview)
+        as the data arrives and end(). If the connection is lost before the
+        end of the message, abort() is called instead, if the handler has it.
+        Those messages are not delivered to the received observers. It returns
+        an id to remove the factory.
+        """
+        oid = self.stream_uid_gen.next()
+        self.stream_factories[oid] = factory
+        reactor.callFromThread(self.__update_stream_threshold__)
+        return oid
+
+    def removeStreamObserver(self, oid):
+        """
+        This method removes a stream observer factory.
+        """
+        del self.stream_factories[oid]
+        reactor.callFromThread(self.__update_stream_threshold__)
+
+    def streamStarted(self, msg):
+        """
+        Direct callback from the protocol, a message larger than the
+        stream threshold begins.
+        """
+        self.__submit__(msg, self.__stream_started__, msg)
+
+    def streamChunk(self, msg, chunk):
+        """
+        Direct callback from the protocol, a chunk of a streamed message.
+        """
+        self.__submit__(msg, self.__stream_chunk__, msg, chunk)
+
+    def streamEnded(self, msg):
+        """
+        Direct callback from the protocol, the streamed message is complete or
+        the connection is lost.
+        """
+        self.__submit__(msg, self.__stream_ended__, msg)
+
+    def __stream_threshold__(self):
+        """
+        Returns the stream threshold given to the protocols.
+        """
+        return self.stream_threshold if len(self.stream_factories) else None
+
+    def __update_stream_threshold__(self):
+        threshold = self.__stream_threshold__()
+        for peer in self.peers.itervalues():
+            peer.stream_threshold = threshold
+
+    def __stream_started__(self, msg):
+        msg.handlers = [factory() for factory in
+                        self.stream_factories.values()]
+        for handler in msg.handlers:
+            self.__stream_call__(handler.start, msg.peerid, msg.msgid,
+                                 msg.size)
+
+    def __stream_chunk__(self, msg, chunk):
+        for handler in msg.handlers:
+            self.__stream_call__(handler.chunk, chunk)
+
+    def __stream_ended__(self, msg):
+        for handler in msg.handlers:
+            if msg.rlen == 0:
+                self.__stream_call__(handler.end)
+            elif hasattr(handler, 'abort'):
+                self.__stream_call__(handler.abort)
+
+    def __stream_call__(self, fct, *args):
+        """
+        A failing stream handler must not break the others.
+        """
+        try:
+            fct(*args)
+        except Exception, err:
+            logger.exception(str(err))
 
     def startService(self):
         """
@@ -262,11 +712,49 @@ class Connector(BIPPrimalConnector, service.Service):
         self.tcp = self.sbind.getHost().port
         if logger.isEnabledFor(logging.DEBUG): 
             logger.debug("Starting Connector on port : %d" % (self.tcp))
+        if self.unix_socket and hasattr(socket, 'AF_UNIX'):
+            self.__listen_unix__()
+        if self.datagram:
+            self.datagram_protocol = BIPDatagramProtocol(
+                                weakref.proxy(self), self.datagram_mtu,
+                                self.datagram_max_size)
+            self.dbind = reactor.listenUDP(0, self.datagram_protocol)
+            self.udp = self.dbind.getHost().port
+
+    def __listen_unix__(self):
+        """
+        This method starts the unix socket listener, its path is derived from
+        the pid and the tcp port so it is unique on the host.
+        """
+        path = os.path.join(UNIX_SOCKET_DIRECTORY,
+                            UNIX_SOCKET_TEMPLATE % (os.getpid(), self.tcp))
+        try:
+            if os.path.exists(path):
+                os.unlink(path)
+            self.ubind = reactor.listenUNIX(path, self.protocol_factory)
+            self.unix = path
+        except Exception, err:
+            if logger.isEnabledFor(logging.WARNING):
+                logger.warning("Cannot listen on unix socket %s : %s"
+                               % (path, str(err)))
 
     def __stopService__(self):
         service.Service.stopService(self)
+        while len(self.links) != 0:
+            self.links.popitem()[1].close()
         self.sbind.stopListening()
+        if self.ubind is not None:
+            self.ubind.stopListening()
+            self.ubind = None
+            self.unix = None
+        if self.dbind is not None:
+            self.dbind.stopListening()
+            self.dbind = None
+            self.datagram_protocol = None
         self.__loseConnection__()
+        if self.executor is not None:
+            self.executor.stop()
+            self.executor = None
         self.sbind = None
         self.tcp = 0
         self.udp = 0
@@ -288,22 +776,124 @@ class Connector(BIPPrimalConnector, service.Service):
         """
         This method is intended to be called from am outside thread. It prepare
         the message for the protocol object and ensure the transport is used in
-        the main thread.
+        the main thread. The msg can be a string or any object implementing the
+        buffer protocol (bytearray, numpy array ...). The msg is queued in the
+        connector outbox which the main thread drains in batches. With the
+        BLOCK slow peer policy, this call waits while a peer is above the high
+        water mark.
         """
-        reactor.callFromThread(self.__send__, msg, peerid = peerid)
+        self.__wait_for_room__(peerid)
+        self.outbox.append(self.__prepare__(msg, peerid))
+        self.__schedule_flush__()
 
     __call__ = send
 
+    def send_many(self, msgs, peerid = None):
+        """
+        This method queues several messages at once, same description as the
+        send method.
+        """
+        self.__wait_for_room__(peerid)
+        self.outbox.extend([self.__prepare__(msg, peerid) for msg in msgs])
+        self.__schedule_flush__()
+
+    def send_deferred(self, msg, peerid = None):
+        """
+        This method is the same as send but returns a SendCompletion which is
+        done, with the number of peers, when the msg reaches the transport of
+        every peer, or fails with a SlowPeerError if the msg is dropped. Its callbacks run in the main
+        thread and the calling thread can wait for it, so producers can use it
+        to pace themselves.
+        """
+        completion = SendCompletion()
+        self.__wait_for_room__(peerid)
+        self.outbox.append(self.__prepare__(msg, peerid, completion))
+        self.__schedule_flush__()
+        return completion
+
+    def __prepare__(self, msg, peerid, completion = None):
+        """
+        This method builds the outbox entry of a msg. The payload is
+        compressed here, in the calling thread, if a target peer negotiated
+        zlib.
+        """
+        compressed = None
+        if self.compression:
+            msg = to_payload(msg)
+            if len(msg) >= self.compression_threshold:
+                if peerid is None:
+                    peers = self.peers.values()
+                else:
+                    peers = [self.peers.get(peerid, None)]
+                if [p for p in peers if (p is not None) and
+                                        (ZLIB_CAPABILITY in p.negotiated)]:
+                    compressed = zlib.compress(msg, self.compression_level)
+                    if len(compressed) >= len(msg):
+                        compressed = None
+        return (msg, peerid, completion, compressed)
+
+    def __wait_for_room__(self, peerid):
+        """
+        This method blocks the calling thread while a peer is above the high
+        water mark with the BLOCK policy. It never blocks the main thread.
+        """
+        high_water = self.high_water
+        if (high_water is None) or (self.slow_peer_policy != BLOCK) or \
+           threadable.isInIOThread():
+            return
+        with self.flow_condition:
+            while True:
+                if peerid is None:
+                    peers = self.peers.values()
+                else:
+                    peers = [self.peers.get(peerid, None)]
+                if not [p for p in peers
+                        if (p is not None) and (p.buffered() >= high_water)]:
+                    break
+                self.flow_condition.wait(1.)
+
+    def __schedule_flush__(self):
+        """
+        This method wakes up the main thread only if no flush of the outbox is
+        already pending.
+        """
+        with self.outbox_lock:
+            if self.flush_scheduled:
+                return
+            self.flush_scheduled = True
+        reactor.callFromThread(self.__flush__)
+
+    def __flush__(self):
+        """
+        This method sends every message queued in the outbox when the flush
+        starts. Messages queued during the flush schedule the next one.
+        """
+        with self.outbox_lock:
+            self.flush_scheduled = False
+        outbox = self.outbox
+        for i in xrange(len(outbox)):
+            msg, peerid, completion, compressed = outbox.popleft()
+            deferred = None
+            if completion is not None:
+                # the deferred lives in the main thread only
+                deferred = defer.Deferred().addBoth(completion.complete)
+            self.__send__(msg, peerid = peerid, deferred = deferred,
+                          compressed = compressed)
+
     def TXTRecord(self, record = None):
         """
-        This method describe the connector as a txt record (python dict) for dnssd.
+        This method describe the connector as a txt record (python dict) for
+        dnssd. The unix socket path, if any (see unix_socket), follows the tcp
+        port.
         """
         if record is None:
             record = {}
         if self.running == 0:
             raise RuntimeError("Cannot get txt record of an stopped connector")
-        record[self.name] = \
-                        ''.join([self.txt_prefix, TXT_SEPARATOR, str(self.tcp)])
+        value = [self.txt_prefix, TXT_SEPARATOR, str(self.tcp)]
+        if self.unix is not None:
+            value += [TXT_SEPARATOR, self.unix]
+        record[self.name] = ''.join(value)
         return record
 
 
@@ -322,6 +912,8 @@ class IConnector(Connector):
             logger.warning("Trying to send msg through an Input Only Connector")
         raise RuntimeError("Sending msg through an Input Connector")
 
+    send_many = send_deferred = send
+
     def connect(self, proxy, timeout = CONNECTION_TIMEOUT):
         """
         Verify the proxy is not another input connector which do not make any
@@ -342,11 +934,14 @@ class OConnector(Connector):
     """
     txt_prefix = OUTPUT_CONNECTOR_PREFIX
     xml_tag = XML_O_CONNECTOR_TAG
-    def received(self, msg):
+    def receivedBatch(self, msgs):
         """
-        Override the received function. Close connection on the client which
-        tries to send something to an output connector. Bad client ...
+        Override the receivedBatch function. Close connection on the client
+        which tries to send something to an output connector. Bad client ...
         """
+        for msg in msgs:
+            msg.release()
+        msg = msgs[0]
         if logger.isEnabledFor(logging.WARNING): 
             logger.warning("Receiving msg : Output Only Connector <closing>")
         if msg.peerid in self.peers:
@@ -372,6 +967,11 @@ class ControlConnector(Connector):
     query
     """
     name = "control"
+
+    # When both peers set binary_control, the control messages are sent with
+    # the compact binary encoding of controlcodec instead of XML.
+    binary_control = False
+
     def __init__(self):
         """
         Initialisation of the generator and the ControlDispatcher()
@@ -381,6 +981,29 @@ class ControlConnector(Connector):
         self.dispatcher = ControlEventDispatcher()
         self.dispatcher.control = weakref.ref(self)
 
+    def receivedBatch(self, msgs):
+        """
+        Override of the receivedBatch callback. The answers to our queries are
+        handled at once in the main thread by the control dispatcher, the
+        other messages go through the executor. An observer making a blocking
+        query from the executor would otherwise wait for an answer queued
+        behind itself.
+        """
+        others = []
+        for msg in msgs:
+            if (self.dispatcher is not None) and (msg.tag != FRAME_ZLIB) and \
+               controlcodec.is_answer(msg.data):
+                try:
+                    self.dispatcher.received(msg)
+                except Exception, err:
+                    logger.exception(str(err))
+                if self.buffer_pool is not None:
+                    msg.release()
+            else:
+                others.append(msg)
+        if len(others) != 0:
+            Connector.receivedBatch(self, others)
+
     def query(self, msg, peerid):
         """
         This method send a control query to the given peerid ( only if the connection
@@ -391,7 +1014,9 @@ class ControlConnector(Connector):
             logger.debug("Sending Query ... to %s" % str(peerid))
         qid = self.qid_generator.next()
         answer = self.dispatcher.addWaitingAnswer(qid, peerid)
-        self.send(CONTROL_QUERY % (qid, msg), peerid = peerid)
+        self.send(controlcodec.message(controlcodec.QUERY, qid, msg,
+                                       self.binaryControl(peerid)),
+                  peerid = peerid)
         return answer
 
     def answer(self, msg, qid, peerid):
@@ -401,7 +1026,9 @@ class ControlConnector(Connector):
         """
         if logger.isEnabledFor(logging.DEBUG):
             logger.debug("Sending Answer ... to %s" % str(peerid))
-        self.send(CONTROL_ANSWER % (qid, msg), peerid = peerid)
+        self.send(controlcodec.message(controlcodec.ANSWER, qid, msg,
+                                       self.binaryControl(peerid)),
+                  peerid = peerid)
 
     def event(self, msg, peerid):
         """
@@ -410,7 +1037,18 @@ class ControlConnector(Connector):
         """
         if logger.isEnabledFor(logging.DEBUG):
             logger.debug("Sending Event ... to %s" % str(peerid))
-        self.send(CONTROL_EVENT % (msg), peerid = peerid)
+        self.send(controlcodec.message(controlcodec.EVENT, 0, msg,
+                                       self.binaryControl(peerid)),
+                  peerid = peerid)
+
+    def binaryControl(self, peerid):
+        """
+        This method returns True if the binary control encoding is negotiated
+        with the peer.
+        """
+        protocol = self.peers.get(peerid, None)
+        return (protocol is not None) and \
+               (CONTROL_CAPABILITY in protocol.negotiated)
 
 
 class ConnectorProxy(object):
@@ -418,11 +1056,13 @@ class ConnectorProxy(object):
     This object represent a remote connector. It does nothing, it is just an
     container of some properties.
     """
-    xml_updatable = ['description', 'tcp', 'udp', 'peerId', 'peers', 'require']
+    xml_updatable = ['description', 'tcp', 'udp', 'unix', 'peerId', 'peers',
+                     'require']
 
     __peerid__ = None
     __tcp__ = None
     __udp__ = None
+    __unix__ = None
     __peers__ = []
 
     def __set_type__(self, value):
@@ -476,6 +1116,12 @@ class ConnectorProxy(object):
         return self.__udp__
     udp = property(__get_udp__, __set_udp__)
 
+    def __set_unix__(self, val):
+        self.__unix__ = None if val in [None, '', 'None'] else val
+    def __get_unix__(self):
+        return self.__unix__
+    unix = property(__get_unix__, __set_unix__)
+
 
 __unbound_control__ = ControlConnector()
 __unbound_control__.peerid = Peerid()
@@ -0,0 +1,124 @@
+#
+"""
+This module implements the compact binary encoding of the control protocol.
+It is used between two peers which both offered the binary control capability
+in the BIP handshake, XML stays the encoding of every other peer. A binary
+message starts with a marker byte which cannot start an XML document, so the
+dispatcher handles both encodings on the same connection.
+
+Layout : marker, kind, qid (0 for the events), operation and its fields.
+    OP_VALUE     the VARIABLE_EVENT_MSG body : name size, name, value
+    OP_REQUEST   a '<tag name="..."/>' body : tag size, tag, name
+    OP_XML       any other body, as XML
+
+The names and values are only sent raw if the XML parser would give them back
+unchanged (see controlparser), so both encodings decode to the same values.
+"""
+import struct
+
+from lxml import etree
+
+from controlparser import ControlElement, VALUE_HEAD, VALUE_MIDDLE, \
+                          VALUE_TAIL, VARIABLE_TAG, VALUE_TAG, NOT_PLAIN, \
+                          NOT_PLAIN_NAME
+
+from cstes import CONTROL_QUERY, \
+                  CONTROL_EVENT, \
+                  CONTROL_ANSWER, \
+                  CONTROL_QUERY_TAG, \
+                  CONTROL_EVENT_TAG, \
+                  CONTROL_ANSWER_TAG
+
+BINARY_MARKER = "\xb1"
+HEADER = struct.Struct("!cBIc") # marker, kind, qid, operation
+SIZE = struct.Struct("!H")
+
+QUERY, EVENT, ANSWER = range(3)
+OP_VALUE, OP_REQUEST, OP_XML = "v", "r", "x"
+
+kind_to_tag_map = {QUERY : CONTROL_QUERY_TAG,
+                   EVENT : CONTROL_EVENT_TAG,
+                   ANSWER : CONTROL_ANSWER_TAG}
+
+ANSWER_ROOT = '<' + CONTROL_ANSWER_TAG
+NAME_ATTRIBUTE = ' name="'
+REQUEST_TAIL = '"/>'
+
+def xml_message(kind, qid, body):
+    """
+    This function returns the XML control message.
+    """
+    if kind == EVENT:
+        return CONTROL_EVENT % body
+    if kind == QUERY:
+        return CONTROL_QUERY % (qid, body)
+    return CONTROL_ANSWER % (qid, body)
+
+def is_plain(name):
+    return NOT_PLAIN_NAME.search(name) is None
+
+def encode(kind, qid, body):
+    """
+    This function returns the binary control message.
+    """
+    if NOT_PLAIN.search(body) is not None:
+        return HEADER.pack(BINARY_MARKER, kind, qid, OP_XML) + body
+    if body.startswith(VALUE_HEAD) and body.endswith(VALUE_TAIL):
+        name, middle, value = body[len(VALUE_HEAD):
+                                   -len(VALUE_TAIL)].partition(VALUE_MIDDLE)
+        if middle and is_plain(name) and (']]>' not in value):
+            return ''.join([HEADER.pack(BINARY_MARKER, kind, qid, OP_VALUE),
+                            SIZE.pack(len(name)), name, value])
+    if body.startswith('<') and body.endswith(REQUEST_TAIL):
+        tag, attribute, name = body[1:-len(REQUEST_TAIL)].partition(
+                                                                NAME_ATTRIBUTE)
+        if attribute and tag.isalnum() and is_plain(name):
+            return ''.join([HEADER.pack(BINARY_MARKER, kind, qid, OP_REQUEST),
+                            SIZE.pack(len(tag)), tag, name])
+    return HEADER.pack(BINARY_MARKER, kind, qid, OP_XML) + body
+
+def message(kind, qid, body, binary = False):
+    """
+    This function returns the control message in the requested encoding.
+    """
+    if binary:
+        return encode(kind, qid, body)
+    return xml_message(kind, qid, body)
+
+def is_answer(data):
+    """
+    This function returns True if the control message, in any encoding, is an
+    answer. Only the root tag of an XML message is looked at.
+    """
+    if data[:1] == BINARY_MARKER:
+        return (len(data) > 1) and (ord(data[1]) == ANSWER)
+    start = 0
+    if data.startswith('<?'):
+        start = data.find('?>') + 2
+        if start == 1:
+            return False
+    while data[start:start + 1].isspace():
+        start += 1
+    return data.startswith(ANSWER_ROOT, start)
+
+def decode(data):
+    """
+    This function returns the root element of a binary control message, a
+    ControlElement or an lxml element for the XML bodies.
+    """
+    marker, kind, qid, operation = HEADER.unpack_from(data)
+    if operation == OP_XML:
+        return etree.fromstring(xml_message(kind, qid, data[HEADER.size:]))
+    size, = SIZE.unpack_from(data, HEADER.size)
+    start = HEADER.size + SIZE.size
+    first, second = data[start:start + size], data[start + size:]
+    if operation == OP_VALUE:
+        element = ControlElement(VARIABLE_TAG, {'name' : first},
+                            children = (ControlElement(VALUE_TAG, {}, second),))
+    elif operation == OP_REQUEST:
+        element = ControlElement(first, {'name' : second})
+    else:
+        raise ValueError("Unknown binary control operation %r" % operation)
+    attrib = {} if kind == EVENT else {'id' : "%08.x" % qid}
+    return ControlElement(kind_to_tag_map[kind], attrib,
+                          children = (element,))
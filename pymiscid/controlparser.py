@@ -0,0 +1,103 @@
+#
+"""
+This module is the fast path of the control message parser. The variable
+events, the bulk of the control traffic, and the queries setting a variable
+are always built from the VARIABLE_EVENT_MSG template of cstes. They are
+recognized with a few string operations and returned as small ControlElement
+trees offering the part of the lxml element interface used by the dispatcher.
+Anything else gives None and must go through lxml, which is faster than python
+code on the other messages (see tools/bench/control.py). So do the messages
+holding a byte lxml would not give back as is : a carriage return (the line
+endings are normalised), a control character or a non ASCII byte (the text is
+decoded to unicode).
+"""
+import re
+
+from cstes import CONTROL_QUERY, \
+                  CONTROL_EVENT, \
+                  CONTROL_QUERY_TAG, \
+                  CONTROL_EVENT_TAG, \
+                  VARIABLE_EVENT_MSG
+
+# wrappers head and tail, the qid follows the head of the queries
+EVENT_HEAD, EVENT_TAIL = CONTROL_EVENT.split('%s')
+QUERY_HEAD, QUERY_TAIL = CONTROL_QUERY.split('%s')
+QUERY_HEAD = QUERY_HEAD.split('%')[0]
+QID_SIZE = len("%08.x" % 0)
+QID_END = '">'
+
+# VARIABLE_EVENT_MSG : head, name, middle, value, tail
+VALUE_HEAD, VALUE_MIDDLE, VALUE_TAIL = VARIABLE_EVENT_MSG.split('%s')
+VARIABLE_TAG = VALUE_HEAD[1:VALUE_HEAD.index(' ')]
+VALUE_TAG = 'value'
+EVENT_END = VALUE_TAIL + EVENT_TAIL
+QUERY_END = VALUE_TAIL + QUERY_TAIL
+
+# the bytes lxml gives back unchanged in a text, and the ones an attribute
+# value is not given back with (its whitespaces are normalised to spaces)
+NOT_PLAIN = re.compile('[^\t\n\x20-\x7f]')
+NOT_PLAIN_NAME = re.compile('[\t\n"&<]')
+
+
+class ControlElement(object):
+    """
+    A light element : tag, attrib, text and children.
+    """
+    __slots__ = ['tag', 'attrib', 'text', 'children']
+
+    def __init__(self, tag, attrib, text = None, children = ()):
+        self.tag = tag
+        self.attrib = attrib
+        self.text = text
+        self.children = children
+
+    def getchildren(self):
+        return list(self.children)
+
+    def find(self, tag):
+        for child in self.children:
+            if child.tag == tag:
+                return child
+        return None
+
+    def findall(self, tag):
+        return [child for child in self.children if child.tag == tag]
+
+    def __iter__(self):
+        return iter(self.children)
+
+    def __getitem__(self, index):
+        return self.children[index]
+
+    def __len__(self):
+        return len(self.children)
+
+
+def parse(data):
+    """
+    This function returns the root ControlElement of a variable event or of a
+    variable query carrying a value, or None for any other message.
+    """
+    if data.startswith(EVENT_HEAD):
+        start, end = len(EVENT_HEAD), EVENT_END
+        tag, attrib = CONTROL_EVENT_TAG, {}
+    elif data.startswith(QUERY_HEAD):
+        start, end = len(QUERY_HEAD) + QID_SIZE + len(QID_END), QUERY_END
+        if data[start - len(QID_END):start] != QID_END:
+            return None
+        tag = CONTROL_QUERY_TAG
+        attrib = {'id' : data[len(QUERY_HEAD):start - len(QID_END)]}
+    else:
+        return None
+    if not (data.startswith(VALUE_HEAD, start) and data.endswith(end)) or \
+       (NOT_PLAIN.search(data) is not None):
+        return None
+    name, middle, value = data[start + len(VALUE_HEAD):
+                               -len(end)].partition(VALUE_MIDDLE)
+    if (not middle) or (NOT_PLAIN_NAME.search(name) is not None) or \
+       (']]>' in value):
+        return None
+    variable = ControlElement(VARIABLE_TAG, {'name' : name},
+                              children = (ControlElement(VALUE_TAG, {},
+                                                         value),))
+    return ControlElement(tag, attrib, children = (variable,))
@@ -3,6 +3,7 @@
 This modules defines de principal constants used during OMiSCID runtime
 """
 import os
+import tempfile
 import xsd
 import logging
 
@@ -82,6 +83,19 @@ PEERID = "%08.x"
 QUERY_TIMEOUT = 5 #seconds
 CONNECTION_TIMEOUT = 5 #seconds
 PROXY_DISCONNECT_TIMEOUT = 5
+RECONNECT_DELAY = 0.1 # seconds, doubled on every failed attempt
+RECONNECT_MAX_DELAY = 10 # seconds
+RECONNECT_JITTER = 0.5 # part of the delay drawn at random
+CONTROL_LINKS_MAX = 64 # open control connections to remote services
+DISPATCH_WORKERS = 1
+DISPATCH_QUEUE_SIZE = 1024
+STREAM_THRESHOLD = 1024 * 1024 # bytes
+COMPRESSION_THRESHOLD = 4096 # bytes
+COMPRESSION_LEVEL = 6
+DECOMPRESSION_MAX_SIZE = 64 * 1024 * 1024 # bytes of a decompressed message
+UNIX_SOCKET_DIRECTORY = os.environ.get("OMISCID_UNIX_SOCKET_DIRECTORY",
+                                       tempfile.gettempdir())
+UNIX_SOCKET_TEMPLATE = "pymiscid-%d-%d.sock" # pid, tcp port
 
 OUTPUT_CONNECTOR_TYPE = OUTPUT_CONNECTOR_PREFIX[0]
 INPUT_CONNECTOR_TYPE = INPUT_CONNECTOR_PREFIX[0]
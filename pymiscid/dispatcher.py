@@ -25,6 +25,9 @@ from cstes import QUERY_TIMEOUT, \
                   VARIABLE_EVENT_MSG
 
 from bip.protocol import PeerError, Peerid
+from bip.wheel import timer_wheel
+import controlparser
+import controlcodec
 
 logger = logging.getLogger(__name__)
 
@@ -32,10 +35,49 @@ logger = logging.getLogger(__name__)
 class BasicEventDispatcher(events.MutexedEventDispatcher):
     """
     This object is the basic event dispatcher for the three standards connector
-    events.
+    events. It also provides the receivedBatch event which delivers, as a list,
+    every message decoded in one read. Observer objects are registered for it
+    only if they have a receivedBatch method.
     """
     events = ['connected', 'disconnected', 'received']
 
+    def __init__(self, *args, **kw):
+        """
+        Standard events and receivedBatch event initialisation.
+        """
+        events.MutexedEventDispatcher.__init__(self, *args, **kw)
+        self.receivedBatchEvent = events.MutexedEvent(self.mutex)
+        self.receivedBatchEvent.name = 'receivedBatch'
+
+    def addObserver(self, obj, *args, **kw):
+        """
+        Add the right method observer to the contained events.
+        """
+        oid = events.MutexedEventDispatcher.addObserver(self, obj, *args, **kw)
+        if hasattr(obj, 'receivedBatch'):
+            self.receivedBatchEvent.addObserver(obj.receivedBatch, *args,
+                                                oid = oid)
+        return oid
+
+    def removeObserver(self, oid):
+        """
+        Remove the right method observer to the contained events.
+        """
+        for evt in self.events + ['receivedBatch']:
+            getattr(self, evt + "Event").observers.pop(oid, None)
+
+    def dispatchBatch(self, msgs):
+        """
+        This method fires the receivedBatch event once with the whole list and
+        the received event for each message. Events without observer are
+        skipped.
+        """
+        if len(self.receivedBatchEvent) != 0:
+            self.receivedBatchEvent(msgs)
+        if len(self.receivedEvent) != 0:
+            for msg in msgs:
+                self.receivedEvent(msg)
+
 
 class ControlEventDispatcher(BasicEventDispatcher):
     """
@@ -45,6 +87,7 @@ class ControlEventDispatcher(BasicEventDispatcher):
     __qtimeout__ = QUERY_TIMEOUT
     service = None
     control = None
+    clock = reactor
 
     def __init__(self):
         BasicEventDispatcher.__init__(self)
@@ -85,12 +128,12 @@ class ControlEventDispatcher(BasicEventDispatcher):
         This method is ussed to create the defered object and add the it
         to the waiting list. This method is normally called by the connector
         when a query is made to create the right defered and to return it to
-        the caller.
+        the caller. The timeout is cancelled with the answer.
         """
         answer  = defer.Deferred()
         self.deferred_answers[peerid][qid] = answer
-        reactor.callLater(self.__qtimeout__, self.__query_timedout__,  qid,
-                          peerid)
+        answer.timer = timer_wheel(self.clock).callLater(self.__qtimeout__,
+                                        self.__query_timedout__, qid, peerid)
         return answer
 
     def connected(self, peerid):
@@ -106,7 +149,11 @@ class ControlEventDispatcher(BasicEventDispatcher):
         """
         while len(self.deferred_answers[peerid]) != 0:
             qid, deferred = self.deferred_answers[peerid].popitem()
+            deferred.timer.cancel()
             deferred.errback(RuntimeError("Connection Lost"))
+        proxy = self.proxys.get(peerid, None)
+        if (proxy is not None) and (proxy() is not None):
+            proxy().disconnected()
         while len(self.remote_observers[peerid]) != 0:
             vname, oid = self.remote_observers[peerid].popitem()
             var = self.service().variables[vname]
@@ -167,17 +214,21 @@ class ControlEventDispatcher(BasicEventDispatcher):
             logger.debug("Query Received " + msg.data)
 
         if self.service is not None:
-            real_query = root.getchildren()[0]
             qid = int(root.attrib['id'], 16)
-            try:
-                answer = self.query_dispatch_table[real_query.tag](self, real_query, msg)
-                if answer is not None:
-                    self.control().answer(answer, qid, msg.peerid)
-            except KeyError, err:
-                if logger.isEnabledFor(logging.WARNING): 
-                    logger.warning('Unknown Control Type (%s): peerid %08.x' 
-                                   % (root.tag, msg.peerid))
-                logger.exception(str(err))
+            answers = []
+            for real_query in root.getchildren():
+                try:
+                    answer = self.query_dispatch_table[real_query.tag](self, real_query, msg)
+                    if answer is not None:
+                        answers.append(answer)
+                except KeyError, err:
+                    if logger.isEnabledFor(logging.WARNING): 
+                        logger.warning('Unknown Control Type (%s): peerid %08.x' 
+                                       % (real_query.tag, msg.peerid))
+                    logger.exception(str(err))
+            # a query may hold several requests, they get a single answer
+            if len(answers) != 0:
+                self.control().answer(''.join(answers), qid, msg.peerid)
 
     def dispatchEvent(self, root, msg):
         """
@@ -197,14 +248,21 @@ class ControlEventDispatcher(BasicEventDispatcher):
 
     def dispatchAnswer(self, root, msg):
         """
-        This method is intended to dispatch the answer for a query.
+        This method is intended to dispatch the answer for a query. The
+        deferred of the query fires in the thread of the clock (the main
+        thread), as its timeout, whatever the thread of the dispatch.
         """
         if logger.isEnabledFor(logging.DEBUG):
             logger.debug("Query Answer")
-        qid = Peerid(root.attrib['id'])
-        if qid in self.deferred_answers[msg.peerid]:
-            answer = self.deferred_answers[msg.peerid].pop(qid)
-            answer.callback(root.getchildren())
+        self.clock.callFromThread(self.__answered__, Peerid(root.attrib['id']),
+                                  msg.peerid, root.getchildren())
+
+    def __answered__(self, qid, peerid, elements):
+        answers = self.deferred_answers.get(peerid, {})
+        if qid in answers:
+            answer = answers.pop(qid)
+            answer.timer.cancel()
+            answer.callback(elements)
         else:
             if logger.isEnabledFor(logging.WARNING):
                 logger.warning('UnRequested or TimedOut Answer : qid.%08.x' 
@@ -213,11 +271,19 @@ class ControlEventDispatcher(BasicEventDispatcher):
     def received(self, msg):
         """
         This method is the main dispatcher for the types of query defined by the
-        root tag of the xml tree.
+        root tag of the xml tree. The binary messages are decoded by
+        controlcodec, the XML ones following the control templates are parsed
+        by the controlparser fast path and the others by lxml.
         """
         if logger.isEnabledFor(logging.DEBUG):
-            logger.debug("ctrl msg received <%d>: %s" % (msg.peerid, msg.data))
-        root = etree.fromstring(msg.data)
+            logger.debug("ctrl msg received <%d>: %r" % (msg.peerid, msg.data))
+        data = msg.data
+        if data[:1] == controlcodec.BINARY_MARKER:
+            root = controlcodec.decode(data)
+        else:
+            root = controlparser.parse(data)
+            if root is None:
+                root = etree.fromstring(data)
         try:
             self.dispatch_table[root.tag](self, root, msg)
         except KeyError, err:
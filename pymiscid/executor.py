@@ -0,0 +1,118 @@
+#
+"""
+This module defines the dispatch executor of the connectors. It replaces the
+shared twisted threadpool for the received messages : every connector owns its
+workers, the messages of a peer are always handled by the same worker so they
+keep their order and the number of pending messages is bounded.
+"""
+from __future__ import with_statement
+import logging
+import threading
+import Queue
+
+from twisted.internet import reactor
+
+from cstes import DISPATCH_WORKERS, \
+                  DISPATCH_QUEUE_SIZE
+
+logger = logging.getLogger(__name__)
+
+INLINE = 0
+
+class DispatchExecutor(object):
+    """
+    This object runs the callbacks of a connector. With workers set to INLINE,
+    the callbacks run directly in the main thread, for ultra low latency
+    handlers which must be quick and succint. Otherwise, when queue_size
+    messages are pending, the peer which submits is not read anymore (see
+    BIPBaseProtocol.pauseReading) until the workers have processed half of the
+    queue.
+    """
+    def __init__(self, workers = DISPATCH_WORKERS,
+                 queue_size = DISPATCH_QUEUE_SIZE):
+        """
+        Simple init, the worker threads are started on the first submit.
+        """
+        self.workers = workers
+        self.queue_size = queue_size
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.queues = []
+        self.threads = []
+        self.paused = {}
+
+    def start(self):
+        """
+        This method starts the worker threads.
+        """
+        for i in xrange(self.workers):
+            queue = Queue.Queue()
+            thread = threading.Thread(target = self.__work__, args = (queue,),
+                                      name = "dispatch-%d" % i)
+            thread.setDaemon(True)
+            self.queues.append(queue)
+            self.threads.append(thread)
+            thread.start()
+
+    def stop(self):
+        """
+        This method stops the worker threads once their queue is processed.
+        """
+        for queue in self.queues:
+            queue.put(None)
+        self.queues = []
+        self.threads = []
+
+    def submit(self, protocol, fct, *args):
+        """
+        This method is called in the main thread to run fct(*args) on behalf of
+        the peer of the given protocol.
+        """
+        if self.workers == INLINE:
+            try:
+                fct(*args)
+            except Exception, err:
+                logger.exception(str(err))
+            return
+        if len(self.queues) == 0:
+            self.start()
+        with self.lock:
+            self.pending += 1
+            full = self.pending >= self.queue_size
+        if full and (protocol is not None) and (protocol not in self.paused):
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Dispatch queue full, pausing %s" %
+                             str(protocol.rpeerid))
+            self.paused[protocol] = True
+            protocol.pauseReading()
+        key = 0 if protocol is None else protocol.rpeerid
+        self.queues[hash(key) % len(self.queues)].put((fct, args))
+
+    def __work__(self, queue):
+        """
+        Worker thread main loop.
+        """
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            fct, args = item
+            try:
+                fct(*args)
+            except Exception, err:
+                logger.exception(str(err))
+            with self.lock:
+                self.pending -= 1
+                resume = (self.pending == self.queue_size / 2) and \
+                         (len(self.paused) != 0)
+            if resume:
+                reactor.callFromThread(self.__resume__)
+
+    def __resume__(self):
+        """
+        This method resumes the transports paused by a full queue.
+        """
+        paused, self.paused = self.paused, {}
+        for protocol in paused:
+            if getattr(protocol.transport, 'connected', False):
+                protocol.resumeReading()
@@ -0,0 +1,187 @@
+#
+"""
+This module runs several asyncio event loops, each in its own thread, so the
+framing and the sends of busy connectors are spread over several loops. The
+calls made from another thread are routed to the loop of the connector.
+Python threads share the GIL, the gain comes from the time spent outside of
+the interpreter (socket syscalls, zlib, memory copies) and from the isolation
+of the slow connectors.
+"""
+from __future__ import with_statement
+import time
+import threading
+import weakref
+import logging
+
+from bip.aio import asyncio
+
+logger = logging.getLogger(__name__)
+
+LOOP_PROBE_INTERVAL = 1. # seconds
+
+class LoopThread(object):
+    """
+    This object is an event loop running in its own thread. It keeps the
+    connectors assigned to it and some metrics.
+    """
+    def __init__(self, name):
+        """
+        Loop and metrics initialisation, the thread is started by start.
+        """
+        self.name = name
+        self.loop = asyncio.new_event_loop()
+        self.thread = None
+        self.connectors = weakref.WeakValueDictionary()
+        self.routed = 0
+        self.lag = 0.
+
+    def start(self):
+        """
+        This method starts the thread of the loop.
+        """
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target = self.__run__, name = self.name)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def __run__(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(self.__probe__, time.time())
+        self.loop.run_forever()
+
+    def __probe__(self, expected):
+        """
+        Measures how late the loop runs its callbacks.
+        """
+        now = time.time()
+        self.lag = max(now - expected, 0.)
+        self.loop.call_later(LOOP_PROBE_INTERVAL, self.__probe__,
+                             now + LOOP_PROBE_INTERVAL)
+
+    def stop(self):
+        """
+        This method stops the loop and waits for its thread.
+        """
+        if self.thread is None:
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        if not self.inLoop():
+            self.thread.join()
+        self.thread = None
+
+    def inLoop(self):
+        """
+        This method returns True if called from the thread of the loop.
+        """
+        return threading.currentThread() is self.thread
+
+    def call(self, fct, *args):
+        """
+        This method runs fct(*args) in the loop, directly if we already are in
+        its thread.
+        """
+        if self.inLoop():
+            fct(*args)
+        else:
+            self.routed += 1
+            self.loop.call_soon_threadsafe(fct, *args)
+
+    def blockingCall(self, fct, *args):
+        """
+        This method runs fct(*args) in the loop and returns its result. If the
+        result is a future, it waits for its result.
+        """
+        if self.inLoop():
+            return fct(*args)
+        done = threading.Event()
+        outcome = []
+        def finished(future):
+            outcome.append((future.exception(), None if future.exception()
+                            else future.result()))
+            done.set()
+        def run():
+            try:
+                result = fct(*args)
+            except Exception, err:
+                outcome.append((err, None))
+                done.set()
+                return
+            if isinstance(result, asyncio.Future):
+                result.add_done_callback(finished)
+            else:
+                outcome.append((None, result))
+                done.set()
+        self.routed += 1
+        self.loop.call_soon_threadsafe(run)
+        done.wait()
+        err, result = outcome[0]
+        if err is not None:
+            raise err
+        return result
+
+    def assign(self, connector):
+        """
+        This method registers a connector running in this loop.
+        """
+        self.connectors[id(connector)] = connector
+
+    def metrics(self):
+        """
+        This method returns the metrics of the loop : received messages,
+        frames sent (written to the transports of the peers), messages routed
+        from other threads and scheduling lag.
+        """
+        connectors = self.connectors.values()
+        return {'name' : self.name,
+                'connectors' : len(connectors),
+                'peers' : sum([len(c.peers) for c in connectors]),
+                'received' : sum([c.received_count for c in connectors]),
+                'sent' : sum([c.sent_count for c in connectors]),
+                'routed' : self.routed,
+                'lag' : self.lag}
+
+
+class LoopGroup(object):
+    """
+    This object is a group of loop threads. The connectors are assigned to the
+    least loaded loop.
+    """
+    def __init__(self, size = 2, name = "loop"):
+        """
+        Creation of the loops, they are started on the first use.
+        """
+        self.loops = [LoopThread("%s-%d" % (name, i)) for i in xrange(size)]
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.loops)
+
+    def start(self):
+        """
+        This method starts every loop of the group.
+        """
+        with self.lock:
+            for loop in self.loops:
+                loop.start()
+
+    def stop(self):
+        """
+        This method stops every loop of the group.
+        """
+        with self.lock:
+            for loop in self.loops:
+                loop.stop()
+
+    def pick(self, count = 1):
+        """
+        This method returns the count least loaded loops.
+        """
+        loops = sorted(self.loops, key = lambda l: len(l.connectors))
+        return loops[:count]
+
+    def metrics(self):
+        """
+        This method returns the list of the metrics of every loop.
+        """
+        return [loop.metrics() for loop in self.loops]
@@ -18,6 +18,10 @@ import thread
 
 # Import some interesting omiscid type
 from connector import INPUT, OUTPUT, INOUTPUT
+from bip.flow import BLOCK, DROP_OLDEST, DROP_NEWEST, DISCONNECT
+from executor import INLINE
+from bip.pool import BufferPool
+from service import ControlLinkPool
 from variable import CONSTANT, READ_WRITE, READ
 from filters import *
 
@@ -5,17 +5,22 @@ This module add defines every Service objects necessary for OMiSCID.
 from __future__ import with_statement
 import logging
 import weakref
+import threading
 import copy
 
+from collections import OrderedDict
+
 import variable, connector
 import codebench.generator as generator
 import codebench.xml as xml
 
 from twisted.application import service
-from twisted.internet import threads, reactor
+from twisted.internet import threads, reactor, defer
+from twisted.python import failure
 from bonjour import BonjourServicePublisher
 
 from bip.protocol import Peerid, peerid_generator_factory
+from bip.wheel import timer_wheel
 
 from cstes import DESCRIPTION_VARIABLE_NAME, \
                   FULL_DESCRIPTION_VALUE, \
@@ -26,7 +31,8 @@ from cstes import DESCRIPTION_VARIABLE_NAME, \
                   REQUEST_CONTROL_QUERY, \
                   VARIABLE_SUBSCRIBE, \
                   VARIABLE_UNSUBSCRIBE, \
-                  PROXY_DISCONNECT_TIMEOUT
+                  PROXY_DISCONNECT_TIMEOUT, \
+                  CONTROL_LINKS_MAX
 
 logger = logging.getLogger(__name__) 
 
@@ -141,42 +147,231 @@ class ServiceBase(ServiceCommon):
 
 
 
+class ControlLink(object):
+    """
+    This object is the state of a control connection in the ControlLinkPool.
+    While the link connects, waiters holds the deferreds of the leases waiting
+    for the connection.
+    """
+    def __init__(self, proxy):
+        self.proxy = weakref.ref(proxy)
+        self.leases = 0
+        self.timer = None
+        self.waiters = None
+        self.lock = threading.Lock()
+
+
+class ControlLinkPool(object):
+    """
+    This object keeps the control connections to the remote services open
+    between the queries. A lease connects as needed, a released link stays open
+    until it has been idle for idle_timeout seconds or until room is needed for
+    a new one : at most max_links links are open, the least recently used idle
+    link is closed first. Every method is thread safe.
+    """
+    def __init__(self, max_links = CONTROL_LINKS_MAX,
+                 idle_timeout = PROXY_DISCONNECT_TIMEOUT):
+        """
+        Links and statistics initialisation.
+        """
+        self.max_links = max_links
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.links = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __alive__(self, proxy):
+        return proxy.linked and (proxy.peerid in proxy.control.peers)
+
+    def __close__(self, link):
+        """
+        Must be called with the lock held.
+        """
+        if link.timer is not None:
+            link.timer.cancel()
+            link.timer = None
+        proxy = link.proxy()
+        if proxy is None:
+            return
+        if proxy.linked:
+            proxy.disconnect()
+        elif proxy.reconnect:
+            # stops the reconnection of the link
+            proxy.control.disconnect(proxy.peerid)
+
+    def __make_room__(self):
+        """
+        Closes the least recently used idle links until a new link fits. Must
+        be called with the lock held.
+        """
+        for peerid, link in self.links.items():
+            if len(self.links) < self.max_links:
+                return
+            if link.leases == 0:
+                del self.links[peerid]
+                self.evictions += 1
+                self.__close__(link)
+        if len(self.links) >= self.max_links:
+            raise RuntimeError("Too many control links in use (%d)"
+                               % self.max_links)
+
+    def __take__(self, proxy):
+        """
+        Counts a lease on the link of the proxy and returns the link.
+        """
+        with self.lock:
+            link = self.links.pop(proxy.peerid, None)
+            if (link is not None) and self.__alive__(proxy):
+                self.hits += 1
+            else:
+                self.misses += 1
+                if link is None:
+                    self.__make_room__()
+                    link = ControlLink(proxy)
+            link.leases += 1
+            if link.timer is not None:
+                link.timer.cancel()
+                link.timer = None
+            self.links[proxy.peerid] = link
+            return link
+
+    def lease(self, proxy):
+        """
+        This method leases the link to the proxy, connecting it as needed. It
+        returns True if a connection has been made. This is blocking so dont
+        call it from the mainthread.
+        """
+        return threads.blockingCallFromThread(reactor, self.lease_deferred,
+                                              proxy)
+
+    def lease_deferred(self, proxy):
+        """
+        This method is the non blocking version of lease, to be called from
+        the main thread. It returns a deferred which fires with True if this
+        lease made the connection. The leases taken while the link connects
+        wait for the same connection.
+        """
+        link = self.__take__(proxy)
+        lease = defer.Deferred()
+        lease.addErrback(self.__lease_failed__, proxy)
+        with link.lock:
+            if link.waiters is not None:
+                link.waiters.append(lease)
+                return lease
+            if self.__alive__(proxy):
+                lease.callback(False)
+                return lease
+            link.waiters = [lease]
+        if proxy.linked:
+            proxy.disconnected()
+        connection = defer.maybeDeferred(proxy.__connection__)
+        connection.addBoth(self.__connection_done__, link)
+        return lease
+
+    def __connection_done__(self, result, link):
+        """
+        Fires the leases waiting for the connection of the link.
+        """
+        with link.lock:
+            waiters, link.waiters = link.waiters, None
+        for i, lease in enumerate(waiters):
+            if isinstance(result, failure.Failure):
+                lease.errback(result)
+            else:
+                lease.callback(i == 0)
+
+    def __lease_failed__(self, reason, proxy):
+        self.release(proxy)
+        return reason
+
+    def release(self, proxy):
+        """
+        This method gives back a leased link, it stays open for a while.
+        """
+        with self.lock:
+            link = self.links.get(proxy.peerid, None)
+            if (link is None) or (link.leases == 0):
+                return
+            link.leases -= 1
+            if link.leases != 0:
+                return
+            link.timer = timer_wheel().callLater(self.idle_timeout,
+                                        self.__expire__, proxy.peerid, link)
+
+    def __expire__(self, peerid, link):
+        """
+        Closes a link idle for idle_timeout seconds, runs in the main thread.
+        """
+        with self.lock:
+            if (self.links.get(peerid, None) is link) and (link.leases == 0):
+                del self.links[peerid]
+                self.__close__(link)
+
+    def discard(self, proxy):
+        """
+        This method closes the link to a proxy if it is not leased.
+        """
+        with self.lock:
+            link = self.links.get(proxy.peerid, None)
+            if (link is not None) and (link.leases == 0):
+                del self.links[proxy.peerid]
+                self.__close__(link)
+
+    def stats(self):
+        """
+        This method returns the number of open, leased and idle links, and the
+        hits, misses and evictions counters.
+        """
+        with self.lock:
+            leased = len([l for l in self.links.itervalues() if l.leases != 0])
+            return {'open' : len(self.links),
+                    'leased' : leased,
+                    'idle' : len(self.links) - leased,
+                    'max_links' : self.max_links,
+                    'hits' : self.hits,
+                    'misses' : self.misses,
+                    'evictions' : self.evictions}
+
+
 class ProxySupervisor(object):
     """
     This object supervise the access to online attribute of a service proxy.
     Each method which access online attributes should either  : 
         1 - bound the access with a call to acquire/release method
         2 - use a python with statement
+    The control connection itself is leased from the ControlLinkPool of the
+    proxy.
     """
-    count = 0
     def __init__(self, proxy):
         self.proxy = weakref.ref(proxy)
 
     def acquire(self):
         """
-        This method connect as needed to the remote service and increment the
-        service count.
+        This method leases the control link to the remote service, and
+        updates its description if it is unknown.
         """
         proxy = self.proxy()
         if not proxy.alive:
             raise RuntimeError("this proxy ain't no more ...")
 
-        self.count += 1
-        if self.count == 1:
-            proxy.connect()
-            if not proxy.resolved:
+        proxy.links.lease(proxy)
+        if not proxy.resolved:
+            try:
                 proxy.update_description()
+            except Exception:
+                proxy.links.release(proxy)
+                raise
 
     def release(self):
         """
-        This method decrement the reference counter and disconnect as needed. To
-        ensure we do not reconnect to often. There is a delay between the
-        release method call and the real deconnection.
+        This method gives back the control link. The pool keeps it open for a
+        while so we do not reconnect to often.
         """
-        if self.count == 1:
-            reactor.callLater(PROXY_DISCONNECT_TIMEOUT, self.__close__)
-        else:
-            self.count -= 1
+        proxy = self.proxy()
+        if proxy is not None:
+            proxy.links.release(proxy)
 
     def __enter__(self):
         self.acquire()
@@ -184,13 +379,6 @@ class ProxySupervisor(object):
     def __exit__(self, typ, value, traceback):
         self.release()
 
-    def __close__(self):
-        if self.count == 1:
-            proxy = self.proxy()
-            if proxy is not None:
-                proxy.disconnect()
-        self.count -= 1
-
 
 class VariableSupervisor(object):
     """
@@ -212,7 +400,7 @@ class VariableSupervisor(object):
         if self.count == 0:
             proxy = self.psupervisor.proxy()
             proxy.control.query(VARIABLE_SUBSCRIBE % self.vname, proxy.peerid)
-        self.count += 0
+        self.count += 1
 
     def release(self):
         """
@@ -221,7 +409,8 @@ class VariableSupervisor(object):
         self.count -= 1
         if self.count == 0:
             proxy = self.psupervisor.proxy()
-            proxy.query(VARIABLE_UNSUBSCRIBE % self.vname, proxy.peerid)
+            proxy.control.query(VARIABLE_UNSUBSCRIBE % self.vname,
+                                proxy.peerid)
         self.psupervisor.release()
 
 
@@ -233,6 +422,15 @@ class ServiceProxy(ServiceCommon):
     resolved = False
     alive = True
     linked = False
+    links = ControlLinkPool()
+
+    # When set, a lost control link is reopened by the control connector and
+    # the variable subscriptions are replayed, see ReconnectingLink.
+    reconnect = False
+
+    # deferreds waiting for the description query in flight, see __described__
+    describing = None
+
     def __init__(self, peerid, host, addr, port, ahost = None):
         """
         Init method
@@ -259,12 +457,13 @@ class ServiceProxy(ServiceCommon):
         self.vsupervisors[name] = VariableSupervisor(name, self.supervisor)
         var.valueProxyEvent.addObserver(self.__variable_proxy_changed__, name)
 
-    def __add_connector__(self, name, con_type, tcp = None):
+    def __add_connector__(self, name, con_type, tcp = None, unix = None):
         """
         Internally used method to create a ConnectorProxy inside a serviceproxy
         """
         con = connector.ConnectorProxy(name, self.addr)
         con.tcp = tcp
+        con.unix = unix
         con.type = con_type
         con.host = self.host
         self.connectors[name] = con
@@ -300,7 +499,9 @@ class ServiceProxy(ServiceCommon):
                 val = val + '/'
             con_type, tcp = val.split('/', 1)
             if con_type in connector.txt_to_connector_type_map:
-                self.__add_connector__(key, con_type, tcp = int(tcp))
+                tcp, unix = (tcp.split('/', 1) + [None])[:2]
+                self.__add_connector__(key, con_type, tcp = int(tcp),
+                                       unix = unix)
             else:
                 self.__add_variable__(key, con_type, tcp)
 
@@ -331,14 +532,66 @@ class ServiceProxy(ServiceCommon):
         assured that the description is up to date. Throws an exception if no
         answer.
         """
-        with self.supervisor:
-            if logger.isEnabledFor(logging.DEBUG):
-                    logger.debug("Thread blocking function called")
-            element = threads.blockingCallFromThread(reactor,
-                                                     self.control.query,
-                                                     SERVICE_FULL_DESCRIPTION,
-                                                     self.peerid)
-            self.update(element)
+        if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Thread blocking function called")
+        threads.blockingCallFromThread(reactor, self.queryDescription)
+
+    def __leased__(self, describe, fct, *args):
+        """
+        Calls fct(*args) in the main thread once the control link is leased
+        and gives it back when the deferred returned by fct fires. The
+        description is updated first if it is unknown and describe is set.
+        """
+        if not self.alive:
+            return defer.fail(RuntimeError("this proxy ain't no more ..."))
+        def leased(connected):
+            if describe and not self.resolved:
+                res = self.__described__()
+                res.addCallback(lambda proxy: fct(*args))
+            else:
+                res = defer.maybeDeferred(fct, *args)
+            res.addBoth(self.__released__)
+            return res
+        lease = defer.maybeDeferred(self.links.lease_deferred, self)
+        return lease.addCallback(leased)
+
+    def __released__(self, result):
+        self.links.release(self)
+        return result
+
+    def __description_query__(self):
+        answer = self.control.query(SERVICE_FULL_DESCRIPTION, self.peerid)
+        answer.addCallback(self.update)
+        return answer
+
+    def __described__(self):
+        """
+        Returns a deferred which fires once the description is up to date, the
+        concurrent calls share a single description query.
+        """
+        described = defer.Deferred()
+        if self.describing is None:
+            self.describing = [described]
+            self.__description_query__().addBoth(self.__description_done__)
+        else:
+            self.describing.append(described)
+        return described
+
+    def __description_done__(self, result):
+        waiters, self.describing = self.describing, None
+        for described in waiters:
+            if isinstance(result, failure.Failure):
+                described.errback(result)
+            else:
+                described.callback(result)
+
+    def queryDescription(self):
+        """
+        This method is the non blocking version of update_description, to be
+        called from the main thread. It returns a deferred which fires with
+        the proxy once its description is up to date.
+        """
+        return self.__leased__(False, self.__described__)
 
     def connect(self):
         """
@@ -352,6 +605,22 @@ class ServiceProxy(ServiceCommon):
         self.control.connect(self)
         self.linked = True
 
+    def __connection__(self):
+        """
+        This method is the non blocking version of connect, to be called from
+        the main thread. It returns a deferred which fires once connected.
+        """
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Proxy Connection to the service : %s" 
+                        % str(self.peerid))
+        connection = self.control.__connection__(self)
+        connection.addCallback(self.__connected__)
+        return connection
+
+    def __connected__(self, result):
+        self.linked = True
+        return result
+
     def disconnect(self):
         """
         Force the disconnection of the proxy
@@ -370,6 +639,29 @@ class ServiceProxy(ServiceCommon):
         """
         self.linked = False
 
+    def reconnected(self):
+        """
+        Callback from the reconnecting link of the control connector, in the
+        main thread. The variable subscriptions are replayed and their answers
+        bring the values up to date.
+        """
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Proxy reconnected to the service : %s"
+                        % str(self.peerid))
+        self.linked = True
+        for vname, vsupervisor in self.vsupervisors.items():
+            if vsupervisor.count > 0:
+                answer = self.control.query(VARIABLE_SUBSCRIBE % vname,
+                                            self.peerid)
+                answer.addCallbacks(self.update, self.__resubscribe_failed__,
+                                    errbackArgs = (vname,))
+
+    def __resubscribe_failed__(self, failure, vname):
+        if logger.isEnabledFor(logging.WARNING):
+            logger.warning("Cannot resubscribe to %s of %s : %s"
+                           % (vname, str(self.peerid),
+                              failure.getErrorMessage()))
+
     def update(self, elements):
         """
         This method update the service proxy variables or connector description
@@ -384,6 +676,7 @@ class ServiceProxy(ServiceCommon):
                 else:
                     self.__add_connector__(name, child.tag)
             xml.Marshall.update(ServiceCommon.__getattr__(self, name), child)
+        return self
 
     def getVariableValue(self, vname):
         """
@@ -393,17 +686,86 @@ class ServiceProxy(ServiceCommon):
         """
         var = self.variables[vname]
         if (var.access_type is variable.CONSTANT) and (var.value is not None):
-            res = var.__value__
-        else:
-            with self.supervisor:
-                if logger.isEnabledFor(logging.DEBUG):
-                        logger.debug("Thread blocking function called")
-                element = threads.blockingCallFromThread(reactor,
-                                                self.control.query,
-                                                REQUEST_CONTROL_QUERY % (var.xml_type, vname),
-                                                self.peerid)[0]
-                res = element.find('value').text
-        return res
+            return var.__value__
+        if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Thread blocking function called")
+        return threads.blockingCallFromThread(reactor, self.queryVariableValue,
+                                              vname)
+
+    def queryVariableValue(self, vname):
+        """
+        This method is the non blocking version of getVariableValue, to be
+        called from the main thread. It returns a deferred which fires with the
+        value.
+        """
+        var = self.variables.get(vname, None)
+        if (var is not None) and (var.access_type is variable.CONSTANT) and \
+           (var.value is not None):
+            return defer.succeed(var.__value__)
+        return self.queryVariableValues([vname]).addCallback(
+                                                    lambda values: values[vname])
+
+    def __values_query__(self, names):
+        """
+        This method sends a single control query for the values of the given
+        variables and the connected peers of the given connectors. It is
+        called in the main thread and returns a deferred firing with the dict
+        of the values, the known values of the constant variables are not
+        asked for.
+        """
+        values = {}
+        requests = []
+        for name in names:
+            if name in self.variables:
+                var = self.variables[name]
+                if (var.access_type is variable.CONSTANT) and \
+                   (var.value is not None):
+                    values[name] = var.__value__
+                    continue
+                requests.append(REQUEST_CONTROL_QUERY % (var.xml_type, name))
+            else:
+                conn = self.connectors[name]
+                requests.append(REQUEST_CONTROL_QUERY % (conn.xml_type, name))
+        if len(requests) == 0:
+            return defer.succeed(values)
+        answer = self.control.query(''.join(requests), self.peerid)
+        answer.addCallback(self.__values_answered__, values, names)
+        return answer
+
+    def __values_answered__(self, elements, values, names):
+        """
+        Matches the answers of a values query with the names.
+        """
+        for element in elements:
+            name = element.attrib['name']
+            if element.tag == VARIABLE_TAG:
+                values[name] = element.find('value').text
+            else:
+                values[name] = [Peerid(e.text) for e in
+                                element.find('peers').findall('peer')]
+        missing = [name for name in names if name not in values]
+        if len(missing) != 0:
+            raise KeyError("No answer for %s" % ", ".join(missing))
+        return values
+
+    def getVariableValues(self, names):
+        """
+        This method returns the dict of the values of several variables in a
+        single round-trip. A connector name gives the list of its connected
+        peers, as getConnectedPeers.
+        """
+        if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Thread blocking function called")
+        return threads.blockingCallFromThread(reactor,
+                                              self.queryVariableValues, names)
+
+    def queryVariableValues(self, names):
+        """
+        This method is the non blocking version of getVariableValues, to be
+        called from the main thread. It returns a deferred which fires with
+        the dict of the values.
+        """
+        return self.__leased__(True, self.__values_query__, names)
 
     def __variable_proxy_changed__(self, value, vname):
             with self.supervisor:
@@ -422,17 +784,21 @@ class ServiceProxy(ServiceCommon):
         This method returns a list of connected peerid of the given connector 
         name
         """
-        conn = self.connectors[cname]
-        with self.supervisor:
-            if logger.isEnabledFor(logging.DEBUG):
-                    logger.debug("Thread blocking function called")
-            element = threads.blockingCallFromThread(reactor,
-                                            self.control.query,
-                                            REQUEST_CONTROL_QUERY % (conn.xml_type, cname),
-                                            self.peerid)[0]
-            el = element.find('peers')
-            res = [Peerid(e.text) for e in el.findall('peer')]
-        return res
+        if cname not in self.connectors:
+            raise KeyError(cname)
+        if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Thread blocking function called")
+        return threads.blockingCallFromThread(reactor, self.queryConnectedPeers,
+                                              cname)
+
+    def queryConnectedPeers(self, cname):
+        """
+        This method is the non blocking version of getConnectedPeers, to be
+        called from the main thread. It returns a deferred which fires with the
+        list of peerids.
+        """
+        return self.queryVariableValues([cname]).addCallback(
+                                                    lambda values: values[cname])
 
 
 
@@ -519,13 +885,20 @@ class StoppedService(ServiceBase):
         self.control.dispatcher.service = weakref.ref(self)
         self.peerid = self.control.peerid = self.idgen.next()
 
-    def addConnector(self, name, description, typ = connector.INOUTPUT):
+    def addConnector(self, name, description, typ = connector.INOUTPUT,
+                     group = None, shards = 1):
         """
-        This method add a new connector to the service
+        This method add a new connector to the service. With a LoopGroup the
+        connector runs in shards event loops of the group instead of the
+        reactor.
         """
         if hasattr(self, name) and logger.isEnabledFor(logging.WARNING):
             logger.warning("Name clash detected -- %s --" % name)
-        newcon = self.connector_type[typ](description)
+        if group is None:
+            newcon = self.connector_type[typ](description)
+        else:
+            import aio
+            newcon = aio.ShardedConnector(description, group, shards, typ)
         newcon.name = name
         newcon.peerid = self.idgen.next()
         self.connectors[name] = newcon
@@ -630,6 +1003,7 @@ class ServiceRepository():
         if peerid in self.proxys:
             proxy = self.proxys[peerid]
             proxy.alive = False
+            proxy.links.discard(proxy)
             reactor.callInThread(self.dispatchRemoved, proxy)
             del self.proxys[peerid]
 
@@ -653,3 +1027,44 @@ class ServiceRepository():
         """
         del self.observers[obj]
 
+    def queryVariableValues(self, names, filter = None):
+        """
+        This method is the non blocking version of getVariableValues, to be
+        called from the main thread. It returns a deferred which fires with
+        the dict of the values by peerid.
+        """
+        proxies = [proxy for proxy in self.proxys.values()
+                   if (filter is None) or filter(proxy)]
+        queries = [proxy.queryVariableValues(names) for proxy in proxies]
+        answers = defer.DeferredList(queries, consumeErrors = True)
+        answers.addCallback(self.__values_answered__, proxies)
+        return answers
+
+    def __values_answered__(self, answers, proxies):
+        values = {}
+        for proxy, (success, result) in zip(proxies, answers):
+            if success:
+                values[proxy.peerid] = result
+            elif logger.isEnabledFor(logging.WARNING):
+                logger.warning("No values from %s : %s"
+                               % (str(proxy.peerid), result.getErrorMessage()))
+        return values
+
+    def getVariableValues(self, names, filter = None):
+        """
+        This method returns the values of the given variables (or connected
+        peers of the given connectors, see ServiceProxy.getVariableValues) of
+        every known service accepted by filter, as a dict by peerid. Each
+        service gets a single control query and the queries run concurrently.
+        The services which fail to answer are missing from the result.
+        """
+        return threads.blockingCallFromThread(reactor,
+                                              self.queryVariableValues,
+                                              names, filter)
+
+    def controlLinkStats(self):
+        """
+        Returns the statistics of the pool of control links to the proxies.
+        """
+        return ServiceProxy.links.stats()
+
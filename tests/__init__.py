@@ -0,0 +1,23 @@
+#
+"""
+The unit and loopback tests of pymiscid, run from the top directory with
+trial :
+
+    trial tests
+
+The modules of pymiscid import each other by their plain names, the tests do
+the same from the package directory, so they run without the bonjour
+dependencies (dbus, avahi). The tests of the service module are skipped when
+those are missing. The log records of pymiscid are dropped, the tests make
+many of them on purpose.
+"""
+import os
+import sys
+import logging
+
+PYMISCID_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  '..', 'pymiscid')
+if PYMISCID_DIRECTORY not in sys.path:
+    sys.path.insert(0, PYMISCID_DIRECTORY)
+
+logging.getLogger().addHandler(logging.NullHandler())
@@ -0,0 +1,254 @@
+#
+"""
+This module holds the helpers of the tests : a fake transport to feed a
+protocol by hand, and a test case starting connectors on the loopback
+interface which are stopped once the test is done, leaving nothing behind in
+the reactor.
+"""
+from twisted.internet import reactor, defer
+from twisted.trial import unittest
+
+import connector
+from bip.protocol import Peerid, BIPBaseProtocol, BIP_HEADER_TEMPLATE, \
+                         LINE_ENDING
+from bip.wheel import timer_wheel
+
+TIMEOUT = 5 # seconds
+
+PEERID = Peerid(0x12345600)
+
+GREETING = BIPBaseProtocol.__greeting__
+
+
+def frame(peerid, msgid, body, tag = None):
+    """
+    This function returns the bip frame of body as sent on the wire. The tag,
+    if any, is the one byte encoding of an extended frame.
+    """
+    if tag is not None:
+        body = tag + body
+    return BIP_HEADER_TEMPLATE % (GREETING, str(peerid), msgid, len(body)) + \
+           body + LINE_ENDING
+
+
+def poll(condition, timeout = TIMEOUT, step = 0.01):
+    """
+    This function returns a deferred which fires once condition() is true, or
+    fails with a RuntimeError after timeout seconds.
+    """
+    deferred = defer.Deferred()
+    deadline = reactor.seconds() + timeout
+    def check():
+        if condition():
+            deferred.callback(None)
+        elif reactor.seconds() > deadline:
+            deferred.errback(RuntimeError("Condition not met in %ss" %
+                                          timeout))
+        else:
+            reactor.callLater(step, check)
+    check()
+    return deferred
+
+
+class FakeAddress(object):
+    """
+    The tcp address of a FakeTransport.
+    """
+    def __init__(self, host = '127.0.0.1'):
+        self.host = host
+
+
+class FakeTransport(object):
+    """
+    A transport which keeps what is written.
+    """
+    connected = True
+    bufferSize = 65536
+    paused = False
+
+    def __init__(self):
+        self.written = []
+        self.sequences = []
+        self.producer = None
+        self.lost = False
+
+    def getPeer(self):
+        return FakeAddress()
+
+    def getHost(self):
+        return FakeAddress()
+
+    def setTcpNoDelay(self, value):
+        pass
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def write(self, data):
+        self.written.append(data)
+
+    def writeSequence(self, data):
+        self.sequences.append(list(data))
+        self.written.append(''.join(data))
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+    def loseConnection(self):
+        self.lost = True
+        self.connected = False
+
+    abortConnection = loseConnection
+
+    def value(self):
+        return ''.join(self.written)
+
+
+class FakeOwner(object):
+    """
+    The owner of a protocol built by hand, normally the connector.
+    """
+    def __init__(self, peerid, **attributes):
+        self.peerid = peerid
+        self.__dict__.update(attributes)
+
+
+class FakeFactory(object):
+    """
+    The factory of a protocol built by hand.
+    """
+    timeout = 1
+
+    def __init__(self, service):
+        self.service = service
+
+
+def sender(peerid):
+    """
+    This function returns a protocol of the given peerid, without writer,
+    whose frames are kept by its transport.
+    """
+    protocol = BIPBaseProtocol()
+    protocol.transport = FakeTransport()
+    protocol.factory = FakeFactory(FakeOwner(peerid))
+    protocol.__msgid__ = 1
+    return protocol
+
+
+class Batches(object):
+    """
+    A protocol observer which keeps the received batches.
+    """
+    def __init__(self):
+        self.batches = []
+        self.connections = 0
+
+    def connected(self, protocol):
+        self.connections += 1
+
+    def receivedBatch(self, msgs):
+        self.batches.append(msgs)
+
+    def messages(self):
+        return [msg for batch in self.batches for msg in batch]
+
+
+def receiver(peerid = PEERID):
+    """
+    This function returns a protocol fed by hand and its observer, the
+    handshake of the peerid is already received.
+    """
+    protocol = BIPBaseProtocol()
+    protocol.transport = FakeTransport()
+    protocol.host = '127.0.0.1'
+    observer = Batches()
+    protocol.connectedEvent.addObserver(observer.connected)
+    protocol.receivedBatchEvent.addObserver(observer.receivedBatch)
+    protocol.dataReceived(frame(peerid, 0, ''))
+    return protocol, observer
+
+
+class Recorder(object):
+    """
+    A connector observer which records the events it gets. The data of the
+    received messages is kept, their buffer may go back to a pool.
+    """
+    def __init__(self):
+        self.connections = []
+        self.disconnections = []
+        self.messages = []
+
+    def connected(self, peerid):
+        self.connections.append(peerid)
+
+    def disconnected(self, peerid):
+        self.disconnections.append(peerid)
+
+    def received(self, msg):
+        self.messages.append(msg.data)
+
+
+class Proxy(object):
+    """
+    The description of a started connector, as a remote one is given to
+    connect.
+    """
+    def __init__(self, con):
+        self.host = self.addr = '127.0.0.1'
+        self.tcp = con.tcp
+        self.unix = con.unix
+        self.peerid = con.peerid
+        self.type = connector.txt_to_connector_type_map[con.txt_prefix]
+
+
+class LoopbackTestCase(unittest.TestCase):
+    """
+    A test case whose connectors are stopped at the end of the test.
+    """
+    def setUp(self):
+        self.connectors = []
+
+    def start(self, factory = connector.Connector, **attributes):
+        """
+        This method builds, configures and starts a connector.
+        """
+        con = factory()
+        con.peerid = Peerid()
+        for name, value in attributes.iteritems():
+            setattr(con, name, value)
+        con.startService()
+        self.connectors.append(con)
+        return con
+
+    def observe(self, con):
+        """
+        This method returns a Recorder observing the connector.
+        """
+        recorder = Recorder()
+        con.dispatcher.addObserver(recorder)
+        return recorder
+
+    def connect(self, con, remote):
+        """
+        This method connects con to remote, the returned deferred fires once
+        both sides are connected.
+        """
+        deferred = con.__connection__(Proxy(remote))
+        deferred.addCallback(lambda result: poll(lambda: con.peerid in
+                                                 remote.peers))
+        return deferred
+
+    def tearDown(self):
+        for con in self.connectors:
+            if con.running:
+                con.__stopService__()
+        # the connections are closed and the timer wheel stops once its
+        # timers are cancelled
+        deferred = poll(lambda: not [c for c in self.connectors
+                                     if len(c.peers) != 0])
+        deferred.addCallback(lambda result: poll(lambda:
+                                                 not timer_wheel().running))
+        return deferred
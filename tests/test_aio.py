@@ -0,0 +1,156 @@
+#
+"""
+Tests of the asyncio backend of the connectors, run on a private event loop.
+"""
+import time
+import weakref
+
+from twisted.trial import unittest
+
+from bip.protocol import Peerid
+try:
+    from bip.aio import asyncio
+    import aio
+except ImportError:
+    asyncio = None
+
+import test_control
+from loopback import Recorder, TIMEOUT
+
+
+class AIOProxy(object):
+    """
+    The description of a started asyncio connector.
+    """
+    unix = None
+
+    def __init__(self, con):
+        self.host = self.addr = '127.0.0.1'
+        self.tcp = con.tcp
+        self.peerid = con.peerid
+
+
+class AIOTestCase(unittest.TestCase):
+    """
+    A test case running its connectors on a private loop, they are stopped
+    and the loop closed at the end of the test.
+    """
+    if asyncio is None:
+        skip = "trollius is not installed"
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.connectors = []
+
+    def tearDown(self):
+        for con in self.connectors:
+            con.stop()
+        self.until(lambda: not [c for c in self.connectors if c.peers])
+        self.loop.close()
+
+    def wait(self, future):
+        """
+        This method runs the loop until the future is done and returns its
+        result.
+        """
+        return self.loop.run_until_complete(asyncio.wait_for(future, TIMEOUT,
+                                                             loop = self.loop))
+
+    def until(self, condition):
+        """
+        This method runs the loop until condition() is true.
+        """
+        deadline = time.time() + TIMEOUT
+        while not condition():
+            if time.time() > deadline:
+                self.fail("Condition not met in %ss" % TIMEOUT)
+            self.loop.run_until_complete(asyncio.sleep(0.01, loop = self.loop))
+
+    def start(self, factory = None):
+        if factory is None:
+            factory = aio.AIOConnector
+        con = factory(loop = self.loop)
+        con.peerid = Peerid()
+        self.connectors.append(con)
+        self.assertIdentical(self.wait(con.start('127.0.0.1')), con)
+        return con
+
+    def connect(self, con, remote):
+        self.assertEqual(self.wait(con.connect(AIOProxy(remote))),
+                         remote.peerid)
+        self.until(lambda: con.peerid in remote.peers)
+
+
+class AIOConnectorTestCase(AIOTestCase):
+    """
+    Two asyncio connectors exchange messages.
+    """
+    def test_round_trip(self):
+        a, b = self.start(), self.start()
+        recorder = Recorder()
+        b.dispatcher.addObserver(recorder)
+        self.connect(b, a)
+        self.assertEqual(recorder.connections, [a.peerid])
+        bodies = ['m%d' % i for i in xrange(100)] + ['x' * 300000]
+        for body in bodies:
+            a.send(body)
+        self.until(lambda: len(recorder.messages) == len(bodies))
+        self.assertEqual(recorder.messages, bodies)
+        self.assertEqual(b.received_count, len(bodies))
+        self.assertTrue(a.sent_count >= len(bodies))
+
+    def test_send_future(self):
+        a, b = self.start(), self.start()
+        self.connect(b, a)
+        self.assertEqual(self.wait(a.send_future('one', b.peerid)), 1)
+        self.assertEqual(self.wait(a.send_future('all')), 1)
+
+    def test_connection_refused(self):
+        a = self.start()
+        proxy = AIOProxy(a)
+        a.stop()
+        self.assertRaises(EnvironmentError, self.wait,
+                          self.start().connect(proxy))
+
+    def test_disconnect(self):
+        a, b = self.start(), self.start()
+        recorder = Recorder()
+        a.dispatcher.addObserver(recorder)
+        self.connect(b, a)
+        b.disconnect(a.peerid)
+        self.until(lambda: recorder.disconnections == [b.peerid])
+        self.assertEqual(b.peers, {})
+
+    def test_output_connector(self):
+        a, b = self.start(aio.AIOOConnector), self.start()
+        self.connect(b, a)
+        b.send('to an output connector')
+        self.until(lambda: len(a.peers) == 0)
+
+
+class AIOControlTestCase(AIOTestCase):
+    """
+    The queries of an asyncio control connector give futures.
+    """
+    def test_query(self):
+        service = test_control.FakeService(v = 'value')
+        server = self.start(aio.AIOControlConnector)
+        server.dispatcher.service = weakref.ref(service)
+        client = self.start(aio.AIOControlConnector)
+        self.connect(client, server)
+        answer = client.query(test_control.variable_query('v'), server.peerid)
+        self.assertEqual(test_control.value_of(self.wait(answer)), 'value')
+
+    def test_service_proxy(self):
+        service = test_control.FakeService(v = 'value', w = 'other')
+        server = self.start(aio.AIOControlConnector)
+        server.dispatcher.service = weakref.ref(service)
+        client = self.start(aio.AIOControlConnector)
+        proxy = aio.AIOServiceProxy(client, server.peerid, '127.0.0.1',
+                                    '127.0.0.1', server.tcp)
+        self.assertEqual(self.wait(proxy.connect()), server.peerid)
+        self.assertIdentical(self.wait(proxy.queryDescription()), proxy)
+        self.assertEqual(sorted(proxy.variables.keys()), ['v', 'w'])
+        self.assertEqual(self.wait(proxy.queryVariableValue('w')), 'other')
+        self.assertEqual(self.wait(proxy.queryVariableValues(['v', 'w'])),
+                         {'v' : 'value', 'w' : 'other'})
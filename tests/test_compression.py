@@ -0,0 +1,81 @@
+#
+"""
+Tests of the zlib compression of the messages between peers which both set
+compression.
+"""
+import os
+import zlib
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from bip.protocol import MessageBuilder, FRAME_PLAIN, FRAME_ZLIB, \
+                         LINE_ENDING
+
+from loopback import LoopbackTestCase, poll, PEERID
+
+
+def compressed_message(body):
+    """
+    This function returns a received message whose body is body compressed.
+    """
+    compressed = zlib.compress(body)
+    msg = MessageBuilder(PEERID, 1, len(compressed) + len(LINE_ENDING),
+                         '127.0.0.1')
+    msg.build(compressed + LINE_ENDING)
+    msg.tag = FRAME_ZLIB
+    return msg
+
+
+class DecompressTestCase(unittest.TestCase):
+    """
+    A compressed body is replaced by its content, up to a maximum size.
+    """
+    def test_round_trip(self):
+        body = os.urandom(1000) * 50
+        msg = compressed_message(body)
+        msg.decompress(len(body))
+        self.assertEqual(msg.data, body)
+        self.assertEqual(msg.view.tobytes(), body)
+        self.assertEqual(len(msg), len(body))
+        self.assertEqual(msg.tag, FRAME_PLAIN)
+
+    def test_empty(self):
+        msg = compressed_message('')
+        msg.decompress(0)
+        self.assertEqual(msg.data, '')
+
+    def test_bomb(self):
+        msg = compressed_message('\0' * (10 * 1024 * 1024))
+        self.assertTrue(len(msg) < 20000)
+        self.assertRaises(zlib.error, msg.decompress, 1024 * 1024)
+        msg = compressed_message('x' * 1001)
+        self.assertRaises(zlib.error, msg.decompress, 1000)
+
+    def test_corrupted(self):
+        msg = compressed_message('abc' * 1000)
+        truncated = MessageBuilder(PEERID, 1, len(msg) // 2 + len(LINE_ENDING),
+                                   '127.0.0.1')
+        truncated.build(msg.data[:len(msg) // 2] + LINE_ENDING)
+        self.assertRaises(zlib.error, truncated.decompress, 10000)
+        garbage = MessageBuilder(PEERID, 1, 10 + len(LINE_ENDING), '127.0.0.1')
+        garbage.build('0123456789' + LINE_ENDING)
+        self.assertRaises(zlib.error, garbage.decompress, 10000)
+
+
+class LoopbackCompressionTestCase(LoopbackTestCase):
+    """
+    Two connectors exchange compressed messages, a message too large once
+    decompressed is dropped.
+    """
+    @defer.inlineCallbacks
+    def test_round_trip(self):
+        a = self.start(compression = True, compression_threshold = 100)
+        b = self.start(compression = True, decompression_max_size = 100000)
+        recorder = self.observe(b)
+        yield self.connect(b, a)
+        bodies = ['small', 'c' * 50000, 'bomb' * 100000, 'end']
+        for body in bodies:
+            a.send(body)
+        yield poll(lambda: recorder.messages[-1:] == ['end'])
+        self.assertEqual(recorder.messages, ['small', 'c' * 50000, 'end'])
@@ -0,0 +1,346 @@
+#
+"""
+Tests of the connectors : broadcast, sends from other threads, flow control
+and dispatch of the received messages.
+"""
+import threading
+
+from twisted.trial import unittest
+from twisted.internet import defer, threads, task, reactor
+
+import connector
+from bip.protocol import Peerid, broadcast
+from bip.flow import SlowPeerError, DROP_NEWEST
+
+from loopback import LoopbackTestCase, Recorder, Proxy, poll, frame, \
+                     sender, receiver, PEERID
+
+
+def completed(completion):
+    """
+    This function returns a deferred firing with a SendCompletion.
+    """
+    deferred = defer.Deferred()
+    completion.addCallbacks(deferred.callback, deferred.errback)
+    return deferred
+
+
+class BroadcastTestCase(unittest.TestCase):
+    """
+    A broadcast payload is serialized once for every peer.
+    """
+    def test_shared_payload(self):
+        protocols = [sender(Peerid(i << 8)) for i in xrange(3)]
+        protocols[1].__msgid__ = 7
+        broadcast(protocols, bytearray('payload'))
+        payloads = [p.transport.sequences[0][1] for p in protocols]
+        self.assertEqual(payloads[0], 'payload')
+        for payload in payloads[1:]:
+            self.assertIdentical(payload, payloads[0])
+        self.assertEqual(protocols[1].transport.value(),
+                         frame(protocols[1].factory.service.peerid, 7,
+                               'payload'))
+
+    def test_completion(self):
+        protocols = [sender(Peerid(i << 8)) for i in xrange(2)]
+        deferreds = broadcast(protocols, 'abc', completion = True)
+        self.assertEqual(len(deferreds), 2)
+        results = []
+        for deferred in deferreds:
+            deferred.addCallback(results.append)
+        self.assertEqual(results, [3, 3])
+        self.assertEqual(broadcast(protocols, 'abc'), [None, None])
+
+
+class LoopbackBroadcastTestCase(LoopbackTestCase):
+    """
+    A connector sends to all its peers.
+    """
+    @defer.inlineCallbacks
+    def test_broadcast(self):
+        source = self.start()
+        peers = [self.start() for i in xrange(3)]
+        recorders = [self.observe(peer) for peer in peers]
+        for peer in peers:
+            yield self.connect(peer, source)
+        source.send('to all')
+        yield poll(lambda: not [r for r in recorders if not r.messages])
+        for recorder in recorders:
+            self.assertEqual(recorder.messages, ['to all'])
+
+
+class OutboxTestCase(LoopbackTestCase):
+    """
+    The messages sent from any thread are queued in the connector outbox and
+    flushed by batches in the main thread.
+    """
+    @defer.inlineCallbacks
+    def test_single_flush(self):
+        a, b = self.start(), self.start()
+        recorder = self.observe(b)
+        yield self.connect(b, a)
+        flushes = []
+        flush = a.__flush__
+        def counting():
+            flushes.append(len(a.outbox))
+            flush()
+        a.__flush__ = counting
+        bodies = ['m%d' % i for i in xrange(100)]
+        for body in bodies[:50]:
+            a.send(body)
+        a.send_many(bodies[50:])
+        yield poll(lambda: len(recorder.messages) == len(bodies))
+        self.assertEqual(flushes, [100])
+        self.assertEqual(recorder.messages, bodies)
+
+    @defer.inlineCallbacks
+    def test_threads(self):
+        a, b = self.start(), self.start()
+        recorder = self.observe(b)
+        yield self.connect(b, a)
+        bodies = ['m%d' % i for i in xrange(2000)]
+        def produce():
+            for body in bodies:
+                a.send(body)
+        yield threads.deferToThread(produce)
+        yield poll(lambda: len(recorder.messages) == len(bodies))
+        self.assertEqual(recorder.messages, bodies)
+
+
+class SendDeferredTestCase(LoopbackTestCase):
+    """
+    The completion of send_deferred gives the number of peers or the error
+    of the peer which dropped the message.
+    """
+    @defer.inlineCallbacks
+    def test_result(self):
+        a, b, c = self.start(), self.start(), self.start()
+        yield self.connect(b, a)
+        result = yield completed(a.send_deferred('one', peerid = b.peerid))
+        self.assertEqual(result, 1)
+        yield self.connect(c, a)
+        result = yield completed(a.send_deferred('all'))
+        self.assertEqual(result, 2)
+
+    @defer.inlineCallbacks
+    def test_no_peer(self):
+        a = self.start()
+        result = yield completed(a.send_deferred('nobody'))
+        self.assertEqual(result, 0)
+
+    @defer.inlineCallbacks
+    def test_unknown_peer(self):
+        a = self.start()
+        completion = a.send_deferred('lost', peerid = Peerid(0x100))
+        yield self.assertFailure(completed(completion), SlowPeerError)
+
+    @defer.inlineCallbacks
+    def test_dropped(self):
+        a, b = self.start(), self.start()
+        yield self.connect(b, a)
+        a.high_water = 1
+        a.slow_peer_policy = DROP_NEWEST
+        writer = a.peers[b.peerid].writer
+        writer.pauseProducing()
+        yield self.assertFailure(completed(a.send_deferred('dropped')),
+                                 SlowPeerError)
+        yield self.assertFailure(completed(a.send_deferred('dropped too',
+                                                           peerid = b.peerid)),
+                                 SlowPeerError)
+        writer.resumeProducing()
+
+    @defer.inlineCallbacks
+    def test_main_thread(self):
+        a, b = self.start(), self.start()
+        yield self.connect(b, a)
+        completion = yield threads.deferToThread(a.send_deferred, 'from thread')
+        result = yield threads.deferToThread(completion.wait, 5)
+        self.assertEqual(result, 1)
+        self.assertTrue(completion.done())
+        names = []
+        yield completed(completion.addCallbacks(lambda result: names.append(
+                                        threading.currentThread().getName())))
+        self.assertEqual(names, [threading.currentThread().getName()])
+
+
+class FakeMessage(object):
+    """
+    A received message.
+    """
+    def __init__(self, data):
+        self.data = data
+
+
+class BatchRecorder(object):
+    """
+    A connector observer which records the received batches.
+    """
+    def __init__(self):
+        self.batches = []
+        self.messages = []
+
+    def connected(self, peerid):
+        pass
+
+    def disconnected(self, peerid):
+        pass
+
+    def received(self, msg):
+        self.messages.append(msg.data)
+
+    def receivedBatch(self, msgs):
+        self.batches.append([msg.data for msg in msgs])
+
+
+class ReceivedBatchTestCase(LoopbackTestCase):
+    """
+    The messages of a read are delivered together to the receivedBatch
+    observers, and one by one to the received ones.
+    """
+    @defer.inlineCallbacks
+    def test_batch(self):
+        a, b = self.start(), self.start()
+        recorder = BatchRecorder()
+        b.dispatcher.addObserver(recorder)
+        yield self.connect(b, a)
+        bodies = ['m%d' % i for i in xrange(50)]
+        a.send_many(bodies)
+        yield poll(lambda: len(recorder.messages) == len(bodies))
+        self.assertEqual(recorder.messages, bodies)
+        self.assertEqual([m for batch in recorder.batches for m in batch],
+                         bodies)
+        self.assertTrue(len(recorder.batches) < len(bodies))
+
+    def test_received_only(self):
+        dispatcher = connector.BasicEventDispatcher()
+        recorder = Recorder()
+        dispatcher.addObserver(recorder)
+        self.assertEqual(len(dispatcher.receivedBatchEvent), 0)
+        dispatcher.dispatchBatch([FakeMessage('a'), FakeMessage('b')])
+        self.assertEqual(recorder.messages, ['a', 'b'])
+
+
+class StreamHandler(object):
+    """
+    A stream observer which records the calls it gets.
+    """
+    handlers = None
+
+    def __init__(self):
+        self.calls = []
+        self.chunks = []
+        self.handlers.append(self)
+
+    def start(self, peerid, msgid, size):
+        self.calls.append(('start', peerid, msgid, size))
+
+    def chunk(self, chunk):
+        self.chunks.append(chunk.tobytes())
+
+    def end(self):
+        self.calls.append(('end',))
+
+    def abort(self):
+        self.calls.append(('abort',))
+
+
+class StreamTestCase(LoopbackTestCase):
+    """
+    The messages above the stream threshold are handed chunk by chunk to the
+    stream observers.
+    """
+    @defer.inlineCallbacks
+    def test_stream(self):
+        a, b = self.start(), self.start(stream_threshold = 1000)
+        recorder = self.observe(b)
+        yield self.connect(b, a)
+        handlers = []
+        factory = type('Handler', (StreamHandler,), {'handlers' : handlers})
+        oid = b.addStreamObserver(factory)
+        yield poll(lambda: b.peers[a.peerid].stream_threshold == 1000)
+        body = ''.join([chr(i % 256) for i in xrange(300000)])
+        a.send('small')
+        a.send(body)
+        a.send('after')
+        yield poll(lambda: len(recorder.messages) == 2 and
+                           handlers and handlers[0].calls[-1] == ('end',))
+        self.assertEqual(recorder.messages, ['small', 'after'])
+        [handler] = handlers
+        self.assertEqual(handler.calls, [('start', a.peerid, 2, len(body)),
+                                         ('end',)])
+        self.assertEqual(''.join(handler.chunks), body)
+        b.removeStreamObserver(oid)
+        yield poll(lambda: b.peers[a.peerid].stream_threshold is None)
+        a.send(body)
+        yield poll(lambda: len(recorder.messages) == 3)
+        self.assertEqual(recorder.messages[2], body)
+
+    def test_abort(self):
+        protocol, observer = receiver()
+        protocol.stream_threshold = 10
+        calls = []
+        class Observer(object):
+            def streamStarted(self, msg):
+                calls.append(('start', msg.size))
+            def streamChunk(self, msg, chunk):
+                calls.append(('chunk', chunk.tobytes()))
+            def streamEnded(self, msg):
+                calls.append(('end', msg.rlen != 0))
+        streams = Observer()
+        protocol.streamStartedEvent.addObserver(streams.streamStarted)
+        protocol.streamChunkEvent.addObserver(streams.streamChunk)
+        protocol.streamEndedEvent.addObserver(streams.streamEnded)
+        protocol.dataReceived(frame(PEERID, 1, 'x' * 100)[:-50])
+        protocol.connectionLost(None)
+        self.assertEqual(calls[0], ('start', 100))
+        self.assertEqual(''.join([c[1] for c in calls if c[0] == 'chunk']),
+                         'x' * 52)
+        self.assertEqual(calls[-1], ('end', True))
+
+
+class ReconnectTestCase(LoopbackTestCase):
+    """
+    The reconnecting links reopen the lost connections, waiting longer after
+    every failed attempt, until they are disconnected.
+    """
+    RECONNECT = dict(reconnect = True, reconnect_delay = 0.02,
+                     reconnect_max_delay = 0.08, reconnect_jitter = 0)
+
+    @defer.inlineCallbacks
+    def test_reconnect(self):
+        a, b = self.start(), self.start(**self.RECONNECT)
+        recorder = self.observe(b)
+        yield self.connect(b, a)
+        self.assertIn(a.peerid, b.links)
+        a.__disconnect__(b.peerid)
+        yield poll(lambda: recorder.disconnections == [a.peerid])
+        yield poll(lambda: len(recorder.connections) == 2)
+        self.assertEqual(recorder.connections, [a.peerid, a.peerid])
+        self.assertEqual(b.links[a.peerid].attempts, 0)
+        yield poll(lambda: b.peerid in a.peers)
+
+    @defer.inlineCallbacks
+    def test_backoff(self):
+        a, b = self.start(), self.start(**self.RECONNECT)
+        proxy = Proxy(a)
+        a.__stopService__()
+        b.__link__(proxy)
+        link = b.links[a.peerid]
+        yield poll(lambda: link.attempts >= 5)
+        delay = link.call.getTime() - reactor.seconds()
+        self.assertTrue(0 < delay <= b.reconnect_max_delay, delay)
+        b.__unlink__(a.peerid)
+        self.assertTrue(link.closed)
+        self.assertIdentical(link.call, None)
+        self.assertEqual(len(b.links), 0)
+
+    @defer.inlineCallbacks
+    def test_disconnect(self):
+        a, b = self.start(), self.start(**self.RECONNECT)
+        recorder = self.observe(b)
+        yield self.connect(b, a)
+        b.__unlink__(a.peerid)
+        yield poll(lambda: recorder.disconnections == [a.peerid])
+        yield task.deferLater(reactor, 0.1, lambda: None)
+        self.assertEqual(recorder.connections, [a.peerid])
+        self.assertEqual(len(a.peers), 0)
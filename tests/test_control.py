@@ -0,0 +1,294 @@
+#
+"""
+Tests of the control connectors : queries, answers and events between two
+control connectors, the one of a service and the one of its clients.
+"""
+import time
+import weakref
+
+from twisted.internet import reactor, defer, threads
+
+from twisted.trial import unittest
+
+from lxml import etree
+
+import connector
+import controlcodec
+import controlparser
+import variable
+import codebench.xml as xml
+
+from cstes import VARIABLE_EVENT_MSG, REQUEST_CONTROL_QUERY, CONTROL_EVENT, \
+                  CONTROL_QUERY
+
+from loopback import LoopbackTestCase, poll
+
+
+class FakeService(object):
+    """
+    The part of a service used by its control dispatcher.
+    """
+    def __init__(self, **values):
+        self.variables = {}
+        self.connectors = {}
+        for name, value in values.iteritems():
+            var = variable.Variable('string', 'test', variable.READ_WRITE,
+                                    value)
+            var.name = name
+            self.variables[name] = var
+
+    def XMLDescription(self):
+        return ''.join([xml.Marshall.dumps(var)
+                        for var in self.variables.values()])
+
+
+def variable_query(name):
+    return REQUEST_CONTROL_QUERY % ('variable', name)
+
+
+def value_of(elements):
+    """
+    This function returns the value of the variable of a query answer.
+    """
+    return elements[0].find('value').text
+
+
+def tree(element):
+    """
+    This function returns the comparable content of an element, a
+    ControlElement or an lxml one.
+    """
+    return (element.tag, dict(element.attrib), type(element.text),
+            element.text, [tree(child) for child in element])
+
+
+class AnswerTestCase(unittest.TestCase):
+    """
+    The answers are recognized without being parsed.
+    """
+    def test_is_answer(self):
+        for binary in [False, True]:
+            answer = controlcodec.message(controlcodec.ANSWER, 1,
+                                          '<variable name="v"/>', binary)
+            self.assertTrue(controlcodec.is_answer(answer))
+            for kind in [controlcodec.QUERY, controlcodec.EVENT]:
+                self.assertFalse(controlcodec.is_answer(controlcodec.message(
+                                        kind, 1, '<variable name="v"/>',
+                                        binary)))
+        self.assertTrue(controlcodec.is_answer('<controlAnswer id="1"/>'))
+        self.assertTrue(controlcodec.is_answer(
+                    '<?xml version="1.0"?>\n <controlAnswer id="1"/>'))
+        self.assertFalse(controlcodec.is_answer('<?xml version="1.0"'))
+        self.assertFalse(controlcodec.is_answer(''))
+
+
+class ParserTestCase(unittest.TestCase):
+    """
+    The fast path gives what lxml gives, or leaves the message to lxml.
+    """
+    VALUES = [('v', 'value'), ('v', ''), ('v', 'a\tb\nc'), ('v', '<&>'),
+              ('v', 'a\r\nb'), ('v', 'a\rb'), ('v', '\xc3\xa9t\xc3\xa9'),
+              ('v', '\x01'), ('v', 'a]]>b'), ('a\tb', 'x'), ('a"b', 'x')]
+
+    def check(self, data, fast_path):
+        fast = controlparser.parse(data)
+        self.assertEqual(fast is not None, fast_path, repr(data))
+        if fast is not None:
+            self.assertEqual(tree(fast), tree(etree.fromstring(data)))
+
+    def test_event(self):
+        for name, value in self.VALUES:
+            body = VARIABLE_EVENT_MSG % (name, value)
+            self.check(CONTROL_EVENT % body, (name, value) in self.VALUES[:4])
+
+    def test_query(self):
+        for name, value in self.VALUES:
+            body = VARIABLE_EVENT_MSG % (name, value)
+            self.check(CONTROL_QUERY % (42, body),
+                       (name, value) in self.VALUES[:4])
+
+    def test_other(self):
+        self.check(CONTROL_QUERY % (1, variable_query('v')), False)
+        self.check(CONTROL_EVENT % '<variable name="v"/>', False)
+
+
+class CodecTestCase(unittest.TestCase):
+    """
+    A binary message decodes to the tree of its XML form.
+    """
+    KINDS = [controlcodec.QUERY, controlcodec.EVENT, controlcodec.ANSWER]
+
+    def operation(self, data):
+        return data[controlcodec.HEADER.size - 1]
+
+    def test_round_trip(self):
+        bodies = [VARIABLE_EVENT_MSG % value for value in ParserTestCase.VALUES]
+        bodies += [variable_query('v'), '<fullDescription/>',
+                   '<variable name="v"/><variable name="w"/>']
+        for kind in self.KINDS:
+            for body in bodies:
+                data = controlcodec.encode(kind, 42, body)
+                try:
+                    root = etree.fromstring(controlcodec.xml_message(kind, 42,
+                                                                     body))
+                except etree.XMLSyntaxError:
+                    self.assertRaises(etree.XMLSyntaxError,
+                                      controlcodec.decode, data)
+                else:
+                    self.assertEqual(tree(controlcodec.decode(data)),
+                                     tree(root), repr(body))
+
+    def test_operations(self):
+        event = lambda body: controlcodec.encode(controlcodec.EVENT, 0, body)
+        data = event(VARIABLE_EVENT_MSG % ('v', '1'))
+        self.assertEqual(self.operation(data), controlcodec.OP_VALUE)
+        self.assertEqual(len(data), 11)
+        self.assertEqual(self.operation(event(variable_query('v'))),
+                         controlcodec.OP_REQUEST)
+        for name, value in [('v', 'a\r\nb'), ('v', '\xc3\xa9'), ('a\tb', 'x'),
+                            ('v', 'a]]>b')]:
+            data = event(VARIABLE_EVENT_MSG % (name, value))
+            self.assertEqual(self.operation(data), controlcodec.OP_XML)
+        self.assertEqual(self.operation(event('<fullDescription/>')),
+                         controlcodec.OP_XML)
+
+    def test_message(self):
+        body = variable_query('v')
+        self.assertEqual(controlcodec.message(controlcodec.QUERY, 1, body),
+                         CONTROL_QUERY % (1, body))
+        self.assertEqual(controlcodec.message(controlcodec.EVENT, 0, body,
+                                              binary = True)[:1],
+                         controlcodec.BINARY_MARKER)
+
+    def test_unknown_operation(self):
+        data = controlcodec.HEADER.pack(controlcodec.BINARY_MARKER,
+                        controlcodec.EVENT, 0, 'z') + '\x00\x01vx'
+        self.assertRaises(ValueError, controlcodec.decode, data)
+
+
+class ControlTestCase(LoopbackTestCase):
+    """
+    A test case with a service control connector and a client one.
+    """
+    def start_service(self, **values):
+        """
+        This method starts the control connector of a fake service holding
+        the given variables.
+        """
+        self.service = FakeService(**values)
+        control = self.start(connector.ControlConnector)
+        control.dispatcher.service = weakref.ref(self.service)
+        return control
+
+    def query(self, client, server, name):
+        return client.query(variable_query(name),
+                            server.peerid).addCallback(value_of)
+
+
+class QueryTestCase(ControlTestCase):
+    """
+    Queries and answers.
+    """
+    @defer.inlineCallbacks
+    def test_query(self):
+        server = self.start_service(v = 'value')
+        client = self.start(connector.ControlConnector)
+        yield self.connect(client, server)
+        value = yield self.query(client, server, 'v')
+        self.assertEqual(value, 'value')
+
+    @defer.inlineCallbacks
+    def test_blocking_query_from_observer(self):
+        server = self.start_service(v = 'value')
+        client = self.start(connector.ControlConnector)
+        client.dispatcher.__qtimeout__ = 2
+        yield self.connect(client, server)
+        results = []
+        class Observer(object):
+            def connected(self, peerid):
+                pass
+            def disconnected(self, peerid):
+                pass
+            def received(self, msg):
+                start = time.time()
+                try:
+                    result = threads.blockingCallFromThread(reactor,
+                                            self.query, client, server, 'v')
+                except Exception, err:
+                    result = err
+                results.append((result, time.time() - start))
+        observer = Observer()
+        observer.query = self.query
+        client.dispatcher.addObserver(observer)
+        server.event(VARIABLE_EVENT_MSG % ('v', 'changed'), client.peerid)
+        yield poll(lambda: len(results) != 0)
+        value, elapsed = results[0]
+        self.assertEqual(value, 'value')
+        self.assertTrue(elapsed < 1, elapsed)
+
+    @defer.inlineCallbacks
+    def test_disconnection_fails_the_queries(self):
+        server = self.start_service(v = 'value')
+        client = self.start(connector.ControlConnector)
+        yield self.connect(client, server)
+        answer = client.query(variable_query('v'), server.peerid)
+        client.__disconnect__(server.peerid)
+        yield self.assertFailure(answer, RuntimeError)
+
+
+class FakeVariable(object):
+    """
+    A variable of a proxy, updated by the events.
+    """
+    xml_updatable = ['value']
+    value = None
+
+
+class FakeProxy(object):
+    """
+    The part of a service proxy used by the dispatcher of its control
+    connector.
+    """
+    def __init__(self, peerid, names):
+        self.peerid = peerid
+        self.variables = dict([(name, FakeVariable()) for name in names])
+
+
+class BinaryControlTestCase(ControlTestCase):
+    """
+    The binary encoding is used when both peers offer it, and gives the same
+    values as XML.
+    """
+    VALUES = {'v' : 'value', 'crlf' : 'a\r\nb', 'utf8' : '\xc3\xa9t\xc3\xa9'}
+    EXPECTED = {'v' : 'value', 'crlf' : 'a\nb', 'utf8' : u'\xe9t\xe9'}
+
+    @defer.inlineCallbacks
+    def check(self, server_binary, client_binary):
+        server = self.start_service(v = 'value')
+        server.binary_control = server_binary
+        client = self.start(connector.ControlConnector,
+                            binary_control = client_binary)
+        yield self.connect(client, server)
+        binary = server_binary and client_binary
+        self.assertEqual(client.binaryControl(server.peerid), binary)
+        self.assertEqual(server.binaryControl(client.peerid), binary)
+        value = yield self.query(client, server, 'v')
+        self.assertEqual(value, 'value')
+        proxy = FakeProxy(server.peerid, self.VALUES.keys())
+        client.dispatcher.addProxy(proxy)
+        for name, value in self.VALUES.iteritems():
+            server.event(VARIABLE_EVENT_MSG % (name, value), client.peerid)
+        yield poll(lambda: None not in [var.value for var
+                                        in proxy.variables.values()])
+        for name, expected in self.EXPECTED.iteritems():
+            value = proxy.variables[name].value
+            self.assertEqual((type(value), value), (type(expected), expected))
+
+    def test_binary(self):
+        return self.check(True, True)
+
+    def test_one_side(self):
+        return self.check(True, False)
+
+    def test_xml(self):
+        return self.check(False, False)
@@ -0,0 +1,150 @@
+#
+"""
+Tests of the datagram mode : fragmentation, reassembly and the bounds kept on
+what the datagrams of anyone can allocate.
+"""
+import random
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from bip.datagram import BIPDatagramProtocol, FRAGMENT
+from bip.protocol import Peerid, BIP_PREFIX_TEMPLATE, BIP_MSGID_TEMPLATE, \
+                         BIP_SIZE_TEMPLATE, LINE_ENDING
+
+from loopback import LoopbackTestCase, poll, GREETING, PEERID
+
+ADDRESS = ('127.0.0.1', 1234)
+
+
+class DatagramTransport(object):
+    """
+    A datagram transport which keeps what is written.
+    """
+    def __init__(self):
+        self.datagrams = []
+
+    def write(self, data, address):
+        self.datagrams.append(data)
+
+
+class DatagramOwner(object):
+    """
+    The connector owning a datagram protocol.
+    """
+    def __init__(self, *peerids):
+        self.peers = dict([(peerid, None) for peerid in peerids])
+        self.messages = []
+
+    def datagramReceived(self, msg):
+        self.messages.append(str(msg.data))
+
+
+def datagrams(msgid, payload, peerid = PEERID, mtu = 100):
+    """
+    This function returns the datagrams of a message.
+    """
+    protocol = BIPDatagramProtocol(None, mtu)
+    protocol.transport = DatagramTransport()
+    protocol.write(BIP_PREFIX_TEMPLATE % (GREETING, peerid), msgid, payload,
+                   ADDRESS)
+    return protocol.transport.datagrams
+
+
+def forged(msgid, offset, total, chunk, peerid = PEERID):
+    """
+    This function returns a datagram with the given fragment header.
+    """
+    return ''.join([BIP_PREFIX_TEMPLATE % (GREETING, peerid),
+                    BIP_MSGID_TEMPLATE % msgid,
+                    BIP_SIZE_TEMPLATE % (len(chunk) + FRAGMENT.size),
+                    FRAGMENT.pack(offset, total), chunk, LINE_ENDING])
+
+
+class ReassemblyTestCase(unittest.TestCase):
+    """
+    The datagrams of a message are reassembled in any order, only the latest
+    message matters.
+    """
+    def setUp(self):
+        self.owner = DatagramOwner(PEERID)
+        self.protocol = BIPDatagramProtocol(self.owner, max_size = 10000,
+                                            timeout = 1)
+        self.protocol.clock = self.clock = task.Clock()
+
+    def receive(self, datagrams):
+        for data in datagrams:
+            self.protocol.datagramReceived(data, ADDRESS)
+
+    def test_round_trip(self):
+        payload = ''.join([chr(random.randrange(256)) for i in xrange(2345)])
+        fragments = datagrams(1, payload)
+        self.assertEqual(len(fragments), 24)
+        random.shuffle(fragments)
+        self.receive(fragments + fragments[:3])
+        self.assertEqual(self.owner.messages, [payload])
+        self.receive(datagrams(2, ''))
+        self.assertEqual(self.owner.messages, [payload, ''])
+
+    def test_late(self):
+        self.receive(datagrams(2, 'second'))
+        self.receive(datagrams(1, 'first'))
+        self.assertEqual(self.owner.messages, ['second'])
+
+    def test_superseded(self):
+        first = datagrams(1, 'a' * 250)
+        self.receive(first[:2])
+        self.receive(datagrams(2, 'b' * 250))
+        self.receive(first[2:])
+        self.assertEqual(self.owner.messages, ['b' * 250])
+
+    def test_too_large(self):
+        self.receive([forged(1, 0, 10001, 'x' * 10)])
+        self.assertEqual(self.protocol.assembling, {})
+        self.receive([forged(1, 0, 1 << 31, 'x' * 10)])
+        self.assertEqual(self.protocol.assembling, {})
+        self.receive(datagrams(1, 'y' * 10000))
+        self.assertEqual(self.owner.messages, ['y' * 10000])
+
+    def test_unknown_peer(self):
+        self.receive(datagrams(1, 'z' * 250, Peerid(0x100)))
+        self.assertEqual(self.protocol.assembling, {})
+        self.assertEqual(self.protocol.last, {})
+        self.assertEqual(self.owner.messages, [])
+
+    def test_expired(self):
+        other = Peerid(0x100)
+        self.owner.peers[other] = None
+        first = datagrams(1, 'a' * 250)
+        self.receive(first[:2])
+        self.clock.advance(0.5)
+        self.receive(datagrams(1, 'b' * 250, other)[:1])
+        self.assertEqual(len(self.protocol.assembling), 2)
+        self.clock.advance(0.6)
+        self.receive(datagrams(2, 'c' * 250, other)[:1])
+        self.assertEqual(self.protocol.assembling.keys(), [other])
+        self.receive(first[2:])
+        self.assertEqual(self.owner.messages, [])
+        self.assertEqual(self.protocol.assembling.keys(), [other])
+
+
+class LoopbackDatagramTestCase(LoopbackTestCase):
+    """
+    Two connectors exchange their messages through udp.
+    """
+    @defer.inlineCallbacks
+    def test_round_trip(self):
+        a = self.start(datagram = True, datagram_max_size = 5000)
+        b = self.start(datagram = True)
+        recorder = self.observe(b)
+        yield self.connect(b, a)
+        yield poll(lambda: a.peers[b.peerid].datagram is not None)
+        body = 'd' * 4000
+        a.send(body)
+        yield poll(lambda: recorder.messages == [body])
+        self.assertNotIdentical(b.datagram_protocol.last.get(a.peerid), None)
+        # too large for a datagram, it goes through the stream connection
+        body = 's' * 6000
+        a.send(body)
+        yield poll(lambda: len(recorder.messages) == 2)
+        self.assertEqual(recorder.messages[1], body)
@@ -0,0 +1,90 @@
+#
+"""
+Tests of the dispatch executor of the connectors.
+"""
+import threading
+
+from twisted.trial import unittest
+
+from executor import DispatchExecutor, INLINE
+from bip.protocol import Peerid
+
+from loopback import FakeTransport, poll
+
+
+class FakePeer(object):
+    """
+    A protocol as given to the executor.
+    """
+    def __init__(self, peerid):
+        self.rpeerid = peerid
+        self.transport = FakeTransport()
+
+    def pauseReading(self):
+        self.transport.pauseProducing()
+
+    def resumeReading(self):
+        self.transport.resumeProducing()
+
+
+class DispatchExecutorTestCase(unittest.TestCase):
+    """
+    The callbacks of a peer run in order, the peer is paused while the queue
+    is full.
+    """
+    def setUp(self):
+        self.executors = []
+
+    def tearDown(self):
+        for executor in self.executors:
+            executor.stop()
+
+    def executor(self, *args):
+        executor = DispatchExecutor(*args)
+        self.executors.append(executor)
+        return executor
+
+    def test_inline(self):
+        executor = self.executor(INLINE)
+        calls = []
+        executor.submit(None, calls.append, threading.currentThread())
+        executor.submit(None, lambda: 1 / 0)
+        executor.submit(None, calls.append, 2)
+        self.assertEqual(calls, [threading.currentThread(), 2])
+
+    def test_order(self):
+        executor = self.executor(4, 10000)
+        peers = [FakePeer(Peerid(i << 8)) for i in xrange(8)]
+        calls = dict([(peer, []) for peer in peers])
+        for i in xrange(1000):
+            for peer in peers:
+                executor.submit(peer, calls[peer].append, i)
+        def done():
+            return not [c for c in calls.values() if len(c) != 1000]
+        deferred = poll(done)
+        deferred.addCallback(lambda result: self.assertEqual(
+                    [c for c in calls.values() if c != range(1000)], []))
+        return deferred
+
+    def test_failure(self):
+        executor = self.executor(1, 100)
+        calls = []
+        executor.submit(None, lambda: 1 / 0)
+        executor.submit(None, calls.append, 1)
+        return poll(lambda: calls == [1])
+
+    def test_pause(self):
+        executor = self.executor(1, 4)
+        peer = FakePeer(Peerid(0x100))
+        gate = threading.Event()
+        calls = []
+        executor.submit(peer, gate.wait, 5)
+        for i in xrange(2):
+            executor.submit(peer, calls.append, i)
+        self.assertFalse(peer.transport.paused)
+        executor.submit(peer, calls.append, 2)
+        self.assertTrue(peer.transport.paused)
+        gate.set()
+        deferred = poll(lambda: not peer.transport.paused)
+        deferred.addCallback(lambda result: poll(lambda: calls == [0, 1, 2]))
+        return deferred
@@ -0,0 +1,91 @@
+#
+"""
+Tests of the per peer flow control.
+"""
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from bip.flow import PeerWriter, SlowPeerError, BLOCK, DROP_OLDEST, \
+                     DROP_NEWEST, DISCONNECT
+
+from loopback import FakeTransport, FakeOwner
+
+
+def writer(policy, high_water = 10):
+    owner = FakeOwner(None, high_water = high_water, slow_peer_policy = policy)
+    return PeerWriter(FakeTransport(), owner)
+
+
+def results(deferred, collected):
+    deferred.addCallbacks(collected.append,
+                          lambda err: collected.append(err.trap(SlowPeerError)))
+    return deferred
+
+
+class PeerWriterTestCase(unittest.TestCase):
+    """
+    The frames are queued while the transport pauses the writer, the policy
+    applies above the high water mark.
+    """
+    def test_direct(self):
+        peer = writer(BLOCK)
+        collected = []
+        peer.write(['abc'], 3, results(defer.Deferred(), collected))
+        self.assertEqual(peer.transport.value(), 'abc')
+        self.assertEqual(collected, [3])
+        self.assertEqual(peer.buffered(), 0)
+        self.assertEqual(peer.frames, 1)
+
+    def test_paused(self):
+        peer = writer(BLOCK)
+        peer.write(['ab'], 2)
+        peer.pauseProducing()
+        self.assertEqual(peer.buffered(), 2)
+        for i in xrange(5):
+            peer.write(['%d' % i], 4)
+        self.assertEqual(peer.buffered(), 22)
+        self.assertEqual(peer.transport.value(), 'ab')
+        peer.resumeProducing()
+        self.assertEqual(peer.transport.value(), 'ab01234')
+        self.assertEqual(peer.buffered(), 0)
+        self.assertEqual(peer.frames, 6)
+
+    def test_drop_newest(self):
+        peer = writer(DROP_NEWEST)
+        peer.pauseProducing()
+        collected = []
+        for i in xrange(4):
+            peer.write(['%d' % i], 4, results(defer.Deferred(), collected))
+        self.assertEqual(collected, [SlowPeerError, SlowPeerError])
+        peer.resumeProducing()
+        self.assertEqual(peer.transport.value(), '01')
+        self.assertEqual(collected, [SlowPeerError, SlowPeerError, 4, 4])
+
+    def test_drop_oldest(self):
+        peer = writer(DROP_OLDEST)
+        peer.pauseProducing()
+        collected = []
+        for i in xrange(4):
+            peer.write(['%d' % i], 4, results(defer.Deferred(), collected))
+        self.assertEqual(collected, [SlowPeerError, SlowPeerError])
+        peer.resumeProducing()
+        self.assertEqual(peer.transport.value(), '23')
+
+    def test_disconnect(self):
+        peer = writer(DISCONNECT)
+        peer.pauseProducing()
+        collected = []
+        for i in xrange(3):
+            peer.write(['%d' % i], 4, results(defer.Deferred(), collected))
+        self.assertTrue(peer.transport.lost)
+        self.assertEqual(collected, [SlowPeerError] * 3)
+        peer.write(['late'], 4, results(defer.Deferred(), collected))
+        self.assertEqual(collected, [SlowPeerError] * 4)
+        self.assertEqual(peer.buffered(), 0)
+
+    def test_unbounded(self):
+        peer = writer(DROP_NEWEST, None)
+        peer.pauseProducing()
+        for i in xrange(100):
+            peer.write(['x'], 1000)
+        self.assertEqual(peer.buffered(), 100000)
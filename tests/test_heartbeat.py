@@ -0,0 +1,149 @@
+#
+"""
+Tests of the heartbeat which detects the dead peers.
+"""
+import time
+
+from twisted.trial import unittest
+from twisted.internet import defer, task, reactor
+
+from bip.protocol import BIPBaseProtocol, Peerid, HEARTBEAT_CAPABILITY, \
+                         FRAME_HEARTBEAT, encode_capabilities
+
+from loopback import LoopbackTestCase, FakeTransport, FakeOwner, \
+                     FakeFactory, frame, poll, PEERID
+
+
+def heartbeating(clock, hb = "200"):
+    """
+    This function returns a protocol with a heartbeat of 0.2s and 3 misses,
+    connected to a peer offering the hb capability.
+    """
+    protocol = BIPBaseProtocol()
+    protocol.clock = clock
+    protocol.factory = FakeFactory(FakeOwner(Peerid(0x100), heartbeat = True,
+                                             heartbeat_interval = 0.2,
+                                             heartbeat_misses = 3))
+    protocol.makeConnection(FakeTransport())
+    protocol.dataReceived(frame(PEERID, 0, encode_capabilities(
+                                            {HEARTBEAT_CAPABILITY : hb})))
+    return protocol
+
+
+def heartbeats(protocol):
+    return len([data for data in protocol.transport.written
+                if data.endswith(FRAME_HEARTBEAT + '\r\n')])
+
+
+class HeartbeatTestCase(unittest.TestCase):
+    """
+    A peer silent for 3 of its intervals is disconnected, unless we stopped
+    reading it.
+    """
+    def setUp(self):
+        self.clock = task.Clock()
+
+    def advance(self, seconds):
+        for i in xrange(int(round(seconds / 0.05))):
+            self.clock.advance(0.05)
+
+    def test_silence(self):
+        protocol = heartbeating(self.clock)
+        self.assertNotIdentical(protocol.heartbeat_call, None)
+        self.advance(0.5)
+        self.assertFalse(protocol.transport.lost)
+        self.advance(0.6)
+        self.assertTrue(protocol.transport.lost)
+        self.assertIdentical(protocol.heartbeat_call, None)
+
+    def test_alive(self):
+        protocol = heartbeating(self.clock)
+        for i in xrange(1, 20):
+            self.advance(0.1)
+            protocol.dataReceived(frame(PEERID, i, 'alive'))
+        self.assertFalse(protocol.transport.lost)
+        protocol.connectionLost(None)
+
+    def test_idle_writes(self):
+        protocol = heartbeating(self.clock)
+        # the handshake was written during the first interval
+        self.advance(0.3)
+        self.assertEqual(heartbeats(protocol), 0)
+        self.advance(0.2)
+        self.assertEqual(heartbeats(protocol), 1)
+        protocol.send('data')
+        protocol.dataReceived(frame(PEERID, 1, 'alive'))
+        self.advance(0.2)
+        self.assertEqual(heartbeats(protocol), 1)
+        self.advance(0.2)
+        self.assertEqual(heartbeats(protocol), 2)
+        self.assertFalse(protocol.transport.lost)
+        protocol.connectionLost(None)
+
+    def test_paused(self):
+        protocol = heartbeating(self.clock)
+        protocol.pauseReading()
+        self.assertTrue(protocol.transport.paused)
+        self.advance(2)
+        self.assertFalse(protocol.transport.lost)
+        protocol.resumeReading()
+        self.assertFalse(protocol.transport.paused)
+        self.advance(0.5)
+        self.assertFalse(protocol.transport.lost)
+        self.advance(0.6)
+        self.assertTrue(protocol.transport.lost)
+
+    def test_invalid_interval(self):
+        for hb in ["abc", "0", "-200", ""]:
+            protocol = heartbeating(self.clock, hb)
+            self.assertTrue(protocol.transport.lost, hb)
+            self.assertIdentical(protocol.heartbeat_call, None)
+
+
+class SlowObserver(object):
+    """
+    A connector observer whose first message takes a while.
+    """
+    def __init__(self, delay):
+        self.delay = delay
+        self.messages = []
+        self.disconnections = []
+
+    def connected(self, peerid):
+        pass
+
+    def disconnected(self, peerid):
+        self.disconnections.append(peerid)
+
+    def received(self, msg):
+        if len(self.messages) == 0:
+            time.sleep(self.delay)
+        self.messages.append(msg.data)
+
+
+class LoopbackHeartbeatTestCase(LoopbackTestCase):
+    """
+    The heartbeats keep the connections of two connectors alive, even while
+    a slow observer stops the reading of its peer.
+    """
+    @defer.inlineCallbacks
+    def test_slow_observer(self):
+        attributes = dict(heartbeat = True, heartbeat_interval = 0.2,
+                          heartbeat_misses = 3)
+        a = self.start(**attributes)
+        b = self.start(dispatch_workers = 1, dispatch_queue_size = 4,
+                       **attributes)
+        observer = SlowObserver(1.5)
+        b.dispatcher.addObserver(observer)
+        yield self.connect(b, a)
+        self.assertNotIdentical(b.peers[a.peerid].heartbeat_call, None)
+        bodies = ['m%d' % i for i in xrange(10)]
+        for body in bodies:
+            # one read, thus one submitted batch, per message
+            a.send(body)
+            yield task.deferLater(reactor, 0.02, lambda: None)
+        yield poll(lambda: b.peers[a.peerid].reading_paused)
+        yield poll(lambda: len(observer.messages) == len(bodies))
+        self.assertEqual(observer.messages, bodies)
+        self.assertEqual(observer.disconnections, [])
+        self.assertIn(a.peerid, b.peers)
@@ -0,0 +1,141 @@
+#
+"""
+Tests of the loop threads and of the connectors sharded over several loops.
+"""
+import threading
+
+from twisted.trial import unittest
+from twisted.internet import defer, threads
+
+from bip.protocol import Peerid
+try:
+    from bip.aio import asyncio
+    import aio
+    import loops
+except ImportError:
+    asyncio = None
+
+from loopback import LoopbackTestCase, Recorder, Proxy, poll
+
+SKIP = "trollius is not installed" if asyncio is None else None
+
+
+class LoopThreadTestCase(unittest.TestCase):
+    """
+    The calls made from another thread are routed to the loop.
+    """
+    skip = SKIP
+
+    def setUp(self):
+        self.loop = loops.LoopThread("test")
+        self.loop.start()
+        self.addCleanup(self.loop.stop)
+
+    def test_call(self):
+        seen = []
+        done = threading.Event()
+        def record():
+            seen.append(threading.currentThread())
+            done.set()
+        self.loop.call(record)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(seen, [self.loop.thread])
+        self.assertEqual(self.loop.routed, 1)
+        self.assertFalse(self.loop.inLoop())
+        self.assertTrue(self.loop.blockingCall(self.loop.inLoop))
+
+    def test_blocking_call(self):
+        self.assertEqual(self.loop.blockingCall(lambda a, b: a + b, 1, 2), 3)
+        self.assertRaises(ZeroDivisionError, self.loop.blockingCall,
+                          lambda: 1 / 0)
+        def later():
+            future = asyncio.Future(loop = self.loop.loop)
+            self.loop.loop.call_later(0.05, future.set_result, 'later')
+            return future
+        self.assertEqual(self.loop.blockingCall(later), 'later')
+
+    def test_stop(self):
+        thread = self.loop.thread
+        self.loop.stop()
+        self.assertFalse(thread.isAlive())
+        self.assertIdentical(self.loop.thread, None)
+
+
+class FakeConnector(object):
+    """
+    A connector as accounted by its loop.
+    """
+    def __init__(self, peers, received, sent):
+        self.peers = dict([(Peerid(i << 8), None) for i in xrange(peers)])
+        self.received_count = received
+        self.sent_count = sent
+
+
+class LoopGroupTestCase(unittest.TestCase):
+    """
+    The connectors go to the least loaded loops.
+    """
+    skip = SKIP
+
+    def test_pick(self):
+        group = loops.LoopGroup(3, "pick")
+        self.assertEqual(len(group), 3)
+        connectors = [FakeConnector(2, 10, 20), FakeConnector(1, 5, 0)]
+        for loop, con in zip(group.pick(2), connectors):
+            loop.assign(con)
+        self.assertEqual(group.pick(), [group.loops[2]])
+        metrics = group.metrics()
+        self.assertEqual([m['name'] for m in metrics],
+                         ['pick-0', 'pick-1', 'pick-2'])
+        self.assertEqual([(m['peers'], m['received'], m['sent'])
+                          for m in metrics], [(2, 10, 20), (1, 5, 0),
+                                              (0, 0, 0)])
+
+
+class ShardedConnectorTestCase(LoopbackTestCase):
+    """
+    A connector served by two loops exchanges messages with twisted
+    connectors.
+    """
+    skip = SKIP
+
+    def setUp(self):
+        LoopbackTestCase.setUp(self)
+        self.group = loops.LoopGroup(2, "shard")
+        self.sharded = aio.ShardedConnector("sharded", self.group, shards = 2)
+        self.sharded.peerid = Peerid()
+        self.sharded.startService()
+
+    def tearDown(self):
+        self.sharded.stopService()
+        self.group.stop()
+        return LoopbackTestCase.tearDown(self)
+
+    @defer.inlineCallbacks
+    def test_shards(self):
+        self.assertEqual(len(self.sharded.shards), 2)
+        self.assertEqual(self.sharded.TXTRecord(),
+                         {self.sharded.name : 'd/%d' % self.sharded.tcp})
+        peers = [self.start(), self.start()]
+        recorders = [self.observe(peer) for peer in peers]
+        recorder = Recorder()
+        self.sharded.dispatcher.addObserver(recorder)
+        for peer in peers:
+            yield threads.deferToThread(self.sharded.connect, Proxy(peer))
+            yield poll(lambda: self.sharded.peerid in peer.peers)
+        self.assertEqual([m['peers'] for m in self.sharded.loopMetrics()],
+                         [1, 1])
+        self.assertEqual(sorted(self.sharded.peers.keys()),
+                         sorted([peer.peerid for peer in peers]))
+        self.sharded.send('to all')
+        self.sharded.send('to one', peers[1].peerid)
+        yield poll(lambda: len(recorders[1].messages) == 2)
+        self.assertEqual(recorders[0].messages, ['to all'])
+        self.assertEqual(recorders[1].messages, ['to all', 'to one'])
+        for peer in peers:
+            peer.send('from %s' % peer.peerid)
+        yield poll(lambda: len(recorder.messages) == 2)
+        self.assertEqual(sorted(recorder.messages),
+                         sorted(['from %s' % peer.peerid for peer in peers]))
+        self.sharded.disconnect(peers[0].peerid)
+        yield poll(lambda: len(self.sharded.peers) == 1)
@@ -0,0 +1,92 @@
+#
+"""
+Tests of the buffer pool of the received messages.
+"""
+from twisted.trial import unittest
+from twisted.internet import defer
+
+import connector
+from bip.pool import BufferPool
+
+from loopback import LoopbackTestCase, poll
+
+
+def leased(pool):
+    return sum([c['leased'] for c in pool.stats()['classes'].values()])
+
+
+class BufferPoolTestCase(unittest.TestCase):
+    """
+    The buffers are leased by power of two classes and recycled.
+    """
+    def setUp(self):
+        self.pool = BufferPool(min_class = 4, max_class = 8, max_free = 2)
+
+    def test_classes(self):
+        self.assertEqual(len(self.pool.lease(0)), 16)
+        self.assertEqual(len(self.pool.lease(16)), 16)
+        self.assertEqual(len(self.pool.lease(17)), 32)
+        self.assertEqual(len(self.pool.lease(256)), 256)
+        self.assertEqual(len(self.pool.lease(257)), 257)
+        self.assertEqual(leased(self.pool), 4)
+
+    def test_recycle(self):
+        buf = self.pool.lease(100)
+        self.pool.release(buf)
+        self.assertIdentical(self.pool.lease(65), buf)
+        stats = self.pool.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual(stats['classes'][128], {'leased' : 1, 'free' : 0})
+
+    def test_max_free(self):
+        bufs = [self.pool.lease(20) for i in xrange(3)]
+        for buf in bufs:
+            self.pool.release(buf)
+        stats = self.pool.stats()
+        self.assertEqual(stats['classes'][32], {'leased' : 0, 'free' : 2})
+        self.assertEqual(stats['discarded'], 1)
+
+    def test_foreign(self):
+        self.pool.release(bytearray(1000))
+        self.pool.release(bytearray(20))
+        self.assertEqual(leased(self.pool), 0)
+        self.assertEqual(self.pool.stats()['discarded'], 0)
+
+
+class LoopbackPoolTestCase(LoopbackTestCase):
+    """
+    Every leased buffer goes back to the pool once its message is handled,
+    whatever the connector does with it.
+    """
+    @defer.inlineCallbacks
+    def test_dispatched(self):
+        pool = BufferPool()
+        a, b = self.start(), self.start(buffer_pool = pool)
+        recorder = self.observe(b)
+        yield self.connect(b, a)
+        bodies = ['m%d' % i * 100 for i in xrange(100)]
+        a.send_many(bodies)
+        yield poll(lambda: len(recorder.messages) == len(bodies))
+        self.assertEqual(recorder.messages, bodies)
+        yield poll(lambda: leased(pool) == 0)
+
+    @defer.inlineCallbacks
+    def test_output_connector(self):
+        pool = BufferPool()
+        a = self.start(connector.OConnector, buffer_pool = pool)
+        b = self.start()
+        yield self.connect(b, a)
+        b.send('to an output connector')
+        yield poll(lambda: len(a.peers) == 0)
+        self.assertTrue(pool.stats()['misses'] > 0)
+        self.assertEqual(leased(pool), 0)
+
+    @defer.inlineCallbacks
+    def test_no_dispatcher(self):
+        pool = BufferPool()
+        a, b = self.start(), self.start(buffer_pool = pool)
+        b.dispatcher = None
+        yield self.connect(b, a)
+        a.send_many(['x' * 100] * 10)
+        yield poll(lambda: pool.stats()['misses'] + pool.stats()['hits'] >= 10)
+        self.assertEqual(leased(pool), 0)
@@ -0,0 +1,213 @@
+#
+"""
+Tests of the BIP framing : message assembly and header decoding.
+"""
+import array
+import random
+
+from twisted.trial import unittest
+
+from bip.protocol import BIPBaseProtocol, MessageBuilder, Peerid, \
+                         LINE_ENDING, BIP_HEADER_TEMPLATE, \
+                         PEERID_CACHE_SIZE, to_payload, is_contiguous
+
+from loopback import FakeTransport, LoopbackTestCase, frame, poll, sender, \
+                     receiver, PEERID
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class View(object):
+    """
+    The layout of a buffer as given by a memoryview.
+    """
+    def __init__(self, shape, strides, itemsize = 1):
+        self.shape = shape
+        self.strides = strides
+        self.itemsize = itemsize
+
+
+class MessageBuilderTestCase(unittest.TestCase):
+    """
+    The body of a message is assembled once in its buffer.
+    """
+    def test_chunks(self):
+        body = 'abcdefghij' * 10
+        data = body + LINE_ENDING
+        msg = MessageBuilder(PEERID, 1, len(data), '127.0.0.1')
+        offset = 0
+        for size in [1, 7, 30, 50, 14]:
+            chunk = 'garbage' + data[offset:offset + size]
+            self.assertEqual(msg.build(chunk, len('garbage')), len(chunk))
+            offset += size
+        self.assertEqual(msg.rlen, 0)
+        self.assertEqual(len(msg), len(body))
+        self.assertIsInstance(msg.view, memoryview)
+        self.assertEqual(msg.view.tobytes(), body)
+        self.assertEqual(msg.data, body)
+        self.assertIdentical(msg.data, msg.data)
+
+    def test_finished(self):
+        msg = MessageBuilder(PEERID, 1, len(LINE_ENDING), '127.0.0.1')
+        msg.build(LINE_ENDING)
+        self.assertRaises(Exception, msg.build, 'x')
+
+    def test_stops_at_the_end(self):
+        data = 'body' + LINE_ENDING
+        msg = MessageBuilder(PEERID, 1, len(data), '127.0.0.1')
+        self.assertEqual(msg.build(data + 'next frame'), len(data))
+        self.assertEqual(msg.data, 'body')
+
+
+class ReceiveTestCase(unittest.TestCase):
+    """
+    The messages of a read are decoded in place.
+    """
+    def test_handshake(self):
+        protocol, observer = receiver()
+        self.assertEqual(observer.connections, 1)
+        self.assertEqual(protocol.rpeerid, PEERID)
+        self.assertEqual(observer.batches, [])
+
+    def test_message(self):
+        protocol, observer = receiver()
+        protocol.dataReceived(frame(PEERID, 1, 'hello'))
+        [msg] = observer.messages()
+        self.assertEqual((msg.peerid, msg.msgid, msg.data),
+                         (PEERID, 1, 'hello'))
+        self.assertEqual(msg.view.tobytes(), 'hello')
+
+    def test_empty_message(self):
+        protocol, observer = receiver()
+        protocol.dataReceived(frame(PEERID, 1, ''))
+        self.assertEqual([m.data for m in observer.messages()], [''])
+
+    def test_split_fuzz(self):
+        bodies = ['', 'a', LINE_ENDING, 'b' * 37, 'c' * 4096, 'd' * 70000]
+        stream = ''.join([frame(PEERID, i + 1, body)
+                          for i, body in enumerate(bodies * 5)])
+        rand = random.Random(2)
+        for i in xrange(50):
+            protocol, observer = receiver()
+            offset = 0
+            while offset < len(stream):
+                size = rand.choice([1, 2, 3, rand.randint(1, 100),
+                                    rand.randint(1, 100000)])
+                protocol.dataReceived(stream[offset:offset + size])
+                offset += size
+            msgs = observer.messages()
+            self.assertEqual([m.data for m in msgs], bodies * 5)
+            self.assertEqual([m.msgid for m in msgs],
+                             range(1, len(bodies) * 5 + 1))
+
+    def test_whole_stream(self):
+        bodies = ['m%d' % i for i in xrange(100)]
+        protocol, observer = receiver()
+        protocol.dataReceived(''.join([frame(PEERID, i + 1, body)
+                                       for i, body in enumerate(bodies)]))
+        self.assertEqual(len(observer.batches), 1)
+        self.assertEqual([m.data for m in observer.messages()], bodies)
+
+
+class HeaderTestCase(unittest.TestCase):
+    """
+    The headers are decoded from their fixed layout.
+    """
+    def test_decode(self):
+        protocol = BIPBaseProtocol()
+        line = BIP_HEADER_TEMPLATE % (BIPBaseProtocol.__greeting__,
+                                      str(PEERID), 0xabcdef, 0x123)
+        self.assertEqual(len(line), BIPBaseProtocol.line_length)
+        self.assertEqual(protocol.decode_header(line),
+                         ('BIP/1.0', PEERID, 0xabcdef, 0x123))
+
+    def test_interned_peerid(self):
+        protocol, observer = receiver()
+        protocol.dataReceived(frame(PEERID, 1, 'a') + frame(PEERID, 2, 'b'))
+        first, second = observer.messages()
+        self.assertIsInstance(first.peerid, Peerid)
+        self.assertIdentical(first.peerid, second.peerid)
+
+    def test_bounded_cache(self):
+        protocol = BIPBaseProtocol()
+        for i in xrange(PEERID_CACHE_SIZE * 3):
+            line = BIP_HEADER_TEMPLATE % (BIPBaseProtocol.__greeting__,
+                                          str(Peerid(i)), 1, 0)
+            self.assertEqual(protocol.decode_header(line)[1], i)
+            self.assertTrue(len(protocol.peerids) <= PEERID_CACHE_SIZE)
+
+    def test_wrong_greeting(self):
+        protocol = BIPBaseProtocol()
+        protocol.transport = FakeTransport()
+        protocol.dataReceived(frame(PEERID, 0, '').replace('BIP/1.0',
+                                                           'XYZ/1.0'))
+        self.assertTrue(protocol.transport.lost)
+        self.assertIdentical(protocol.rpeerid, None)
+
+
+class PayloadTestCase(unittest.TestCase):
+    """
+    The messages are sent from any buffer, the buffers which cannot be sent
+    as one are refused.
+    """
+    def test_str(self):
+        msg = 'abc'
+        self.assertIdentical(to_payload(msg), msg)
+
+    def test_buffers(self):
+        self.assertEqual(to_payload(bytearray('abc')), 'abc')
+        self.assertEqual(to_payload(memoryview('abc')), 'abc')
+        self.assertEqual(to_payload(buffer('xabc', 1)), 'abc')
+        self.assertEqual(to_payload(array.array('B', [97, 98, 99])), 'abc')
+
+    def test_fallback(self):
+        self.assertEqual(to_payload(u'abc'), 'abc')
+        self.assertEqual(to_payload(42), '42')
+
+    def test_contiguous(self):
+        self.assertTrue(is_contiguous(View((4,), (1,))))
+        self.assertTrue(is_contiguous(View((2, 3), (12, 4), 4)))
+        self.assertTrue(is_contiguous(View((1, 3), (100, 4), 4)))
+        self.assertFalse(is_contiguous(View((4,), (2,))))
+        self.assertFalse(is_contiguous(View((2, 3), (16, 4), 4)))
+
+    def test_non_contiguous(self):
+        if numpy is None:
+            raise unittest.SkipTest("numpy is not installed")
+        data = numpy.arange(12, dtype = numpy.int32).reshape((3, 4))
+        self.assertEqual(to_payload(data), data.tostring())
+        self.assertRaises(TypeError, to_payload, data[:, ::2])
+
+    def test_scatter(self):
+        protocol = sender(PEERID)
+        payload = bytearray('payload')
+        protocol.send(payload)
+        [sequence] = protocol.transport.sequences
+        self.assertEqual(len(sequence), 3)
+        self.assertEqual(sequence[1:], ['payload', LINE_ENDING])
+        self.assertEqual(''.join(sequence), frame(PEERID, 1, 'payload'))
+        protocol.send('next')
+        self.assertEqual(protocol.transport.written[1],
+                         frame(PEERID, 2, 'next'))
+
+
+class LoopbackReceiveTestCase(LoopbackTestCase):
+    """
+    Messages sent through a tcp connection.
+    """
+    def test_send(self):
+        a, b = self.start(), self.start()
+        recorder = self.observe(b)
+        bodies = ['', 'x', 'y' * 100000]
+        def send(result):
+            for body in bodies:
+                a.send(body)
+            return poll(lambda: len(recorder.messages) == len(bodies))
+        deferred = self.connect(b, a)
+        deferred.addCallback(send)
+        deferred.addCallback(lambda result:
+                             self.assertEqual(recorder.messages, bodies))
+        return deferred
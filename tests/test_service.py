@@ -0,0 +1,345 @@
+#
+"""
+Tests of the service proxies against services started on the loopback
+interface, without being published. The service module needs the bonjour
+backend (dbus) to be imported.
+"""
+from twisted.internet import defer, threads
+
+import connector
+import variable
+try:
+    import service
+except ImportError:
+    service = None
+
+from loopback import LoopbackTestCase, Proxy, poll
+
+IDLE_TIMEOUT = 0.05 # seconds
+
+
+class ServiceTestCase(LoopbackTestCase):
+    """
+    A test case with services and proxies on them, the control connectors are
+    stopped at the end of the test.
+    """
+    if service is None:
+        skip = "the bonjour backend (dbus) is not installed"
+
+    def start_service(self, connectors = (), **values):
+        """
+        This method starts, without publishing it, a service holding the given
+        string variables and input/output connectors.
+        """
+        svc = service.StoppedService()
+        for name, value in values.iteritems():
+            svc.addVariable(name, 'string', 'test', value = value)
+        for name in connectors:
+            svc.addConnector(name, 'test')
+        svc.__class__ = service.StartedService
+        svc.subservices.startService()
+        self.connectors.append(svc.control)
+        self.connectors.extend(svc.connectors.values())
+        return svc
+
+    def proxy(self, svc, links = None, **attributes):
+        """
+        This method returns a proxy on the service, with its own control
+        connector and link pool.
+        """
+        proxy = service.ServiceProxy(svc.peerid, '127.0.0.1', '127.0.0.1',
+                                     svc.control.tcp)
+        proxy.control = self.start(connector.ControlConnector)
+        if links is None:
+            links = service.ControlLinkPool(idle_timeout = IDLE_TIMEOUT)
+        proxy.links = links
+        for name, value in attributes.iteritems():
+            setattr(proxy, name, value)
+        return proxy
+
+
+class ControlLinkPoolTestCase(ServiceTestCase):
+    """
+    The control links are leased, kept open while idle for a while and
+    closed when room is needed.
+    """
+    @defer.inlineCallbacks
+    def test_reuse(self):
+        svc = self.start_service()
+        proxy = self.proxy(svc)
+        connected = yield proxy.links.lease_deferred(proxy)
+        self.assertTrue(connected)
+        self.assertIn(proxy.control.peerid, svc.control.peers)
+        proxy.links.release(proxy)
+        connected = yield proxy.links.lease_deferred(proxy)
+        self.assertFalse(connected)
+        stats = proxy.links.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual((stats['open'], stats['leased']), (1, 1))
+        proxy.links.release(proxy)
+        self.assertEqual(proxy.links.stats()['idle'], 1)
+
+    @defer.inlineCallbacks
+    def test_idle_timeout(self):
+        svc = self.start_service()
+        proxy = self.proxy(svc)
+        yield proxy.links.lease_deferred(proxy)
+        proxy.links.release(proxy)
+        yield poll(lambda: proxy.links.stats()['open'] == 0)
+        yield poll(lambda: len(svc.control.peers) == 0)
+        self.assertFalse(proxy.linked)
+
+    @defer.inlineCallbacks
+    def test_concurrent_leases(self):
+        svc = self.start_service()
+        proxy = self.proxy(svc)
+        leases = [proxy.links.lease_deferred(proxy) for i in xrange(3)]
+        connected = yield defer.gatherResults(leases)
+        self.assertEqual(connected, [True, False, False])
+        self.assertEqual(len(svc.control.peers), 1)
+        self.assertEqual(proxy.links.stats()['leased'], 1)
+        for lease in leases:
+            proxy.links.release(proxy)
+
+    @defer.inlineCallbacks
+    def test_eviction(self):
+        links = service.ControlLinkPool(max_links = 1, idle_timeout = 5)
+        first, second = self.start_service(), self.start_service()
+        proxies = [self.proxy(first, links), self.proxy(second, links)]
+        yield links.lease_deferred(proxies[0])
+        self.assertRaises(RuntimeError, links.lease_deferred, proxies[1])
+        self.assertEqual(links.stats()['open'], 1)
+        links.release(proxies[0])
+        yield links.lease_deferred(proxies[1])
+        self.assertEqual(links.stats()['evictions'], 1)
+        yield poll(lambda: len(first.control.peers) == 0)
+        links.release(proxies[1])
+        links.discard(proxies[1])
+        self.assertEqual(links.stats()['open'], 0)
+
+    @defer.inlineCallbacks
+    def test_connection_failure(self):
+        svc = self.start_service()
+        proxy = self.proxy(svc)
+        proxy.__connection__ = lambda: proxy.control.__connection__(
+                                                    proxy, timeout = 0.2)
+        svc.control.__stopService__()
+        yield self.assertFailure(proxy.links.lease_deferred(proxy), RuntimeError)
+        stats = proxy.links.stats()
+        self.assertEqual((stats['leased'], stats['misses']), (0, 1))
+        proxy.links.discard(proxy)
+
+    @defer.inlineCallbacks
+    def test_blocking_lease(self):
+        svc = self.start_service()
+        proxy = self.proxy(svc)
+        connected = yield threads.deferToThread(proxy.links.lease, proxy)
+        self.assertTrue(connected)
+        proxy.links.release(proxy)
+
+
+class Values(object):
+    """
+    A variable observer which keeps the values it gets, the observers are
+    weakly referenced.
+    """
+    def __init__(self):
+        self.values = []
+
+    def changed(self, value):
+        self.values.append(value)
+
+
+class ReconnectTestCase(ServiceTestCase):
+    """
+    A reconnecting proxy replays its variable subscriptions once its control
+    link is back.
+    """
+    @defer.inlineCallbacks
+    def test_resubscribe(self):
+        svc = self.start_service(v = 'old')
+        links = service.ControlLinkPool(idle_timeout = 5)
+        proxy = self.proxy(svc, links, reconnect = True)
+        for name, value in [('reconnect_delay', 0.02), ('reconnect_jitter', 0)]:
+            setattr(proxy.control, name, value)
+        values = Values()
+        observers = svc.control.dispatcher.remote_observers
+        subscribed = lambda: 'v' in observers.get(proxy.control.peerid, {})
+        yield proxy.queryDescription()
+        yield threads.deferToThread(proxy.addVariableObserver, 'v',
+                                    values.changed)
+        yield poll(subscribed)
+        svc.setVariableValue('v', 'first')
+        yield poll(lambda: values.values[-1:] == ['first'])
+        reconnected = []
+        proxy.reconnected = lambda: (reconnected.append(True),
+                                     service.ServiceProxy.reconnected(proxy))
+        svc.control.__disconnect__(proxy.control.peerid)
+        yield poll(lambda: len(reconnected) == 1)
+        yield poll(subscribed)
+        svc.setVariableValue('v', 'second')
+        yield poll(lambda: values.values[-1:] == ['second'])
+        links.release(proxy)
+        links.discard(proxy)
+
+
+class QueryCounter(object):
+    """
+    A control connector query wrapper which counts the queries.
+    """
+    def __init__(self, control):
+        self.query = control.query
+        self.count = 0
+        control.query = self
+
+    def __call__(self, msg, peerid):
+        self.count += 1
+        return self.query(msg, peerid)
+
+
+class ValuesTestCase(ServiceTestCase):
+    """
+    The values of several variables and connectors are given by a single
+    control query.
+    """
+    @defer.inlineCallbacks
+    def test_values(self):
+        svc = self.start_service(connectors = ['out'], v = '1', w = '2')
+        client = self.start()
+        yield self.connect(client, svc.connectors['out'])
+        proxy = self.proxy(svc)
+        yield proxy.queryDescription()
+        counter = QueryCounter(proxy.control)
+        values = yield proxy.queryVariableValues(['v', 'w', 'out'])
+        self.assertEqual(values, {'v' : '1', 'w' : '2',
+                                  'out' : [client.peerid]})
+        self.assertEqual(counter.count, 1)
+        value = yield proxy.queryVariableValue('w')
+        self.assertEqual(value, '2')
+        peers = yield proxy.queryConnectedPeers('out')
+        self.assertEqual(peers, [client.peerid])
+
+    @defer.inlineCallbacks
+    def test_blocking(self):
+        svc = self.start_service(v = '1', w = '2')
+        proxy = self.proxy(svc)
+        values = yield threads.deferToThread(proxy.getVariableValues,
+                                             ['v', 'w'])
+        self.assertEqual(values, {'v' : '1', 'w' : '2'})
+
+    @defer.inlineCallbacks
+    def test_constant(self):
+        svc = self.start_service(v = '1')
+        constant = svc.variables['c'] = variable.Variable('string', 'test',
+                                                variable.CONSTANT, 'k')
+        constant.name = 'c'
+        proxy = self.proxy(svc)
+        yield proxy.queryDescription()
+        counter = QueryCounter(proxy.control)
+        values = yield proxy.queryVariableValues(['c'])
+        self.assertEqual(values, {'c' : 'k'})
+        values = yield proxy.queryVariableValues(['c', 'v'])
+        self.assertEqual(values, {'c' : 'k', 'v' : '1'})
+        self.assertEqual(counter.count, 1)
+
+    @defer.inlineCallbacks
+    def test_missing(self):
+        svc = self.start_service(v = '1', w = '2')
+        proxy = self.proxy(svc)
+        yield self.assertFailure(proxy.queryVariableValues(['v', 'nope']),
+                                 KeyError)
+        del svc.variables['w']
+        yield self.assertFailure(proxy.queryVariableValues(['v', 'w']),
+                                 KeyError)
+        self.assertEqual(proxy.links.stats()['leased'], 0)
+
+    @defer.inlineCallbacks
+    def test_repository(self):
+        services = [self.start_service(v = str(i)) for i in xrange(3)]
+        repository = service.ServiceRepository()
+        proxies = [self.proxy(svc) for svc in services]
+        dead = proxies[2]
+        dead.__connection__ = lambda: dead.control.__connection__(
+                                                    dead, timeout = 0.2)
+        services[2].control.__stopService__()
+        for proxy in proxies:
+            repository.proxys[proxy.peerid] = proxy
+        values = yield repository.queryVariableValues(['v'])
+        self.assertEqual(values, {proxies[0].peerid : {'v' : '0'},
+                                  proxies[1].peerid : {'v' : '1'}})
+        values = yield repository.queryVariableValues(['v'],
+                        filter = lambda proxy: proxy is proxies[1])
+        self.assertEqual(values, {proxies[1].peerid : {'v' : '1'}})
+
+
+class DeferredProxyTestCase(ServiceTestCase):
+    """
+    The queries of a proxy return deferreds, the control link is leased for
+    each of them and the description is asked for once.
+    """
+    @defer.inlineCallbacks
+    def test_description(self):
+        svc = self.start_service(connectors = ['out'], v = '1')
+        proxy = self.proxy(svc)
+        self.assertFalse(proxy.resolved)
+        result = yield proxy.queryDescription()
+        self.assertIdentical(result, proxy)
+        self.assertTrue(proxy.resolved)
+        self.assertEqual(proxy.variables.keys(), ['v'])
+        self.assertEqual(proxy.connectors.keys(), ['out'])
+        self.assertEqual(proxy.connectors['out'].tcp,
+                         svc.connectors['out'].tcp)
+        self.assertEqual(proxy.links.stats()['leased'], 0)
+
+    @defer.inlineCallbacks
+    def test_concurrent_description(self):
+        svc = self.start_service(v = '1')
+        proxy = self.proxy(svc)
+        counter = QueryCounter(proxy.control)
+        results = yield defer.gatherResults([proxy.queryDescription()
+                                             for i in xrange(3)])
+        self.assertEqual(results, [proxy] * 3)
+        self.assertEqual(counter.count, 1)
+
+    @defer.inlineCallbacks
+    def test_described_first(self):
+        svc = self.start_service(v = '1')
+        proxy = self.proxy(svc)
+        counter = QueryCounter(proxy.control)
+        value = yield proxy.queryVariableValue('v')
+        self.assertEqual(value, '1')
+        self.assertTrue(proxy.resolved)
+        self.assertEqual(counter.count, 2)
+
+    @defer.inlineCallbacks
+    def test_in_flight(self):
+        svc = self.start_service(connectors = ['out'], v = '1', w = '2')
+        proxy = self.proxy(svc)
+        yield proxy.queryDescription()
+        queries = [proxy.queryVariableValue(name) for name in ['v', 'w'] * 10]
+        queries.append(proxy.queryConnectedPeers('out'))
+        results = yield defer.gatherResults(queries)
+        self.assertEqual(results, ['1', '2'] * 10 + [[]])
+        stats = proxy.links.stats()
+        self.assertEqual((stats['misses'], stats['leased']), (1, 0))
+
+    @defer.inlineCallbacks
+    def test_blocking(self):
+        svc = self.start_service(connectors = ['out'], v = '1')
+        proxy = self.proxy(svc)
+        yield threads.deferToThread(proxy.update_description)
+        self.assertTrue(proxy.resolved)
+        value = yield threads.deferToThread(proxy.getVariableValue, 'v')
+        self.assertEqual(value, '1')
+        peers = yield threads.deferToThread(proxy.getConnectedPeers, 'out')
+        self.assertEqual(peers, [])
+        yield self.assertFailure(threads.deferToThread(proxy.getConnectedPeers,
+                                                       'nope'), KeyError)
+
+    @defer.inlineCallbacks
+    def test_dead(self):
+        svc = self.start_service(v = '1')
+        proxy = self.proxy(svc)
+        proxy.alive = False
+        yield self.assertFailure(proxy.queryDescription(), RuntimeError)
+        yield self.assertFailure(proxy.queryVariableValue('v'), RuntimeError)
@@ -0,0 +1,195 @@
+#
+"""
+Tests of the shared memory transport between peers of the same host.
+"""
+import os
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from bip import shm
+from bip.protocol import BIPBaseProtocol, Peerid, FRAME_PLAIN, FRAME_SHM
+
+from loopback import LoopbackTestCase, Proxy, poll, frame, receiver, PEERID
+
+
+def ring_files():
+    return [name for name in os.listdir(shm.SHM_DIRECTORY)
+            if name.startswith(shm.SHM_PREFIX)]
+
+
+def extended_receiver():
+    """
+    This function returns a hand fed protocol whose frames start with their
+    encoding tag, without any shared memory ring.
+    """
+    protocol, observer = receiver()
+    protocol.extended = True
+    protocol.line_length = BIPBaseProtocol.line_length + len(FRAME_PLAIN)
+    return protocol, observer
+
+
+class RingTestCase(unittest.TestCase):
+    """
+    The payloads go through the ring, only their notification is sent.
+    """
+    def setUp(self):
+        self.writer = shm.RingWriter(Peerid(0x100), 1000)
+        self.addCleanup(self.writer.close)
+
+    def reader(self):
+        reader = shm.RingReader(self.writer.path)
+        self.addCleanup(reader.close)
+        return reader
+
+    def test_round_trip(self):
+        reader = self.reader()
+        self.assertFalse(os.path.exists(self.writer.path))
+        for i in xrange(20):
+            payload = chr(65 + i) * (100 + 17 * i)
+            notification = self.writer.write(payload)
+            head, length = shm.NOTIFICATION.unpack(notification)
+            self.assertTrue(reader.holds(head, length))
+            buf = bytearray(length)
+            reader.read(head, length, buf)
+            self.assertEqual(str(buf), payload)
+
+    def test_full(self):
+        reader = self.reader()
+        notification = self.writer.write('x' * 600)
+        self.assertIdentical(self.writer.write('y' * 600), None)
+        head, length = shm.NOTIFICATION.unpack(notification)
+        reader.read(head, length, bytearray(length))
+        self.assertNotIdentical(self.writer.write('y' * 600), None)
+
+    def test_holds(self):
+        reader = self.reader()
+        self.assertTrue(reader.holds(0, 1000))
+        self.assertTrue(reader.holds(2500, 500))
+        self.assertFalse(reader.holds(0, 1001))
+        self.assertFalse(reader.holds(2900, 200))
+
+
+class RingPathTestCase(unittest.TestCase):
+    """
+    The ring given by a remote peer must be a ring file of SHM_DIRECTORY.
+    """
+    def shm_file(self, name, content):
+        path = os.path.join(shm.SHM_DIRECTORY, name)
+        open(path, 'wb').write(content)
+        self.addCleanup(lambda: os.path.exists(path) and os.unlink(path))
+        return path
+
+    def assertRefused(self, path):
+        self.assertRaises(ValueError, shm.RingReader, path)
+
+    def test_outside(self):
+        path = os.path.abspath(self.mktemp())
+        open(path, 'wb').write('\0' * 100)
+        self.assertRefused(path)
+        self.assertTrue(os.path.exists(path))
+        self.assertRefused(os.path.join(shm.SHM_DIRECTORY, '..',
+                                        os.path.relpath(path, '/')))
+        self.assertTrue(os.path.exists(path))
+
+    def test_symlink(self):
+        target = os.path.abspath(self.mktemp())
+        open(target, 'wb').write('\0' * 100)
+        link = os.path.join(shm.SHM_DIRECTORY,
+                            shm.SHM_PREFIX + 'link-%d' % os.getpid())
+        os.symlink(target, link)
+        self.addCleanup(os.unlink, link)
+        self.assertRefused(link)
+        self.assertEqual(open(target, 'rb').read(), '\0' * 100)
+
+    def test_prefix(self):
+        path = self.shm_file('other-%d' % os.getpid(), '\0' * 100)
+        self.assertRefused(path)
+        self.assertTrue(os.path.exists(path))
+
+    def test_too_small(self):
+        path = self.shm_file(shm.SHM_PREFIX + 'small-%d' % os.getpid(),
+                             '\0' * shm.RING_HEADER.size)
+        self.assertRefused(path)
+
+    def test_not_regular(self):
+        path = os.path.join(shm.SHM_DIRECTORY,
+                            shm.SHM_PREFIX + 'dir-%d' % os.getpid())
+        os.mkdir(path)
+        self.addCleanup(os.rmdir, path)
+        self.assertRaises((ValueError, EnvironmentError), shm.RingReader,
+                          path)
+
+
+class NotificationTestCase(unittest.TestCase):
+    """
+    A shared memory notification must be negotiated and inside the ring.
+    """
+    def test_not_negotiated(self):
+        protocol, observer = extended_receiver()
+        protocol.dataReceived(frame(PEERID, 1,
+                                    shm.NOTIFICATION.pack(0, 10), FRAME_SHM))
+        self.assertTrue(protocol.transport.lost)
+        self.assertEqual(observer.messages(), [])
+
+    def test_outside_of_the_ring(self):
+        writer = shm.RingWriter(Peerid(0x100), 1000)
+        self.addCleanup(writer.close)
+        protocol, observer = extended_receiver()
+        protocol.shm_reader = shm.RingReader(writer.path)
+        self.addCleanup(protocol.shm_reader.close)
+        protocol.dataReceived(frame(PEERID, 1,
+                                    shm.NOTIFICATION.pack(900, 1 << 30),
+                                    FRAME_SHM))
+        self.assertTrue(protocol.transport.lost)
+        self.assertEqual(observer.messages(), [])
+
+    def test_truncated(self):
+        writer = shm.RingWriter(Peerid(0x100), 1000)
+        self.addCleanup(writer.close)
+        protocol, observer = extended_receiver()
+        protocol.shm_reader = shm.RingReader(writer.path)
+        self.addCleanup(protocol.shm_reader.close)
+        protocol.dataReceived(frame(PEERID, 1, 'abc', FRAME_SHM))
+        self.assertTrue(protocol.transport.lost)
+
+
+class LoopbackShmTestCase(LoopbackTestCase):
+    """
+    Two connectors of the same host exchange the large payloads through the
+    shared memory rings.
+    """
+    @defer.inlineCallbacks
+    def test_round_trip(self):
+        before = ring_files()
+        attributes = dict(shared_memory = True, shm_size = 1 << 20,
+                          shm_threshold = 1000)
+        a, b = self.start(**attributes), self.start(**attributes)
+        recorder = self.observe(b)
+        yield self.connect(b, a)
+        self.assertNotIdentical(b.peers[a.peerid].shm_reader, None)
+        self.assertEqual(ring_files(), before)
+        bodies = ['small'] + [os.urandom(300000) for i in xrange(10)] + \
+                 ['end']
+        for body in bodies:
+            a.send(body)
+        yield poll(lambda: len(recorder.messages) == len(bodies))
+        self.assertTrue(recorder.messages == bodies)
+
+    @defer.inlineCallbacks
+    def test_forged_ring(self):
+        target = os.path.abspath(self.mktemp())
+        open(target, 'wb').write('keep me')
+        a = self.start(shared_memory = True)
+        b = self.start(shared_memory = True)
+        offer = b.protocol_factory.protocol.offer_capabilities
+        def forged(protocol):
+            capabilities = offer(protocol)
+            capabilities['shm'] = target
+            return capabilities
+        b.protocol_factory.protocol = type('Forging', (BIPBaseProtocol,),
+                                    {'offer_capabilities' : forged})
+        recorder = self.observe(a)
+        a.__connection__(Proxy(b)).addErrback(lambda err: None)
+        yield poll(lambda: len(recorder.disconnections) != 0)
+        self.assertEqual(open(target).read(), 'keep me')
@@ -0,0 +1,49 @@
+#
+"""
+Tests of the unix socket listener of the connectors, which is opt-in.
+"""
+import os
+
+from lxml import etree
+from twisted.internet import defer, address
+
+import connector
+import codebench.xml as xml
+
+from loopback import LoopbackTestCase, poll
+
+
+class UnixSocketTestCase(LoopbackTestCase):
+    """
+    By default the txt record and the description are the OMiSCID ones, a
+    connector listening on an unix socket publishes its path.
+    """
+    def description(self, con):
+        proxy = connector.ConnectorProxy(con.name, '127.0.0.1')
+        xml.Marshall.update(proxy, etree.fromstring(xml.Marshall.dumps(con)))
+        return proxy
+
+    def test_default(self):
+        con = self.start()
+        self.assertIdentical(con.unix, None)
+        self.assertEqual(con.TXTRecord(),
+                         {con.name : '%s/%d' % (con.txt_prefix, con.tcp)})
+        description = xml.Marshall.dumps(con)
+        self.assertNotIn('<unix', description)
+        self.assertNotIn('<udp', description)
+        self.assertIdentical(self.description(con).unix, None)
+
+    @defer.inlineCallbacks
+    def test_opt_in(self):
+        a = self.start(unix_socket = True)
+        self.assertTrue(os.path.exists(a.unix))
+        self.assertEqual(a.TXTRecord(), {a.name : '%s/%d/%s'
+                                         % (a.txt_prefix, a.tcp, a.unix)})
+        self.assertEqual(self.description(a).unix, a.unix)
+        b = self.start()
+        recorder = self.observe(b)
+        yield self.connect(b, a)
+        self.assertIsInstance(a.peers[b.peerid].transport.getHost(),
+                              address.UNIXAddress)
+        a.send('through unix')
+        yield poll(lambda: recorder.messages == ['through unix'])
@@ -0,0 +1,86 @@
+#
+"""
+Tests of the timer wheel, driven by a task.Clock.
+"""
+import random
+
+from twisted.trial import unittest
+from twisted.internet import task
+
+from bip.wheel import TimerWheel
+
+TICK = 0.05
+STEP = 0.01 # seconds, the clock advances by steps
+
+
+class TimerWheelTestCase(unittest.TestCase):
+    """
+    The timers never fire before their expiry, and at most one tick late.
+    """
+    def setUp(self):
+        self.clock = task.Clock()
+        self.fired = []
+
+    def fire(self, expiry):
+        self.fired.append((expiry, self.clock.seconds()))
+
+    def schedule(self, wheel, delay):
+        return wheel.callLater(delay, self.fire, self.clock.seconds() + delay)
+
+    def advance(self, steps):
+        for i in xrange(steps):
+            self.clock.advance(STEP)
+
+    def check(self, count):
+        self.assertEqual(len(self.fired), count)
+        for expiry, fired in self.fired:
+            self.assertTrue(fired >= expiry - 1e-9, (expiry, fired))
+            self.assertTrue(fired <= expiry + TICK + STEP + 1e-9,
+                            (expiry, fired))
+
+    def test_random(self):
+        rand = random.Random(23)
+        for size in [512, 8]:
+            wheel = TimerWheel(self.clock, TICK, size)
+            for i in xrange(300):
+                self.advance(rand.randint(0, 7))
+                self.schedule(wheel, rand.choice([0, TICK, 4 * TICK,
+                                                  rand.uniform(0, 1)]))
+            while wheel.running:
+                self.advance(1)
+        self.check(600)
+
+    def test_lagging_cursor(self):
+        wheel = TimerWheel(self.clock, TICK)
+        self.schedule(wheel, 1)
+        self.advance(4)
+        # expires at 0.06, after the next tick of the cursor at 0.05
+        self.schedule(wheel, 2 * STEP)
+        self.advance(5)
+        self.check(0)
+        self.advance(2)
+        self.check(1)
+
+    def test_restart(self):
+        wheel = TimerWheel(self.clock, TICK)
+        self.schedule(wheel, TICK)
+        self.advance(10)
+        self.check(1)
+        self.assertFalse(wheel.running)
+        self.assertIdentical(wheel.last, None)
+        self.advance(3)
+        self.schedule(wheel, 2 * TICK)
+        self.advance(20)
+        self.check(2)
+
+    def test_cancel(self):
+        wheel = TimerWheel(self.clock, TICK, 8)
+        timers = [self.schedule(wheel, delay) for delay in [0.1, 1, 2]]
+        self.assertEqual(len(wheel), 3)
+        timers[1].cancel()
+        self.assertFalse(timers[1].active())
+        self.assertTrue(timers[2].active())
+        self.advance(300)
+        self.check(2)
+        self.assertEqual(len(wheel), 0)
+        self.assertFalse(wheel.running)
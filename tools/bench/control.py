@@ -0,0 +1,87 @@
+#
+"""
+Dispatch rate of the control messages by ControlEventDispatcher.received. The
+variable events of a remote service are dispatched to the variable proxy of its
+ServiceProxy, first through lxml only (the former path) and then with the
+controlparser fast path.
+"""
+import os
+import sys
+import time
+
+try:
+    from pymiscid import dispatcher, controlparser, variable
+    from pymiscid.bip.protocol import Peerid
+    from pymiscid.cstes import CONTROL_EVENT, VARIABLE_EVENT_MSG
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..',
+                                    'pymiscid'))
+    import dispatcher, controlparser, variable
+    from bip.protocol import Peerid
+    from cstes import CONTROL_EVENT, VARIABLE_EVENT_MSG
+
+MSG_COUNT = 50000
+REPEAT = 3
+PEERID = Peerid(0x0badbe00)
+
+
+class Message(object):
+    """
+    Just enough message for the dispatcher.
+    """
+    def __init__(self, data):
+        self.data = data
+        self.peerid = PEERID
+
+
+class Proxy(object):
+    """
+    Just enough service proxy for the events.
+    """
+    def __init__(self):
+        self.peerid = PEERID
+        self.variables = {'position' : variable.VariableProxy()}
+
+
+def lxml_only(data):
+    return None
+
+
+def run(msgs, fast):
+    """
+    Best time over REPEAT runs.
+    """
+    parse = controlparser.parse
+    if not fast:
+        controlparser.parse = lxml_only
+    try:
+        best = None
+        for i in xrange(REPEAT):
+            disp = dispatcher.ControlEventDispatcher()
+            proxy = Proxy()
+            disp.addProxy(proxy)
+            disp.connected(PEERID)
+            start = time.time()
+            for msg in msgs:
+                disp.received(msg)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+    finally:
+        controlparser.parse = parse
+
+
+def main():
+    events = [Message(CONTROL_EVENT % (VARIABLE_EVENT_MSG %
+                                       ('position', '%d %d' % (i, -i))))
+              for i in xrange(MSG_COUNT)]
+    print "%d variable events per run" % MSG_COUNT
+    legacy = run(events, False)
+    current = run(events, True)
+    print "lxml %.3fs (%6d msg/s), fast path %.3fs (%6d msg/s), x%.1f" % \
+          (legacy, MSG_COUNT / legacy, current, MSG_COUNT / current,
+           legacy / current)
+
+
+if __name__ == "__main__":
+    main()
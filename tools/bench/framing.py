@@ -0,0 +1,178 @@
+#
+"""
+Micro-benchmark of the BIP framing engine. A stream made of many small BIP
+messages is cut in reads of READ_SIZE bytes and fed to the current
+BIPBaseProtocol and to the former slicing FastLineReceiver/MessageBuilder pair.
+"""
+import os
+import sys
+import time
+import ctypes
+import logging
+
+try:
+    from pymiscid.bip import protocol
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..',
+                                    'pymiscid'))
+    from bip import protocol
+
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 65536
+MSG_SIZES = [16, 64, 256]
+MSG_COUNT = 20000
+REPEAT = 5
+
+
+class NullTransport(object):
+    """
+    Just enough transport for the receive path.
+    """
+    bufferSize = 65536
+
+
+class LegacyMessageBuilder(object):
+    """
+    The former MessageBuilder : ctypes buffer and data slicing.
+    """
+    def __init__(self, peerid, msgid, rlen, host):
+        self.peerid = peerid
+        self.msgid = msgid
+        self.rlen = rlen
+        self.host = host
+        self.buffer = (ctypes.c_char * (rlen - 2))()
+
+    def __get_data__(self):
+        return self.buffer.raw
+    data = property(__get_data__)
+
+    def build(self, data):
+        data, rest = data[:self.rlen], data[self.rlen:]
+        datalen = len(data)
+        if datalen == 2:
+            pass
+        elif self.rlen == datalen:
+            self.buffer[-(self.rlen - 2):] = data[:-2]
+        elif (self.rlen - 2) <= datalen:
+            self.buffer[-(self.rlen - 2):] = data
+        else:
+            self.buffer[-(self.rlen - 2):-(self.rlen - 2) + datalen] = data
+        self.rlen -= datalen
+        return rest
+
+
+class LegacyReceiver(object):
+    """
+    The former FastLineReceiver with the former BIPBaseProtocol callbacks.
+    """
+    line_length = protocol.BIPBaseProtocol.line_length
+    line_mode = True
+    line_buffer = None
+    line_rlen = 0
+    msg = None
+    count = 0
+
+    def __init__(self):
+        self.transport = NullTransport()
+
+    def _dataReceived(self, data):
+        rest = ""
+        if self.line_mode:
+            if self.line_rlen == 0:
+                self.line_buffer = []
+                self.line_rlen = self.line_length
+            hdr, rest = data[:self.line_rlen], data[self.line_rlen:]
+            self.line_rlen -= len(hdr)
+            self.line_buffer.append(hdr)
+            if self.line_rlen == 0:
+                self.lineReceived(''.join(self.line_buffer))
+                self.line_mode = False
+        else:
+            rest = self.rawDataReceived(data)
+        return rest
+
+    def dataReceived(self, data):
+        while len(data) != 0:
+            data = self._dataReceived(data)
+
+    def lineReceived(self, line):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Line Data Receive")
+        proto, peerid, msgid, size = line.split()
+        peerid = protocol.Peerid(peerid)
+        size = int(size, 16)
+        msgid = int(msgid, 16)
+        self.msg = LegacyMessageBuilder(peerid, msgid, size + 2, None)
+
+    def rawDataReceived(self, data):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Raw Data Received")
+        rest = self.msg.build(data)
+        if self.msg.rlen == 0:
+            optimized_size = max(len(self.msg.data) / 10 , 65535)
+            if (self.transport.bufferSize > (optimized_size * 2)) or \
+               (self.transport.bufferSize < (optimized_size / 2)):
+                self.transport.bufferSize = optimized_size
+            self.count += 1
+            self.line_mode = True
+        return rest
+
+
+class Receiver(protocol.BIPBaseProtocol):
+    """
+    The current BIPBaseProtocol, counting the received messages.
+    """
+    host = None
+    count = 0
+    rpeerid = protocol.Peerid(0)
+
+    def __init__(self):
+        protocol.BIPBaseProtocol.__init__(self)
+        self.transport = NullTransport()
+
+    def receivedBatchEvent(self, msgs):
+        self.count += len(msgs)
+
+
+def build_stream(size):
+    """
+    This function returns the reads of a stream of MSG_COUNT messages.
+    """
+    body = 'x' * size
+    frames = [protocol.BIP_HEADER_TEMPLATE % ('BIP/1.0', '0badbe00', i + 1,
+              size) + body + protocol.LINE_ENDING for i in xrange(MSG_COUNT)]
+    stream = ''.join(frames)
+    return [stream[i:i + READ_SIZE] for i in xrange(0, len(stream), READ_SIZE)]
+
+
+def run(receiver_type, reads):
+    """
+    Best time over REPEAT runs.
+    """
+    best = None
+    for i in xrange(REPEAT):
+        receiver = receiver_type()
+        start = time.time()
+        for data in reads:
+            receiver.dataReceived(data)
+        elapsed = time.time() - start
+        assert receiver.count == MSG_COUNT
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    print "%d messages per run, reads of %d bytes" % (MSG_COUNT, READ_SIZE)
+    for size in MSG_SIZES:
+        reads = build_stream(size)
+        legacy = run(LegacyReceiver, reads)
+        current = run(Receiver, reads)
+        print "%5d bytes : legacy %.3fs (%7d msg/s), offset cursor %.3fs " \
+              "(%7d msg/s), x%.1f" % (size, legacy, MSG_COUNT / legacy,
+                                     current, MSG_COUNT / current,
+                                     legacy / current)
+
+
+if __name__ == "__main__":
+    main()
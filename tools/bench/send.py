@@ -0,0 +1,89 @@
+#
+"""
+Throughput of Connector.send from a producer thread. The former path wakes up
+the reactor once per message with reactor.callFromThread, the current one
+queues the messages in the connector outbox which the reactor drains in
+batches.
+"""
+import os
+import sys
+import time
+import threading
+
+try:
+    from pymiscid import connector
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..',
+                                    'pymiscid'))
+    import connector
+
+from twisted.internet import reactor
+
+MSG_COUNT = 200000
+MSG = 'x' * 64
+REPEAT = 3
+
+
+class CountingConnector(connector.Connector):
+    """
+    A connector without peers which only counts the sent messages.
+    """
+    count = 0
+    done = None
+
+    def __send__(self, msg, peerid = None, deferred = None, compressed = None):
+        self.count += 1
+        if self.count == MSG_COUNT:
+            self.done.set()
+
+
+def legacy_send(con, msg):
+    reactor.callFromThread(con.__send__, msg, peerid = None)
+
+
+def current_send(con, msg):
+    con.send(msg)
+
+
+def current_send_many(con, msg):
+    con.send_many([msg] * 100)
+
+
+def run(send, batch = 1):
+    """
+    Best time over REPEAT runs.
+    """
+    best = None
+    for i in xrange(REPEAT):
+        con = CountingConnector()
+        con.done = threading.Event()
+        start = time.time()
+        for j in xrange(MSG_COUNT / batch):
+            send(con, MSG)
+        con.done.wait(60)
+        elapsed = time.time() - start
+        assert con.count == MSG_COUNT
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    thread = threading.Thread(target = reactor.run,
+                              kwargs = {'installSignalHandlers' : False})
+    thread.start()
+    try:
+        print "%d messages of %d bytes from a producer thread" % \
+                                                    (MSG_COUNT, len(MSG))
+        for name, send, batch in [('callFromThread', legacy_send, 1),
+                                  ('send', current_send, 1),
+                                  ('send_many(100)', current_send_many, 100)]:
+            elapsed = run(send, batch)
+            print "%-16s : %.3fs (%8d msg/s)" % (name, elapsed,
+                                                MSG_COUNT / elapsed)
+    finally:
+        reactor.callFromThread(reactor.stop)
+        thread.join()
+
+
+if __name__ == "__main__":
+    main()